@@ -0,0 +1,135 @@
+# CPU per ingested session: parsing the payload, aggregating its events and
+# encoding the raw record. "former" reproduces the previous per-event DomEvent
+# objects, asdict serialization and per-object aggregation loops; "columnar" is
+# the current path, and "compose" adds everything else done per session before
+# the storage round-trip (keys, rollup index, time buckets).
+#
+#   python benchmarks/ingest.py --sessions 5000 --events 400
+import argparse
+import dataclasses
+import json
+import random
+import time
+from collections import Counter
+
+from omnimatsoo.codec import RecordCodec
+from omnimatsoo.entities import PlaybackStatistics
+from omnimatsoo.kvstorage import SUPPORTED, Client
+from omnimatsoo.services import PlaybackBenchmark
+
+TARGETS = ("loadstart", "loadeddata", "playing", "ended")
+
+
+@dataclasses.dataclass
+class FormerDomEvent:
+    timestamp: float
+    type: str
+
+
+@dataclasses.dataclass
+class FormerQualitySample:
+    samples: int
+    creationTimes: list[float]
+    droppedVideoFrames: list[int]
+    totalVideoFrames: list[int]
+
+
+@dataclasses.dataclass
+class FormerStatistics:
+    id: str
+    timestamp: int
+    target: str
+    duration: float
+    events: list[FormerDomEvent]
+    device_tag: str
+    playbackquality: FormerQualitySample
+
+    def __post_init__(self):
+        self.playbackquality = FormerQualitySample(**self.playbackquality)
+        for i, e in enumerate(self.events):
+            self.events[i] = (
+                FormerDomEvent(**e) if isinstance(e, dict) else FormerDomEvent(*e)
+            )
+
+
+def former(body: bytes):
+    stats = FormerStatistics(**json.loads(body))
+    counts = Counter(evt.type for evt in stats.events)
+    targets = dict.fromkeys(TARGETS, 0)
+    for evt in stats.events:
+        if evt.type in targets and not targets[evt.type]:
+            targets[evt.type] = evt.timestamp
+    record = json.dumps(dataclasses.asdict(stats), separators=(",", ":"))
+    return counts, targets, record
+
+
+def columnar(codec: RecordCodec):
+    def ingest(body: bytes):
+        stats = PlaybackStatistics(**json.loads(body))
+        counts = stats.events.counts()
+        targets = stats.events.first_timestamps(TARGETS)
+        return counts, targets, codec.encode(stats)
+
+    return ingest
+
+
+def compose(service: PlaybackBenchmark):
+    def ingest(body: bytes):
+        return service._compose_writes(PlaybackStatistics(**json.loads(body)))
+
+    return ingest
+
+
+def payload(i: int, num_events: int) -> bytes:
+    now, events = 0.0, []
+    for evt in ("loadstart", "loadedmetadata", "loadeddata", "canplay", "playing"):
+        now += random.uniform(1, 50)
+        events.append([now, evt])
+    while len(events) < num_events - 1:
+        now += random.uniform(1, 500)
+        events.append([now, random.choice(("timeupdate", "waiting", "playing"))])
+    events.append([now + 100, "ended"])
+    return json.dumps(
+        {
+            "id": f"{i:08x}",
+            "timestamp": 1700000000000 + i,
+            "target": f"https://d111111abcdef8.cloudfront.net/video/{i % 50}/a.mp4",
+            "duration": random.uniform(10, 600),
+            "events": events,
+            "device_tag": random.choice(("pixel", "ios", "desktop-chrome")),
+            "playbackquality": {
+                "samples": 10,
+                "creationTimes": [k * 1000.0 for k in range(10)],
+                "droppedVideoFrames": [0] * 10,
+                "totalVideoFrames": [k * 30 for k in range(10)],
+            },
+        }
+    ).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=300)
+    args = parser.parse_args()
+
+    Client.init(SUPPORTED.MEMORY)
+    bodies = [payload(i, args.events) for i in range(args.sessions)]
+    paths = {
+        "former": former,
+        "columnar+json": columnar(RecordCodec("json")),
+        "columnar+packed": columnar(RecordCodec("packed")),
+        "compose+packed": compose(PlaybackBenchmark(RecordCodec("packed"))),
+    }
+    print(f"{args.events} events per session")
+    print(f"{'path':<20}{'us/session':>12}{'sessions/s':>12}")
+    for name, ingest in paths.items():
+        started = time.process_time()
+        for body in bodies:
+            ingest(body)
+        elapsed = (time.process_time() - started) / len(bodies)
+        print(f"{name:<20}{elapsed * 1e6:>12.1f}{1 / elapsed:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
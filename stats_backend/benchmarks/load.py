@@ -0,0 +1,231 @@
+# Load generator: posts synthetic sessions to /collect/ (or /collect/batch/)
+# and times the /aggr queries as the dataset grows. Runs the app in process
+# through the Flask test client, with the storage picked by --storage, or
+# against a running server (e.g. matsoogo) with --url, whose storage is
+# whatever it was started with.
+#
+#   python benchmarks/load.py --sessions 20000 --checkpoints 1000,5000,20000
+#   python benchmarks/load.py --storage redis --redis localhost:6379
+#   APP_STORAGE=memory matsoogo --workers 4 &
+#   python benchmarks/load.py --url http://localhost:5000 --concurrency 8
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+ORIGINS = (
+    "bucket{}.s3.amazonaws.com",
+    "d{}abcdef8.cloudfront.net",
+    "edge{}.example.net",
+)
+DEVICES = ("pixel", "ios", "desktop-chrome", "desktop-firefox", "tv", "tablet")
+QUERIES = (
+    "/aggr/playable-latency/0/",
+    "/aggr/playable-latency/0,1,2/",
+    "/aggr/playback-duration/2/",
+    "/aggr/event/playing/0,1/",
+    "/aggr/playable-latency-quantiles/0/?q=0.5,0.99",
+)
+
+
+class Generator:
+    # sessions spread uniformly over origins x devices x videos, the groups
+    # the rollups are kept for, with num_events events and a stall or two
+    def __init__(self, num_events, origins, devices, videos, seed):
+        self.random = random.Random(seed)
+        self.num_events = num_events
+        self.hosts = [ORIGINS[i % len(ORIGINS)].format(i) for i in range(origins)]
+        self.devices = [
+            f"{DEVICES[i % len(DEVICES)]}-{i // len(DEVICES)}" for i in range(devices)
+        ]
+        self.videos = [f"video{i}.mp4" for i in range(videos)]
+        self.started = int(time.time() * 1000)
+        self.count = 0
+
+    def session(self) -> dict:
+        rand, self.count = self.random, self.count + 1
+        now, events = 0.0, []
+        for evt in ("loadstart", "loadedmetadata", "loadeddata", "canplay", "play"):
+            now += rand.uniform(1, 50)
+            events.append([now, evt])
+        events.append([now + rand.uniform(1, 2000), "playing"])
+        while len(events) < self.num_events - 1:
+            now += rand.uniform(100, 1000)
+            events.append([now, rand.choice(("timeupdate", "waiting", "playing"))])
+        events.append([now + 100, "ended"])
+        return {
+            "id": f"{self.count:08x}{rand.getrandbits(32):08x}",
+            "timestamp": self.started - rand.randrange(86400 * 1000),
+            "target": f"https://{rand.choice(self.hosts)}/v/{rand.choice(self.videos)}",
+            "duration": rand.uniform(10, 600),
+            "events": events,
+            "device_tag": rand.choice(self.devices),
+            "playbackquality": {
+                "samples": 1,
+                "creationTimes": [now],
+                "droppedVideoFrames": [rand.randint(0, 5)],
+                "totalVideoFrames": [int(now / 33)],
+            },
+        }
+
+
+class InProcessTarget:
+    def __init__(self):
+        from omnimatsoo.app import create_app
+
+        app = create_app()
+        app.logger.disabled = True
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, body: bytes = None) -> int:
+        return self.client.open(path, method=method, data=body).status_code
+
+
+class HTTPTarget:
+    # one keep-alive connection per thread
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.local = threading.local()
+
+    def request(self, method: str, path: str, body: bytes = None) -> int:
+        if (conn := getattr(self.local, "conn", None)) is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port)
+        try:
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            self.local.conn = None
+            raise
+        response.read()
+        return response.status
+
+
+def timed_request(target, method: str, path: str, body: bytes = None) -> float:
+    started = time.perf_counter()
+    if (status := target.request(method, path, body)) >= 400:
+        raise RuntimeError(f"{method} {path}: {status}")
+    return time.perf_counter() - started
+
+
+def percentile(latencies: list, q: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def ingest(target, generator, num_sessions, batch_size, concurrency) -> dict:
+    if batch_size:
+        path = "/collect/batch/"
+        bodies = [
+            "\n".join(
+                json.dumps(generator.session())
+                for _ in range(min(batch_size, num_sessions - start))
+            ).encode("utf-8")
+            for start in range(0, num_sessions, batch_size)
+        ]
+    else:
+        path = "/collect/"
+        bodies = [
+            json.dumps(generator.session()).encode("utf-8") for _ in range(num_sessions)
+        ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(
+            pool.map(lambda body: timed_request(target, "POST", path, body), bodies)
+        )
+    elapsed = time.perf_counter() - started
+    return {
+        "requests_per_s": len(bodies) / elapsed,
+        "sessions_per_s": num_sessions / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1e3,
+        "p99_ms": percentile(latencies, 0.99) * 1e3,
+    }
+
+
+def query(target, path: str, repeat: int) -> dict:
+    # the first request may be answered from the result cache of an earlier
+    # checkpoint, the rest likely are unless it is disabled
+    latencies = [timed_request(target, "GET", path) for _ in range(repeat)]
+    return {
+        "first_ms": latencies[0] * 1e3,
+        "p50_ms": statistics.median(latencies) * 1e3,
+        "p99_ms": percentile(latencies, 0.99) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="server to load, in process when unset")
+    parser.add_argument(
+        "--storage", choices=("memory", "local", "redis"), default="memory"
+    )
+    parser.add_argument("--redis", default="localhost:6379", help="host:port")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument(
+        "--checkpoints",
+        help="comma separated dataset sizes to time the queries at, "
+        "defaults to every tenth of --sessions",
+    )
+    parser.add_argument("--batch", type=int, default=0, help="sessions per request")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--events", type=int, default=40)
+    parser.add_argument("--origins", type=int, default=3)
+    parser.add_argument("--devices", type=int, default=6)
+    parser.add_argument("--videos", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query")
+    parser.add_argument("--no-result-cache", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.url:
+        target = HTTPTarget(args.url)
+    else:
+        host, _, port = args.redis.rpartition(":")
+        os.environ.setdefault("APP_STORAGE", args.storage)
+        os.environ.setdefault("APP_REDIS_HOST", host)
+        os.environ.setdefault("APP_REDIS_PORT", port)
+        if args.no_result_cache:
+            os.environ["APP_RESULT_CACHE_SIZE"] = "0"
+        target = InProcessTarget()
+    generator = Generator(
+        args.events, args.origins, args.devices, args.videos, args.seed
+    )
+    if args.checkpoints:
+        checkpoints = sorted(map(int, args.checkpoints.split(",")))
+    else:
+        checkpoints = [args.sessions * i // 10 for i in range(1, 11)]
+
+    results, done = [], 0
+    print(f"{'sessions':>9}  {'path':<48}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for checkpoint in checkpoints:
+        if checkpoint > done:
+            stats = ingest(
+                target, generator, checkpoint - done, args.batch, args.concurrency
+            )
+            done = checkpoint
+            results.append({"sessions": done, "path": "ingest", **stats})
+            print(
+                f"{done:>9}  {'ingest':<48}{stats['requests_per_s']:>9.0f}"
+                f"{stats['p50_ms']:>9.2f}{stats['p99_ms']:>9.2f}"
+            )
+        for path in QUERIES:
+            stats = query(target, path, args.repeat)
+            results.append({"sessions": done, "path": path, **stats})
+            print(
+                f"{done:>9}  {path:<48}{'':>9}"
+                f"{stats['p50_ms']:>9.2f}{stats['p99_ms']:>9.2f}"
+            )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Prefix lookups of MemoryBackend through its sorted key index against the
+# former linear startswith scan over every stored key.
+#
+#   python benchmarks/memory_prefix.py --sessions 200000
+import argparse
+import time
+
+from omnimatsoo.kvstorage import MemoryBackend, WriteBatch
+
+
+def linear_scan(storage: dict, prefix: str) -> dict:
+    return {k: v for k, v in storage.items() if k.startswith(prefix)}
+
+
+def fill(backend: MemoryBackend, num_sessions: int):
+    for i in range(num_sessions):
+        group = f"{('S3', 'CloudFront', 'Edge')[i % 3]}:device{i % 7}:video{i % 11}"
+        backend.write(
+            WriteBatch(
+                sets={f"ORGE:{group}:{i:08d}": "{}"},
+                deltas={
+                    f"AGGRTPLAYABLE_C:{group}": 1.0,
+                    f"AGGRTPLAYABLE_S:{group}": 12.5,
+                    f"AGGRHIST:playing:{group}": 1.0,
+                },
+            )
+        )
+
+
+def timed(func, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    backend = MemoryBackend()
+    started = time.perf_counter()
+    fill(backend, args.sessions)
+    elapsed = time.perf_counter() - started
+    print(
+        f"{len(backend._storage)} keys, "
+        f"{args.sessions / elapsed:,.0f} sessions/s written with the index"
+    )
+
+    print(f"{'prefix':<32}{'matches':>10}{'indexed ms':>14}{'scan ms':>12}")
+    for prefix in (
+        "AGGRTPLAYABLE_C:",
+        "AGGRTPLAYABLE_C:S3:device3:",
+        "AGGRHIST:playing:",
+        "ORGE:Edge:device1:video5:",
+    ):
+        matches = len(backend.get_items(prefix))
+        indexed = timed(lambda: backend.get_items(prefix), args.repeat)
+        scan = timed(lambda: linear_scan(backend._storage, prefix), args.repeat)
+        print(f"{prefix:<32}{matches:>10}{indexed * 1e3:>14.3f}{scan * 1e3:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Bytes per session and encode/decode throughput of the raw record codecs,
+# against the former serialize_dataclass JSON. Formats and compressions whose
+# optional dependency isn't installed are skipped.
+#
+#   python benchmarks/record_codec.py --sessions 20000 --samples 60
+import argparse
+import json
+import random
+import time
+
+from omnimatsoo.codec import COMPRESSIONS, FORMATS, RecordCodec
+from omnimatsoo.entities import PlaybackStatistics
+from omnimatsoo.utils import serialize_dataclass
+
+
+def session(i: int, num_samples: int) -> dict:
+    # roughly what the test client posts: a burst of startup events, periodic
+    # progress around stalls, and one quality sample per poll
+    now, events = 0.0, []
+    for evt in ("loadstart", "durationchange", "loadedmetadata", "loadeddata"):
+        now += random.uniform(1, 50)
+        events.append([now, evt])
+    for evt in ("canplay", "play", "playing", "canplaythrough"):
+        now += random.uniform(1, 10)
+        events.append([now, evt])
+    for _ in range(random.randint(0, 8)):
+        for evt in ("waiting", "stalled", "playing"):
+            now += random.uniform(100, 3000)
+            events.append([now, evt])
+    events.append([now + 10000, "ended"])
+    frames = [random.randint(0, 5) for _ in range(num_samples)]
+    return {
+        "id": f"{random.getrandbits(32):08x}",
+        "timestamp": 1700000000000 + i,
+        "target": f"https://d111111abcdef8.cloudfront.net/video/{i % 50}/short.mp4",
+        "duration": random.uniform(10, 600),
+        "events": events,
+        "device_tag": random.choice(("pixel", "ios", "desktop-chrome")),
+        "playbackquality": {
+            "samples": num_samples,
+            "creationTimes": [k * 1000.0 + random.random() for k in range(num_samples)],
+            "droppedVideoFrames": frames,
+            "totalVideoFrames": [k * 30 for k in range(num_samples)],
+        },
+    }
+
+
+def timed(func, items: list) -> tuple[float, list]:
+    started = time.perf_counter()
+    results = [func(item) for item in items]
+    return len(items) / (time.perf_counter() - started), results
+
+
+def report(name: str, size: float, encode_rate: float, decode_rate: float):
+    print(f"{name:<20}{size:>15.0f}{encode_rate:>12,.0f}{decode_rate:>12,.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=30)
+    args = parser.parse_args()
+
+    stats = [
+        PlaybackStatistics(**session(i, args.samples)) for i in range(args.sessions)
+    ]
+    print(f"{'codec':<20}{'bytes/session':>15}{'encode/s':>12}{'decode/s':>12}")
+    encode_rate, records = timed(serialize_dataclass, stats)
+    decode_rate, _ = timed(json.loads, records)
+    size = sum(len(r) for r in records) / len(records)
+    report("serialize_dataclass", size, encode_rate, decode_rate)
+
+    for format in FORMATS:
+        for compression in COMPRESSIONS:
+            try:
+                codec = RecordCodec(format, compression)
+            except ValueError as ex:
+                print(f"{format}+{compression}: skipped, {ex}")
+                continue
+            encode_rate, records = timed(codec.encode, stats)
+            decode_rate, _ = timed(codec.decode, records)
+            size = sum(len(r) for r in records) / len(records)
+            report(f"{format}+{compression}", size, encode_rate, decode_rate)
+
+
+if __name__ == "__main__":
+    main()
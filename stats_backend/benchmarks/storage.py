@@ -0,0 +1,132 @@
+# set, mupdate, batched write and prefix read latency of the storage backends:
+# memory, local (append-only log with snapshots, with and without fsync) and,
+# with --redis, a Redis server. For local, also the time to reopen the
+# directory, i.e. to recover from a crash, and the throughput of --processes
+# workers writing to it at once.
+#
+#   python benchmarks/storage.py --keys 20000
+#   python benchmarks/storage.py --redis localhost:6379 --processes 4
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from omnimatsoo.kvstorage import LocalBackend, MemoryBackend, RedisBackend, WriteBatch
+
+OPS = ("set", "mupdate", "write", "prefix")
+GROUPS = [
+    f"{origin}:device{d}:video{v}"
+    for origin in ("S3", "CloudFront", "Edge")
+    for d in range(7)
+    for v in range(11)
+]
+
+
+def batch(ns: str, i: int) -> WriteBatch:
+    group = GROUPS[i % len(GROUPS)]
+    return WriteBatch(
+        sets={f"{ns}ORGE:{group}:{i:08d}": b"r" * 200},
+        deltas={
+            f"{ns}AGGRTPLAYABLE_C:{group}": 1.0,
+            f"{ns}AGGRTPLAYABLE_S:{group}": 12.5,
+        },
+        hdeltas={f"{ns}AGGRIDX:AGGRTPLAYABLE_C:0": {group.split(":")[0]: 1.0}},
+    )
+
+
+def timed(func, num: int) -> float:
+    # microseconds per call
+    started = time.perf_counter()
+    for i in range(num):
+        func(i)
+    return (time.perf_counter() - started) / num * 1e6
+
+
+def run(backend, ns: str, num_keys: int, repeat: int) -> dict:
+    # every key starts with ns, so that they can be removed from a shared Redis
+    prefix = f"{ns}ORGE:{GROUPS[0]}:"
+    results = {
+        "set": timed(lambda i: backend.set(f"{ns}SET:{i:08d}", b"v" * 200), num_keys),
+        "mupdate": timed(
+            lambda i: backend.mupdate(
+                {f"{ns}CNT:{i % 1000}": 1.0, f"{ns}CNT:total": 1.0}
+            ),
+            num_keys,
+        ),
+        "write": timed(lambda i: backend.write(batch(ns, i)), num_keys),
+        "prefix": timed(lambda i: backend.get_items(prefix), repeat),
+    }
+    backend.delete([*backend.iter_keys(ns), *dict(backend.iter_hashes(ns))])
+    return results
+
+
+def write_worker(directory: str, start: int, num: int):
+    backend = LocalBackend(directory)
+    for i in range(start, start + num):
+        backend.write(batch("", i))
+    backend.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=10000, help="calls per operation")
+    parser.add_argument("--repeat", type=int, default=50, help="prefix reads")
+    parser.add_argument("--redis", help="host:port of a Redis to include")
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="matsoo-local-")
+    backends = {
+        "memory": lambda: MemoryBackend(),
+        "local": lambda: LocalBackend(os.path.join(directory, "nosync")),
+        "local+fsync": lambda: LocalBackend(
+            os.path.join(directory, "fsync"), fsync=True
+        ),
+    }
+    if args.redis:
+        host, _, port = args.redis.rpartition(":")
+        backends["redis"] = lambda: RedisBackend(host=host, port=int(port))
+
+    try:
+        print(f"{'backend':<14}" + "".join(f"{op + ' us':>14}" for op in OPS))
+        for name, create in backends.items():
+            backend = create()
+            results = run(backend, f"BENCH{os.getpid()}:", args.keys, args.repeat)
+            print(f"{name:<14}" + "".join(f"{results[op]:>14.1f}" for op in OPS))
+            backend.close()
+
+        path = os.path.join(directory, "nosync")
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        started = time.perf_counter()
+        LocalBackend(path).close()
+        print(
+            f"local reopened in {(time.perf_counter() - started) * 1e3:.1f} ms "
+            f"from {size / 2**20:.1f} MiB"
+        )
+
+        path = os.path.join(directory, "shared")
+        workers = [
+            multiprocessing.Process(
+                target=write_worker, args=(path, i * args.keys, args.keys)
+            )
+            for i in range(args.processes)
+        ]
+        LocalBackend(path).close()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        print(
+            f"local, {args.processes} processes: "
+            f"{args.processes * args.keys / elapsed:,.0f} writes/s"
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 from setuptools import setup, find_packages
 
-
 setup(
     name="omnimatsoo",
     version="0.1.0",
@@ -8,12 +7,20 @@ setup(
     package_dir={"": "src"},
     include_package_data=True,
     zip_safe=False,
-    extras_require={},
-    tests_require=["pytest"],
+    extras_require={
+        "msgpack": ["msgpack"],
+        "zstd": ["zstandard"],
+        "parquet": ["pyarrow"],
+    },
+    tests_require=["pytest", "fakeredis[lua]"],
     install_requires=["bokeh", "flask", "flask-cors", "redis"],
     entry_points={
         "console_scripts": [
             "matsoogo = omnimatsoo.wsgi:start",
+            "matsoo-rebuild-rollups = omnimatsoo.maintenance:rebuild_rollups",
+            "matsoo-compact-raw = omnimatsoo.maintenance:compact_raw",
+            "matsoo-reaggregate = omnimatsoo.maintenance:reaggregate",
+            "matsoo-export-raw = omnimatsoo.maintenance:export_raw",
         ]
     },
 )
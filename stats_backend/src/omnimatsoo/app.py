@@ -1,8 +1,18 @@
-import logging
-from flask import Flask
-from omnimatsoo.handlers import collect_blueprint, aggr_blueprint
+import os
+import time
+
+from flask import Flask, g, request
+from omnimatsoo.cache import ResultCache
+from omnimatsoo.codec import RecordCodec
+from omnimatsoo.handlers import collect_blueprint, aggr_blueprint, metrics_blueprint
 from omnimatsoo.kvstorage import SUPPORTED, Client
-from omnimatsoo.services import ServiceClients
+from omnimatsoo.metrics import REGISTRY, REQUEST_SECONDS, Profiler, component_counters
+from omnimatsoo.services import (
+    DEFAULT_ORIGIN_RULES,
+    OriginRules,
+    ServiceClients,
+    routing_tag,
+)
 
 
 def create_app():
@@ -10,11 +20,156 @@ def create_app():
     app.url_map.strict_slashes = True
     app.register_blueprint(collect_blueprint)
     app.register_blueprint(aggr_blueprint)
+    app.register_blueprint(metrics_blueprint)
     config_logger(app.logger)
-    Client.init(SUPPORTED.REDIS)
-    ServiceClients.init_services()
+    init_clients()
+    init_metrics(app)
     return app
 
 
+def init_clients():
+    # stage and storage timings on /metrics, on unless APP_METRICS is 0
+    REGISTRY.enabled = os.environ.get("APP_METRICS", "1") != "0"
+    write_behind = None
+    # seconds between flushes of buffered counter updates, unset to disable
+    if flush_interval := float(os.environ.get("APP_WRITE_BEHIND_INTERVAL") or 0):
+        write_behind = {
+            "flush_interval": flush_interval,
+            "max_keys": int(os.environ.get("APP_WRITE_BEHIND_MAX_KEYS") or 10000),
+        }
+    # redis, memory for a single process without persistence, or local for the
+    # processes of a single host persisting to APP_LOCAL_DIR
+    storage_type = SUPPORTED(os.environ.get("APP_STORAGE") or "redis")
+    storage_kwargs = {}
+    if storage_type == SUPPORTED.LOCAL:
+        # log size in MiB after which the state is snapshotted
+        snapshot_mb = int(os.environ.get("APP_LOCAL_SNAPSHOT_MB") or 64)
+        storage_kwargs = {
+            "directory": os.environ.get("APP_LOCAL_DIR") or "data",
+            # fsync every write, otherwise only snapshots are
+            "fsync": os.environ.get("APP_LOCAL_FSYNC", "0") != "0",
+            "snapshot_bytes": snapshot_mb * 1024 * 1024,
+        }
+    if storage_type == SUPPORTED.REDIS:
+        storage_kwargs = {
+            "host": os.environ.get("APP_REDIS_HOST") or "redis",
+            "port": int(os.environ.get("APP_REDIS_PORT") or 6379),
+            # path of the unix socket of a co-located Redis, replaces host:port
+            "unix_socket_path": os.environ.get("APP_REDIS_SOCKET") or None,
+        }
+    # comma separated "host:port" shards, keys are routed by their group
+    if shards := os.environ.get("APP_REDIS_SHARDS"):
+        storage_type = SUPPORTED.SHARDED
+        storage_kwargs = {"shards": shards.split(","), "tag": routing_tag}
+    Client.init(
+        storage_type,
+        transactions=os.environ.get("APP_REDIS_TRANSACTIONS", "lua"),
+        # what contains() is answered from: none (EXISTS), set, prefix or bloom
+        membership=os.environ.get("APP_REDIS_MEMBERSHIP") or "none",
+        bloom_capacity=int(os.environ.get("APP_REDIS_BLOOM_CAPACITY") or 10_000_000),
+        bloom_error_rate=float(os.environ.get("APP_REDIS_BLOOM_ERROR_RATE") or 0.001),
+        # connection pool of each Redis, 0 connections for an unbounded pool;
+        # timeouts in seconds
+        max_connections=int(os.environ.get("APP_REDIS_MAX_CONNECTIONS") or 64),
+        pool_timeout=float(os.environ.get("APP_REDIS_POOL_TIMEOUT") or 10),
+        socket_timeout=float(os.environ.get("APP_REDIS_SOCKET_TIMEOUT") or 10),
+        socket_connect_timeout=float(os.environ.get("APP_REDIS_CONNECT_TIMEOUT") or 5),
+        socket_keepalive=os.environ.get("APP_REDIS_KEEPALIVE", "1") != "0",
+        health_check_interval=int(os.environ.get("APP_REDIS_HEALTH_CHECK") or 30),
+        write_behind=write_behind,
+        instrument=REGISTRY.enabled,
+        **storage_kwargs,
+    )
+    # raw records: json (the former layout), packed or msgpack; none, zlib or
+    # zstd compression
+    record_codec = RecordCodec(
+        format=os.environ.get("APP_RECORD_FORMAT") or "packed",
+        compression=os.environ.get("APP_RECORD_COMPRESSION") or "none",
+    )
+    # ordered netloc suffix rules for the origin tag of a target,
+    # e.g. "s3.amazonaws.com=S3,cloudfront.net=CloudFront,*=Edge"
+    origin_rules = DEFAULT_ORIGIN_RULES
+    if spec := os.environ.get("APP_ORIGIN_RULES"):
+        origin_rules = OriginRules.parse(spec)
+    # /aggr results are cached until written to, and for at most
+    # APP_RESULT_CACHE_TTL seconds; a size of 0 disables the cache
+    result_cache = None
+    if cache_size := int(os.environ.get("APP_RESULT_CACHE_SIZE") or 1024):
+        result_cache = ResultCache(
+            max_entries=cache_size,
+            ttl=float(os.environ.get("APP_RESULT_CACHE_TTL") or 5.0),
+        )
+    # seconds before raw records expire, unset to keep them
+    raw_ttl = int(os.environ.get("APP_RAW_RECORD_TTL") or 0) or None
+    # raw records of sessions older than APP_RAW_RETENTION seconds are folded
+    # into archived rollups and deleted every APP_COMPACTION_INTERVAL seconds,
+    # dumped to gzip files in APP_ARCHIVE_DIR if set; by one process only, the
+    # first of the pre-forked workers
+    retention = float(os.environ.get("APP_RAW_RETENTION") or 0)
+    if raw_ttl and retention and raw_ttl <= retention:
+        # records would expire before compaction archives them
+        raise ValueError("APP_RAW_RECORD_TTL must be longer than APP_RAW_RETENTION")
+    ServiceClients.init_services(
+        record_codec=record_codec,
+        result_cache=result_cache,
+        origin_rules=origin_rules,
+        key_cache_size=int(os.environ.get("APP_KEY_CACHE_SIZE") or 4096),
+        raw_ttl=raw_ttl,
+    )
+    if retention:
+        ServiceClients.init_compactor(
+            older_than=retention,
+            interval=float(os.environ.get("APP_COMPACTION_INTERVAL") or 3600),
+            archive_dir=os.environ.get("APP_ARCHIVE_DIR") or None,
+            background=(os.environ.get("APP_WORKER_ID") or "0") == "0",
+        )
+
+
+def init_metrics(app: Flask):
+    REGISTRY.add_collector("components", component_counters(metered_components))
+    # cProfile dumps of a sample (APP_PROFILE_SAMPLE) of the requests whose
+    # path matches the APP_PROFILE_ROUTE regex, written to APP_PROFILE_DIR
+    profiler = None
+    if route := os.environ.get("APP_PROFILE_ROUTE"):
+        profiler = Profiler(
+            route,
+            sample=float(os.environ.get("APP_PROFILE_SAMPLE") or 0.01),
+            directory=os.environ.get("APP_PROFILE_DIR") or "profiles",
+        )
+
+    @app.before_request
+    def start_request():
+        g.started = time.perf_counter()
+        g.profile = profiler.start(request.path) if profiler else None
+
+    @app.after_request
+    def finish_request(response):
+        if profiler:
+            profiler.stop(g.pop("profile", None), request.path)
+        if REGISTRY.enabled and "started" in g:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - g.started,
+                handler=request.endpoint or "unmatched",
+                method=request.method,
+                status=response.status_code,
+            )
+        return response
+
+
+def metered_components() -> dict:
+    # the storage and its wrappers and shards, the result cache and compactor
+    components = {}
+    storage = Client.get()
+    while storage is not None:
+        components[type(storage).__name__] = storage
+        for i, shard in enumerate(getattr(storage, "shards", ())):
+            components[f"{type(shard).__name__}[{i}]"] = shard
+        storage = getattr(storage, "storage", None)
+    if service := ServiceClients.playback_benchmark:
+        components["ResultCache"] = service.result_cache
+    components["Compactor"] = ServiceClients.compactor
+    return components
+
+
 def config_logger(logger):
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(os.environ.get("APP_LOG_LEVEL") or "INFO")
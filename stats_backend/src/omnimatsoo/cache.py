@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable, Optional
+
+
+@dataclass
+class CachedResult:
+    etag: str
+    value: Any
+
+
+class ResultCache:
+    # size-bounded LRU of query results; an entry is only returned while the
+    # version it was computed at is still current and its ttl hasn't passed,
+    # the ttl bounds staleness for writes that don't bump versions
+    def __init__(self, max_entries: int = 1024, ttl: float = 5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: tuple) -> Optional[CachedResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != version or entry[0] < time.monotonic():
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[2]
+
+    def put(self, key: Hashable, version: tuple, result: CachedResult):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,290 @@
+import json
+import struct
+import sys
+import zlib
+from array import array
+from typing import Union
+
+from omnimatsoo.entities import EVENT_TYPES, PlaybackStatistics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# records start with a version byte, the format in the low nibble and the
+# compression in the high one; legacy records are bare JSON objects and start
+# with "{" (0x7b), which is never assigned
+COMPRESSIONS = {"none": 0x00, "zlib": 0x10, "zstd": 0x20}
+LEGACY_JSON = ord("{")
+
+
+def _fields(stats: PlaybackStatistics) -> dict:
+    # the same structure as dataclasses.asdict, without its deep copies
+    quality = stats.playbackquality
+    return {
+        "id": stats.id,
+        "timestamp": stats.timestamp,
+        "target": stats.target,
+        "duration": stats.duration,
+        "events": stats.events.to_dicts(),
+        "device_tag": stats.device_tag,
+        "playbackquality": {
+            "samples": quality.samples,
+            "creationTimes": quality.creationTimes,
+            "droppedVideoFrames": quality.droppedVideoFrames,
+            "totalVideoFrames": quality.totalVideoFrames,
+        },
+    }
+
+
+def _le_bytes(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _le_array(typecode: str, data: memoryview) -> list:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
+
+
+class JSONFormat:
+    ID = 0x00
+
+    def pack(self, stats: PlaybackStatistics) -> bytes:
+        return json.dumps(_fields(stats), separators=(",", ":")).encode("utf-8")
+
+    def unpack(self, data: memoryview) -> dict:
+        return json.loads(bytes(data))
+
+
+class PackedFormat:
+    # fixed-width header, then the strings, the event columns and the quality
+    # samples as little-endian arrays; event types outside EVENT_TYPES are
+    # appended to the record and referenced past it
+    ID = 0x01
+    HEADER = struct.Struct("<qdqIIIIHIHH")
+
+    def pack(self, stats: PlaybackStatistics) -> bytes:
+        quality, events = stats.playbackquality, stats.events
+        extra_types = events.types[len(EVENT_TYPES) :]
+        strings = [
+            s.encode("utf-8")
+            for s in (stats.id, stats.target, stats.device_tag, *extra_types)
+        ]
+        header = self.HEADER.pack(
+            stats.timestamp,
+            stats.duration,
+            quality.samples,
+            len(events),
+            len(quality.creationTimes),
+            len(quality.droppedVideoFrames),
+            len(quality.totalVideoFrames),
+            len(strings[0]),
+            len(strings[1]),
+            len(strings[2]),
+            len(extra_types),
+        )
+        return b"".join(
+            (
+                header,
+                *strings[:3],
+                *(struct.pack("<H", len(s)) + s for s in strings[3:]),
+                _le_bytes(events.timestamps),
+                _le_bytes(events.codes),
+                _le_bytes(array("d", quality.creationTimes)),
+                _le_bytes(array("q", quality.droppedVideoFrames)),
+                _le_bytes(array("q", quality.totalVideoFrames)),
+            )
+        )
+
+    def unpack(self, data: memoryview) -> dict:
+        (
+            timestamp,
+            duration,
+            samples,
+            num_events,
+            num_creation_times,
+            num_dropped,
+            num_total,
+            *lengths,
+            num_extra_types,
+        ) = self.HEADER.unpack_from(data)
+        pos = self.HEADER.size
+        strings = []
+        for length in lengths:
+            strings.append(str(data[pos : pos + length], "utf-8"))
+            pos += length
+        event_types = list(EVENT_TYPES)
+        for _ in range(num_extra_types):
+            (length,) = struct.unpack_from("<H", data, pos)
+            event_types.append(str(data[pos + 2 : pos + 2 + length], "utf-8"))
+            pos += 2 + length
+
+        def take(typecode: str, count: int) -> list:
+            nonlocal pos
+            end = pos + count * array(typecode).itemsize
+            values = _le_array(typecode, data[pos:end])
+            pos = end
+            return values
+
+        timestamps = take("d", num_events)
+        codes = take("H", num_events)
+        return {
+            "id": strings[0],
+            "timestamp": timestamp,
+            "target": strings[1],
+            "duration": duration,
+            "events": [
+                {"timestamp": t, "type": event_types[c]}
+                for t, c in zip(timestamps, codes)
+            ],
+            "device_tag": strings[2],
+            "playbackquality": {
+                "samples": samples,
+                "creationTimes": take("d", num_creation_times),
+                "droppedVideoFrames": take("q", num_dropped),
+                "totalVideoFrames": take("q", num_total),
+            },
+        }
+
+
+class MsgpackFormat:
+    # positional msgpack array, event types interned like PackedFormat but
+    # unknown ones kept inline as strings
+    ID = 0x02
+
+    def pack(self, stats: PlaybackStatistics) -> bytes:
+        quality, events = stats.playbackquality, stats.events
+        return msgpack.packb(
+            [
+                stats.id,
+                stats.timestamp,
+                stats.target,
+                stats.duration,
+                events.timestamps.tolist(),
+                [
+                    code if code < len(EVENT_TYPES) else events.types[code]
+                    for code in events.codes
+                ],
+                stats.device_tag,
+                quality.samples,
+                quality.creationTimes,
+                quality.droppedVideoFrames,
+                quality.totalVideoFrames,
+            ]
+        )
+
+    def unpack(self, data: memoryview) -> dict:
+        (
+            id,
+            timestamp,
+            target,
+            duration,
+            timestamps,
+            codes,
+            device_tag,
+            samples,
+            creation_times,
+            dropped,
+            total,
+        ) = msgpack.unpackb(data)
+        return {
+            "id": id,
+            "timestamp": timestamp,
+            "target": target,
+            "duration": duration,
+            "events": [
+                {"timestamp": t, "type": EVENT_TYPES[c] if isinstance(c, int) else c}
+                for t, c in zip(timestamps, codes)
+            ],
+            "device_tag": device_tag,
+            "playbackquality": {
+                "samples": samples,
+                "creationTimes": creation_times,
+                "droppedVideoFrames": dropped,
+                "totalVideoFrames": total,
+            },
+        }
+
+
+FORMATS = {"json": JSONFormat(), "packed": PackedFormat(), "msgpack": MsgpackFormat()}
+
+
+class RecordCodec:
+    # encodes raw playback records with the configured format and compression;
+    # decoding dispatches on the version byte, so records written with any
+    # other configuration, including legacy JSON, stay readable
+    def __init__(self, format: str = "packed", compression: str = "none", level=None):
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported record format: {format}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported record compression: {compression}")
+        if format == "msgpack" and msgpack is None:
+            raise ValueError("The msgpack record format requires msgpack")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("The zstd record compression requires zstandard")
+        self.format = FORMATS[format]
+        self.compression = compression
+        self.level = level
+        self._fallback_version = bytes((JSONFormat.ID | COMPRESSIONS[compression],))
+        self._version = bytes((self.format.ID | COMPRESSIONS[compression],))
+
+    def encode(self, stats: PlaybackStatistics) -> bytes:
+        if self.compression == "none" and isinstance(self.format, JSONFormat):
+            return JSONFormat().pack(stats)
+        try:
+            version, data = self._version, self.format.pack(stats)
+        except (TypeError, OverflowError, struct.error):
+            # values the binary layouts can't hold, e.g. a float frame count
+            version, data = self._fallback_version, JSONFormat().pack(stats)
+        return version + self._compress(data)
+
+    def decode(self, record: Union[str, bytes]) -> dict:
+        if isinstance(record, str):
+            return json.loads(record)
+        version = record[0]
+        if version == LEGACY_JSON:
+            return json.loads(record)
+        data = self._decompress(version & 0xF0, memoryview(record)[1:])
+        for format in FORMATS.values():
+            if format.ID == version & 0x0F:
+                return format.unpack(data)
+        raise ValueError(f"Unknown record version: {version:#04x}")
+
+    def to_json(self, record: Union[str, bytes]) -> str:
+        # the legacy JSON text of a record, for dumps of the raw data
+        if isinstance(record, str):
+            return record
+        if record[:1] == b"{":
+            return record.decode("utf-8")
+        return json.dumps(self.decode(record), separators=(",", ":"))
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "zlib":
+            return zlib.compress(data, -1 if self.level is None else self.level)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(level=self.level or 3).compress(data)
+        return data
+
+    def _decompress(self, compression: int, data: memoryview):
+        if compression == COMPRESSIONS["zlib"]:
+            return memoryview(zlib.decompress(data))
+        if compression == COMPRESSIONS["zstd"]:
+            if zstandard is None:
+                raise ValueError("Reading zstd compressed records requires zstandard")
+            return memoryview(zstandard.ZstdDecompressor().decompress(data))
+        if compression:
+            raise ValueError(f"Unknown record compression: {compression:#04x}")
+        return data
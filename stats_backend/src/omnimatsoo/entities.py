@@ -1,10 +1,40 @@
+from array import array
+from collections import Counter
 from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+# media events listened to by the test client, interned to their position
+EVENT_TYPES = (
+    "abort",
+    "canplay",
+    "canplaythrough",
+    "durationchange",
+    "complete",
+    "emptied",
+    "ended",
+    "error",
+    "loadeddata",
+    "loadedmetadata",
+    "loadstart",
+    "pause",
+    "play",
+    "playing",
+    "ratechange",
+    "suspend",
+    "seeked",
+    "seeking",
+    "stalled",
+    "volumechange",
+    "waiting",
+)
+EVENT_CODES = {name: code for code, name in enumerate(EVENT_TYPES)}
 
 
 @dataclass
 class DomEvent:
     # see MediaEvents@ https://github.com/matsoo5g/omnimatsoo/blob/main/test_client/js/benchmarkcontroller.js
     # ref: https://html.spec.whatwg.org/multipage/media.html
+    __slots__ = ("timestamp", "type")
     timestamp: float
     type: str
 
@@ -13,10 +43,81 @@ class DomEvent:
         return cls(*event)
 
 
+class EventColumns:
+    # the media events of a session as columns: timestamps, and type codes
+    # indexing types, which is EVENT_TYPES followed by any other type the
+    # session reported
+    __slots__ = ("timestamps", "codes", "types")
+
+    def __init__(
+        self, timestamps: array = None, codes: array = None, types: tuple = EVENT_TYPES
+    ):
+        self.timestamps = array("d") if timestamps is None else timestamps
+        self.codes = array("H") if codes is None else codes
+        self.types = types
+
+    @classmethod
+    def parse(cls, events: list) -> "EventColumns":
+        # accepts [timestamp, type] pairs as sent by the client and
+        # {"timestamp", "type"} objects as stored by the former layout
+        columns, extra_types = cls(), {}
+        append_timestamp, append_code = columns.timestamps.append, columns.codes.append
+        for evt in events:
+            if isinstance(evt, dict):
+                timestamp, name = evt["timestamp"], evt["type"]
+            else:
+                timestamp, name = evt
+            if not isinstance(name, str):
+                raise TypeError(f"Event type must be a string: {name!r}")
+            append_timestamp(timestamp)
+            if (code := EVENT_CODES.get(name)) is None:
+                code = extra_types.setdefault(name, len(EVENT_TYPES) + len(extra_types))
+            append_code(code)
+        if extra_types:
+            columns.types = EVENT_TYPES + tuple(extra_types)
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __iter__(self) -> Iterator[DomEvent]:
+        types = self.types
+        for timestamp, code in zip(self.timestamps, self.codes):
+            yield DomEvent(timestamp, types[code])
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, EventColumns):
+            return NotImplemented
+        return self.timestamps == other.timestamps and self.names() == other.names()
+
+    def names(self) -> list[str]:
+        return list(map(self.types.__getitem__, self.codes))
+
+    def counts(self) -> dict[str, int]:
+        return {self.types[code]: n for code, n in Counter(self.codes).items()}
+
+    def first_timestamps(self, names: Iterable[str]) -> dict[str, float]:
+        # the first non-zero timestamp of each of names, 0 if there is none
+        ret = dict.fromkeys(names, 0)
+        wanted = {self.types.index(n): n for n in ret if n in self.types}
+        for timestamp, code in zip(self.timestamps, self.codes):
+            if code in wanted and timestamp and not ret[wanted[code]]:
+                ret[wanted[code]] = timestamp
+        return ret
+
+    def to_dicts(self) -> list[dict]:
+        types = self.types
+        return [
+            {"timestamp": timestamp, "type": types[code]}
+            for timestamp, code in zip(self.timestamps, self.codes)
+        ]
+
+
 @dataclass
 class PlaybackQualitySample:
     # https://developer.mozilla.org/en-US/docs/Web/API/VideoPlaybackQuality
     # the measured data doesn't make sense at all, unused.
+    __slots__ = ("samples", "creationTimes", "droppedVideoFrames", "totalVideoFrames")
     samples: int
     creationTimes: list[float]
     droppedVideoFrames: list[int]
@@ -25,17 +126,26 @@ class PlaybackQualitySample:
 
 @dataclass
 class PlaybackStatistics:
+    __slots__ = (
+        "id",
+        "timestamp",
+        "target",
+        "duration",
+        "events",
+        "device_tag",
+        "playbackquality",
+    )
     id: str
     timestamp: int
     target: str
     duration: float
-    events: list[DomEvent]
+    events: EventColumns
     device_tag: str
     playbackquality: PlaybackQualitySample
 
     def __post_init__(self):
-        self.playbackquality = PlaybackQualitySample(**self.playbackquality)
-        for i, e in enumerate(self.events):
-            self.events[i] = (
-                DomEvent(**e) if isinstance(e, dict) else DomEvent.from_tuple(e)
-            )
+        # events are kept as columns rather than one DomEvent per event
+        if not isinstance(self.playbackquality, PlaybackQualitySample):
+            self.playbackquality = PlaybackQualitySample(**self.playbackquality)
+        if not isinstance(self.events, EventColumns):
+            self.events = EventColumns.parse(self.events)
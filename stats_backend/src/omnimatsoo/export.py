@@ -0,0 +1,53 @@
+import csv
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class CSVWriter:
+    # a header row, then the rows; missing values are empty fields
+    def __init__(self, path: str, columns: tuple[tuple[str, str], ...]):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(name for name, _ in columns)
+
+    def write(self, rows: list[tuple]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    # one row group per write, columns typed by their arrow type name
+    def __init__(self, path: str, columns: tuple[tuple[str, str], ...]):
+        if pyarrow is None:
+            raise ValueError("The parquet export format requires pyarrow")
+        self._schema = pyarrow.schema(
+            [(name, pyarrow.type_for_alias(type)) for name, type in columns]
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def write(self, rows: list[tuple]):
+        if not rows:
+            return
+        arrays = [
+            pyarrow.array(column, field.type)
+            for column, field in zip(zip(*rows), self._schema)
+        ]
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {"csv": CSVWriter, "parquet": ParquetWriter}
+
+
+def open_writer(path: str, format: str, columns: tuple[tuple[str, str], ...]):
+    if format not in WRITERS:
+        raise ValueError(f"Unsupported export format: {format}")
+    return WRITERS[format](path, columns)
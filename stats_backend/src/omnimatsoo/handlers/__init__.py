@@ -3,8 +3,10 @@ from flask_cors import CORS
 
 collect_blueprint = Blueprint("collect", __name__, url_prefix="/collect")
 aggr_blueprint = Blueprint("aggr", __name__, url_prefix="/aggr")
+metrics_blueprint = Blueprint("metrics", __name__)
 CORS(collect_blueprint)
 CORS(aggr_blueprint)
 
 import omnimatsoo.handlers.collect
 import omnimatsoo.handlers.aggr
+import omnimatsoo.handlers.metrics
@@ -1,23 +1,68 @@
-from flask import jsonify, Response
+import json
+import math
+import time
+from functools import partial
+from typing import Optional
 
+from flask import jsonify, request, Response
+
+from omnimatsoo.cache import CachedResult
 from omnimatsoo.handlers import aggr_blueprint
 from omnimatsoo.services import ServiceClients as SVC
 
 
 @aggr_blueprint.route("/", methods=["GET"])
 def get_types():
-    return Response("/all/, /playable-latency/<nodes>/, /playback-duration/<nodes>, /event/<event-name>/<nodes>/")
+    return Response(
+        "/all/[?cursor=&limit=][&format=ndjson] (ndjson: a page and a cursor line "
+        "on the wsgi server, all records on the native server), "
+        "/playable-latency/<nodes>/[?from=&to=&step=], "
+        "/playback-duration/<nodes>/[?from=&to=&step=], "
+        "/event/<event-name>/<nodes>/[?from=&to=&step=], "
+        "/playable-latency-quantiles/<nodes>/[?q=0.5,0.95,0.99], "
+        "/playback-duration-quantiles/<nodes>/[?q=0.5,0.95,0.99]"
+    )
+
+
+DEFAULT_QUANTILES = "0.5,0.95,0.99"
+DEFAULT_SERIES_STEP = 3600
+DEFAULT_SERIES_SPAN = 86400
+DEFAULT_PAGE_LIMIT = 1000
+MAX_PAGE_LIMIT = 10000
 
 
 @aggr_blueprint.route("/all/", methods=["GET"])
 def get_all():
+    # ?cursor=&limit= pages through the records, without either the whole
+    # keyspace is returned at once. ?format=ndjson returns one record per line;
+    # Tornado's WSGIContainer buffers a whole response before sending it, so
+    # here that is one page of records followed by a {"cursor": ...} line
+    # while more remain. Only the native server (--server native) streams all
+    # the records in one response with memory bounded by a page
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        cursor = request.args.get("cursor") or None
+        if request.args.get("format") == "ndjson":
+            return Response(
+                ndjson_page(cursor, limit), content_type="application/x-ndjson"
+            )
+        if "cursor" in request.args or "limit" in request.args:
+            cursor, items = SVC.playback_benchmark.list_page(cursor, limit)
+            return jsonify({"items": items, "cursor": cursor})
+    except ValueError as ex:
+        return Response(
+            response=f'bad request: "{ex}"',
+            status=400,
+            content_type="application/json",
+        )
     return jsonify(SVC.playback_benchmark.list_all())
 
 
 @aggr_blueprint.route("/event/<event>/<nodes>/", methods=["GET"])
 def get_num_events(event, nodes):
-    return _get_node_aggr(
+    return _get_timed_node_aggr(
         handler=SVC.playback_benchmark.group_by_nodes_num_events,
+        series_handler=SVC.playback_benchmark.series_by_nodes_num_events,
         event_name=event,
         nodes=nodes,
     )
@@ -25,20 +70,72 @@ def get_num_events(event, nodes):
 
 @aggr_blueprint.route("/playable-latency/<nodes>/", methods=["GET"])
 def get_playablelatency(nodes):
-    return _get_node_aggr(
+    return _get_timed_node_aggr(
         handler=SVC.playback_benchmark.group_by_nodes_playable,
+        series_handler=SVC.playback_benchmark.series_by_nodes_playable,
+        nodes=nodes,
+    )
+
+
+@aggr_blueprint.route("/playable-latency-quantiles/<nodes>/", methods=["GET"])
+def get_playablelatency_quantiles(nodes):
+    return _get_quantile_aggr(
+        handler=SVC.playback_benchmark.group_by_nodes_playable_quantiles,
+        nodes=nodes,
+    )
+
+
+@aggr_blueprint.route("/playback-duration-quantiles/<nodes>/", methods=["GET"])
+def get_playbackduration_quantiles(nodes):
+    return _get_quantile_aggr(
+        handler=SVC.playback_benchmark.group_by_nodes_playback_duration_quantiles,
         nodes=nodes,
     )
 
 
 @aggr_blueprint.route("/playback-duration/<nodes>/", methods=["GET"])
 def get_playbackduration(nodes):
-    return _get_node_aggr(
+    return _get_timed_node_aggr(
         handler=SVC.playback_benchmark.group_by_nodes_playback_duration,
+        series_handler=SVC.playback_benchmark.series_by_nodes_playback_duration,
         nodes=nodes,
     )
 
 
+def _get_quantile_aggr(handler, **kwargs):
+    q = request.args.get("q") or DEFAULT_QUANTILES
+    try:
+        kwargs["quantiles"] = parse_quantiles(q)
+    except ValueError:
+        return Response(
+            response=f'wrong quantiles format: "{q}"',
+            status=400,
+            content_type="application/json",
+        )
+    return _get_node_aggr(handler, **kwargs)
+
+
+def _get_timed_node_aggr(handler, series_handler, **kwargs):
+    # ?from=&to=&step= (epoch seconds) returns per-step time series instead of
+    # the all-time totals
+    try:
+        time_range = parse_time_range(request.args)
+    except ValueError:
+        return Response(
+            response=f'wrong time range format: "{request.query_string.decode()}"',
+            status=400,
+            content_type="application/json",
+        )
+    if time_range is None:
+        # totals are served from the result cache, with an etag
+        cached_handler = partial(
+            SVC.playback_benchmark.cached_aggregation, handler.__name__
+        )
+        return _get_node_aggr(cached_handler, **kwargs)
+    start, end, step = time_range
+    return _get_node_aggr(series_handler, start=start, end=end, step=step, **kwargs)
+
+
 def _get_node_aggr(handler, **kwargs):
     if "nodes" not in kwargs:
         return Response(
@@ -47,8 +144,10 @@ def _get_node_aggr(handler, **kwargs):
             content_type="application/json",
         )
     nodes = kwargs["nodes"]
-    pnodes = nodes.split(",")
-    if not pnodes or not len(pnodes := list(map(int, filter(None, pnodes)))):
+    try:
+        if not (pnodes := parse_nodes(nodes)):
+            raise ValueError(nodes)
+    except ValueError:
         return Response(
             response=f'wrong parameter format: "{nodes}"',
             status=400,
@@ -56,11 +155,70 @@ def _get_node_aggr(handler, **kwargs):
         )
     kwargs["nodes"] = pnodes
     try:
-        ret = jsonify(handler(**kwargs))
+        result = handler(**kwargs)
     except IndexError:
         return Response(
             response=f'bad node numbers specified: "{nodes}"',
             status=400,
             content_type="application/json",
         )
+    except ValueError as ex:
+        return Response(
+            response=f'bad request: "{ex}"',
+            status=400,
+            content_type="application/json",
+        )
+    if not isinstance(result, CachedResult):
+        return jsonify(result)
+    if request.if_none_match.contains(result.etag):
+        return Response(status=304, headers={"ETag": f'"{result.etag}"'})
+    ret = jsonify(result.value)
+    ret.set_etag(result.etag)
     return ret
+
+
+def parse_nodes(nodes: str) -> list[int]:
+    return list(map(int, filter(None, nodes.split(","))))
+
+
+def parse_quantiles(quantiles: str) -> list[float]:
+    if not (parsed := list(map(float, filter(None, quantiles.split(","))))):
+        raise ValueError(quantiles)
+    if any(not 0 <= q <= 1 for q in parsed):
+        raise ValueError(quantiles)
+    return parsed
+
+
+def parse_time_range(args) -> Optional[tuple[int, int, int]]:
+    if not any(args.get(k) for k in ("from", "to", "step")):
+        return None
+    step = int(args.get("step") or DEFAULT_SERIES_STEP)
+    end = parse_timestamp(args.get("to") or time.time())
+    start = parse_timestamp(args.get("from") or end - DEFAULT_SERIES_SPAN)
+    if step <= 0 or start >= end:
+        raise ValueError(args)
+    return start, end, step
+
+
+def parse_limit(limit: str) -> int:
+    if not limit:
+        return DEFAULT_PAGE_LIMIT
+    if not 0 < (limit := int(limit)) <= MAX_PAGE_LIMIT:
+        raise ValueError(f"limit must be within 1..{MAX_PAGE_LIMIT}")
+    return limit
+
+
+def ndjson_page(cursor: Optional[str], limit: int) -> str:
+    cursor, items = SVC.playback_benchmark.list_page(cursor, limit)
+    lines = [{"key": k, "value": v} for k, v in items.items()]
+    if cursor is not None:
+        lines.append({"cursor": cursor})
+    return "".join(json.dumps(line, separators=(",", ":")) + "\n" for line in lines)
+
+
+def parse_timestamp(value) -> int:
+    # epoch seconds, fractions are dropped; inf and nan are rejected like any
+    # other malformed value
+    if not math.isfinite(timestamp := float(value)):
+        raise ValueError(value)
+    return int(timestamp)
@@ -1,19 +1,101 @@
+import json
+import logging
+
 from flask import request, jsonify, Response, current_app
 
 from omnimatsoo.handlers import collect_blueprint
 from omnimatsoo.entities import PlaybackStatistics
+from omnimatsoo.metrics import stage
 from omnimatsoo.services import ServiceClients as SVC
 
+MAX_BATCH_ITEMS = 10000
+
 
 @collect_blueprint.route("/", methods=["POST"])
 def _():
-    result = request.get_json(force=True)
-    current_app.logger.debug(f"Received: {result}")
+    with stage("parse"):
+        result = request.get_json(force=True)
+    if current_app.logger.isEnabledFor(logging.DEBUG):
+        current_app.logger.debug(f"Received: {result}")
     try:
-        SVC.playback_benchmark.add(PlaybackStatistics(**result))
+        with stage("build"):
+            playback_statistics = PlaybackStatistics(**result)
+        SVC.playback_benchmark.add(playback_statistics)
     except Exception as ex:
         current_app.logger.error(f"Unable to process received payload: {ex}")
         return Response(
             response="bad payload", status=400, content_type="application/json"
         )
     return jsonify("")
+
+
+@collect_blueprint.route("/batch/", methods=["POST"])
+def collect_batch():
+    try:
+        with stage("parse"):
+            payloads = parse_batch(request.get_data())
+    except ValueError as ex:
+        current_app.logger.error(f"Unable to parse received batch: {ex}")
+        return Response(
+            response="bad payload", status=400, content_type="application/json"
+        )
+    if len(payloads) > MAX_BATCH_ITEMS:
+        return Response(
+            response=f'too many items: "{len(payloads)}" > "{MAX_BATCH_ITEMS}"',
+            status=413,
+            content_type="application/json",
+        )
+    current_app.logger.debug(f"Received batch of {len(payloads)} items")
+    try:
+        return jsonify(add_batch(payloads))
+    except Exception as ex:
+        current_app.logger.error(f"Unable to store received batch: {ex}")
+        return Response(
+            response="storage failure", status=500, content_type="application/json"
+        )
+
+
+def add_batch(payloads: list) -> dict:
+    errors, accepted, positions = [None] * len(payloads), [], []
+    with stage("build"):
+        for i, payload in enumerate(payloads):
+            try:
+                if isinstance(payload, Exception):
+                    raise payload
+                accepted.append(PlaybackStatistics(**payload))
+                positions.append(i)
+            except Exception as ex:
+                errors[i] = str(ex) or type(ex).__name__
+    for i, error in zip(positions, SVC.playback_benchmark.add_many(accepted)):
+        errors[i] = error
+
+    results = [
+        (
+            {"status": "accepted"}
+            if error is None
+            else {"status": "rejected", "error": error}
+        )
+        for error in errors
+    ]
+    num_rejected = sum(error is not None for error in errors)
+    return {
+        "accepted": len(errors) - num_rejected,
+        "rejected": num_rejected,
+        "results": results,
+    }
+
+
+def parse_batch(data: bytes) -> list:
+    # either a JSON array, or NDJSON where a malformed line only rejects itself
+    data = data.strip()
+    if data.startswith(b"["):
+        return json.loads(data)
+    payloads = []
+    for line in data.splitlines():
+        if not (line := line.strip()):
+            continue
+        try:
+            payloads.append(json.loads(line))
+        except ValueError as ex:
+            payloads.append(ex)
+    return payloads
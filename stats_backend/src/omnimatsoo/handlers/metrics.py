@@ -0,0 +1,9 @@
+from flask import Response
+
+from omnimatsoo.handlers import metrics_blueprint
+from omnimatsoo.metrics import REGISTRY
+
+
+@metrics_blueprint.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(REGISTRY.render(), content_type="text/plain; version=0.0.4")
@@ -1,14 +1,68 @@
+import atexit
+import errno
+import fcntl
+import logging
+import math
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
 from abc import abstractmethod, ABC
-
+from binascii import crc_hqx
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Any, Optional, Union
+from hashlib import sha1
+from itertools import islice
+from typing import Any, Callable, Iterator, Optional, Union
+
+from redis import (
+    BlockingConnectionPool,
+    ConnectionPool,
+    Redis,
+    UnixDomainSocketConnection,
+    WatchError,
+)
+
+from omnimatsoo.metrics import STORAGE_BYTES, STORAGE_SECONDS
 
-from redis import Redis, WatchError
+logger = logging.getLogger(__name__)
 
 
 class SUPPORTED(Enum):
     MEMORY: str = "memory"
+    LOCAL: str = "local"
     REDIS: str = "redis"
+    SHARDED: str = "sharded"
+
+
+@dataclass
+class WriteBatch:
+    # plain values to set, counter deltas and hash field deltas to apply in a
+    # single round-trip, ttls (seconds) expire any of those keys
+    sets: dict[Union[str, bytes], Union[str, bytes]] = field(default_factory=dict)
+    deltas: dict[Union[str, bytes], float] = field(default_factory=dict)
+    hdeltas: dict[Union[str, bytes], dict[str, float]] = field(default_factory=dict)
+    ttls: dict[Union[str, bytes], int] = field(default_factory=dict)
+
+    def merge(self, other: "WriteBatch") -> "WriteBatch":
+        self.sets.update(other.sets)
+        for id, delta in other.deltas.items():
+            self.deltas[id] = self.deltas.get(id, 0.0) + delta
+        for id, fields in other.hdeltas.items():
+            target = self.hdeltas.setdefault(id, {})
+            for f, delta in fields.items():
+                target[f] = target.get(f, 0.0) + delta
+        for id, ttl in other.ttls.items():
+            self.ttls[id] = max(ttl, self.ttls.get(id, 0))
+        return self
+
+    def __bool__(self) -> bool:
+        return bool(self.sets or self.deltas or self.hdeltas)
 
 
 class Storage(ABC):
@@ -30,6 +84,62 @@ class Storage(ABC):
     ) -> dict[Union[str, bytes], Union[str, bytes]]:
         pass
 
+    @abstractmethod
+    def iter_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[Union[str, bytes]]:
+        pass
+
+    @abstractmethod
+    def iter_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], Union[str, bytes]]]:
+        # fetched batch_size keys at a time, keys removed meanwhile are skipped
+        pass
+
+    @abstractmethod
+    def scan_items(
+        self,
+        id_prefix_range: Optional[Union[str, bytes]] = "",
+        cursor: Optional[str] = None,
+        count: int = 1000,
+    ) -> tuple[Optional[str], dict[Union[str, bytes], Union[str, bytes]]]:
+        # one page of roughly count examined keys, next cursor is None when done
+        pass
+
+    @abstractmethod
+    def get_hash(self, id: Union[str, bytes]) -> dict[Union[str, bytes], float]:
+        pass
+
+    @abstractmethod
+    def iter_hashes(
+        self, id_prefix_range: Union[str, bytes], batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], dict[Union[str, bytes], float]]]:
+        pass
+
+    @abstractmethod
+    def get_hashes(
+        self, ids: list[Union[str, bytes]]
+    ) -> list[dict[Union[str, bytes], float]]:
+        pass
+
+    @abstractmethod
+    def replace_hashes(
+        self,
+        id_prefix_range: Union[str, bytes],
+        mapping: dict[Union[str, bytes], dict[str, float]],
+    ) -> bool:
+        pass
+
+    @abstractmethod
+    def group_hashes(
+        self, ids: list[Union[str, bytes]], nodes: Optional[list[int]] = None
+    ) -> dict[Union[str, bytes], list[float]]:
+        # sums of the fields of ids per group, one per hash; with nodes a field
+        # "a:b:c|x" belongs to the group of its nodes at those positions joined
+        # by ":", followed by its "|x" suffix if any, e.g. [2, 0] -> "c:a|x"
+        pass
+
     @abstractmethod
     def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
         pass
@@ -42,34 +152,219 @@ class Storage(ABC):
     def contains(self, id: Union[str, bytes]) -> bool:
         pass
 
+    @abstractmethod
+    def delete(self, ids: list[Union[str, bytes]]) -> dict[Union[str, bytes], int]:
+        # the ids that existed, with the bytes their value took (0 for hashes)
+        pass
+
+    @abstractmethod
+    def swap_namespace(self, staging: str, prefixes: tuple[str, ...]) -> int:
+        # deletes the keys under prefixes and renames every key under staging
+        # to its name without staging, at once; the number of keys renamed
+        pass
+
     @abstractmethod
     def mupdate(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
         pass
 
+    @abstractmethod
+    def write(self, batch: WriteBatch) -> bool:
+        pass
+
+    def close(self):
+        pass
+
+
+def _prefix_end(prefix: Union[str, bytes]) -> Optional[Union[str, bytes]]:
+    # smallest key above every key starting with prefix, None when unbounded
+    while prefix:
+        last = prefix[-1]
+        if isinstance(prefix, bytes):
+            if last < 0xFF:
+                return prefix[:-1] + bytes((last + 1,))
+        elif ord(last) < 0x10FFFF:
+            return prefix[:-1] + chr(ord(last) + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def _group_field(field: Union[str, bytes], nodes: list[int]) -> Union[str, bytes]:
+    sep, bar = (b":", b"|") if isinstance(field, bytes) else (":", "|")
+    head, found, suffix = field.rpartition(bar)
+    if not found:
+        head, suffix = suffix, suffix[:0]
+    field_nodes = head.split(sep)
+    # positions past the nodes of the field are empty, as in GROUP_SCRIPT
+    picked = (field_nodes[i] if i < len(field_nodes) else sep[:0] for i in nodes)
+    return sep.join(picked) + found + suffix
+
+
+class SortedKeys:
+    # Keys kept sorted in blocks of at most 2 * LOAD keys (the layout of
+    # sortedcontainers.SortedList), so an insert only shifts one block and a
+    # range lookup is a bisect over block maxima plus slices.
+    LOAD = 1000
+
+    def __init__(self):
+        self._blocks = []
+        self._maxes = []
+
+    def __len__(self) -> int:
+        return sum(map(len, self._blocks))
+
+    def add(self, key: Union[str, bytes]):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._blocks[i].append(key)
+            self._maxes[i] = key
+        else:
+            insort(self._blocks[i], key)
+        if len(block := self._blocks[i]) > 2 * self.LOAD:
+            self._blocks[i : i + 1] = [block[: self.LOAD], block[self.LOAD :]]
+            self._maxes[i : i + 1] = [block[self.LOAD - 1], block[-1]]
+
+    def discard(self, key: Union[str, bytes]):
+        if (i := bisect_left(self._maxes, key)) == len(self._maxes):
+            return
+        block = self._blocks[i]
+        if (j := bisect_left(block, key)) < len(block) and block[j] == key:
+            del block[j]
+            if block:
+                self._maxes[i] = block[-1]
+            else:
+                del self._blocks[i], self._maxes[i]
+
+    def irange(
+        self, start: Union[str, bytes], stop: Optional[Union[str, bytes]] = None
+    ) -> Iterator[Union[str, bytes]]:
+        # keys with start <= key < stop
+        i = bisect_left(self._maxes, start)
+        for block in self._blocks[i:]:
+            lo = bisect_left(block, start) if block[0] < start else 0
+            if stop is None or block[-1] < stop:
+                yield from block[lo:]
+                continue
+            yield from block[lo : bisect_left(block, stop)]
+            return
+
+    def iprefix(self, prefix: Union[str, bytes]) -> Iterator[Union[str, bytes]]:
+        return self.irange(prefix, _prefix_end(prefix))
+
 
 class MemoryBackend(Storage):
     TYPE = SUPPORTED.MEMORY
 
     def __init__(self, **kwargs):
         self._storage = {}
+        self._hashes = {}
+        # expiry deadlines (time.time()) of keys written with a ttl
+        self._expiry = {}
+        self._num_writes = 0
+        # ordered view of the keys of _storage for prefix range lookups
+        self._keys = SortedKeys()
+        # read-modify-write of counters must not interleave between threads
+        self._lock = threading.RLock()
 
     def get_keys(
         self, id_prefix_range: Optional[Union[str, bytes]] = ""
     ) -> list[Union[str, bytes]]:
-        return [k for k in self._storage.keys() if k.startswith(id_prefix_range)]
+        with self._lock:
+            return self._live(list(self._keys.iprefix(id_prefix_range)))
 
     def get_values(
         self, id_prefix_range: Optional[Union[str, bytes]] = ""
     ) -> list[Union[str, bytes]]:
-        return [v for k, v in self._storage.items() if k.startswith(id_prefix_range)]
+        with self._lock:
+            keys = self._live(list(self._keys.iprefix(id_prefix_range)))
+            return [self._storage[k] for k in keys]
 
     def get_items(
         self, id_prefix_range: Optional[Union[str, bytes]] = ""
     ) -> dict[Union[str, bytes], Union[str, bytes]]:
-        return {k: v for k, v in self._storage.items() if k.startswith(id_prefix_range)}
+        with self._lock:
+            keys = self._live(list(self._keys.iprefix(id_prefix_range)))
+            return {k: self._storage[k] for k in keys}
+
+    def iter_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[Union[str, bytes]]:
+        for _, items in self._iter_pages(id_prefix_range, batch_size):
+            yield from items
+
+    def iter_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], Union[str, bytes]]]:
+        for _, items in self._iter_pages(id_prefix_range, batch_size):
+            yield from items.items()
+
+    def scan_items(
+        self,
+        id_prefix_range: Optional[Union[str, bytes]] = "",
+        cursor: Optional[str] = None,
+        count: int = 1000,
+    ) -> tuple[Optional[str], dict[Union[str, bytes], Union[str, bytes]]]:
+        # the cursor is the first key of the next page
+        start = max(cursor or id_prefix_range, id_prefix_range)
+        with self._lock:
+            keys = list(
+                islice(
+                    self._keys.irange(start, _prefix_end(id_prefix_range)), count + 1
+                )
+            )
+            items = {k: self._storage[k] for k in self._live(keys[:count])}
+        return (keys[count] if len(keys) > count else None), items
+
+    def get_hash(self, id: Union[str, bytes]) -> dict[Union[str, bytes], float]:
+        with self._lock:
+            if self._is_expired(id, time.time()):
+                return {}
+            return dict(self._hashes.get(id, {}))
+
+    def get_hashes(
+        self, ids: list[Union[str, bytes]]
+    ) -> list[dict[Union[str, bytes], float]]:
+        return [self.get_hash(id) for id in ids]
+
+    def iter_hashes(
+        self, id_prefix_range: Union[str, bytes], batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], dict[Union[str, bytes], float]]]:
+        with self._lock:
+            ids = [k for k in self._hashes if k.startswith(id_prefix_range)]
+        for id in ids:
+            if fields := self.get_hash(id):
+                yield id, fields
+
+    def group_hashes(
+        self, ids: list[Union[str, bytes]], nodes: Optional[list[int]] = None
+    ) -> dict[Union[str, bytes], list[float]]:
+        groups = {}
+        for i, fields in enumerate(self.get_hashes(ids)):
+            for field, value in fields.items():
+                if nodes:
+                    field = _group_field(field, nodes)
+                groups.setdefault(field, [0.0] * len(ids))[i] += float(value)
+        return groups
+
+    def replace_hashes(
+        self,
+        id_prefix_range: Union[str, bytes],
+        mapping: dict[Union[str, bytes], dict[str, float]],
+    ) -> bool:
+        with self._lock:
+            for id in [k for k in self._hashes if k.startswith(id_prefix_range)]:
+                del self._hashes[id]
+                self._expiry.pop(id, None)
+            self._hashes.update((k, dict(v)) for k, v in mapping.items() if v)
+        return True
 
     def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
-        self._storage[id] = content
+        with self._lock:
+            self._put(id, content)
         return True
 
     def mset(
@@ -77,130 +372,1529 @@ class MemoryBackend(Storage):
     ) -> bool:
         if len(contents) != len(ids):
             return False
-        for id, content in zip(ids, contents):
-            self._storage[id] = content
+        with self._lock:
+            for id, content in zip(ids, contents):
+                self._put(id, content)
         return True
 
     def contains(self, id: Union[str, bytes]) -> bool:
-        return id in self._storage
+        with self._lock:
+            return id in self._storage and not self._is_expired(id, time.time())
+
+    def delete(self, ids: list[Union[str, bytes]]) -> dict[Union[str, bytes], int]:
+        deleted = {}
+        with self._lock:
+            for id in self._live(ids):
+                if id in self._storage:
+                    value = self._storage.pop(id)
+                    self._keys.discard(id)
+                    deleted[id] = len(value) if isinstance(value, (str, bytes)) else 8
+                if self._hashes.pop(id, None) is not None:
+                    deleted.setdefault(id, 0)
+                self._expiry.pop(id, None)
+        return deleted
+
+    def swap_namespace(self, staging: str, prefixes: tuple[str, ...]) -> int:
+        with self._lock:
+            for prefix in prefixes:
+                for id in list(self._keys.iprefix(prefix)):
+                    del self._storage[id]
+                    self._keys.discard(id)
+                    self._expiry.pop(id, None)
+            for id in [k for k in self._hashes if k.startswith(prefixes)]:
+                del self._hashes[id]
+                self._expiry.pop(id, None)
+            staged = self._live(list(self._keys.iprefix(staging)))
+            for id in staged:
+                self._put(id[len(staging) :], self._storage.pop(id))
+                self._keys.discard(id)
+            staged_hashes = self._live(
+                [k for k in self._hashes if k.startswith(staging)]
+            )
+            for id in staged_hashes:
+                self._hashes[id[len(staging) :]] = self._hashes.pop(id)
+            for id in (*staged, *staged_hashes):
+                if (deadline := self._expiry.pop(id, None)) is not None:
+                    self._expiry[id[len(staging) :]] = deadline
+        return len(staged) + len(staged_hashes)
 
     def mupdate(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
+        with self._lock:
+            return self._incr(mapping)
+
+    def write(self, batch: WriteBatch) -> bool:
+        with self._lock:
+            for id, content in batch.sets.items():
+                self._put(id, content)
+            self._incr(batch.deltas)
+            now = time.time()
+            for id, fields in batch.hdeltas.items():
+                # like HINCRBYFLOAT, an expired hash starts afresh
+                if self._expiry:
+                    self._is_expired(id, now)
+                target = self._hashes.setdefault(id, {})
+                for f, delta in fields.items():
+                    target[f] = float(target.get(f, 0.0) + delta)
+            for id, ttl in batch.ttls.items():
+                self._expiry[id] = now + ttl
+            self._num_writes += 1
+            if self._expiry and not self._num_writes % 1000:
+                for id in list(self._expiry):
+                    self._is_expired(id, now)
+        return True
+
+    def _is_expired(self, id: Union[str, bytes], now: float) -> bool:
+        if (deadline := self._expiry.get(id)) is None or deadline > now:
+            return False
+        del self._expiry[id]
+        self._hashes.pop(id, None)
+        if self._storage.pop(id, None) is not None:
+            self._keys.discard(id)
+        return True
+
+    def _incr(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
+        # like INCRBYFLOAT, the ttl of an incremented key is kept
         ret = []
         for id, delta in mapping.items():
-            self._storage[id] = (v := float(self._storage.get(id, 0.0) + delta))
+            if self._expiry:
+                self._is_expired(id, time.time())
+            self._put(id, v := float(self._storage.get(id, 0.0) + delta), True)
             ret.append(v)
         return ret
 
+    def _live(self, keys: list[Union[str, bytes]]) -> list[Union[str, bytes]]:
+        # drops, and removes, the keys whose ttl has passed
+        if not self._expiry:
+            return keys
+        now = time.time()
+        return [k for k in keys if not self._is_expired(k, now)]
+
+    def _put(
+        self,
+        id: Union[str, bytes],
+        content: Union[str, bytes, float],
+        keep_ttl: bool = False,
+    ):
+        # like SET, setting a value clears the ttl of the key
+        if id not in self._storage:
+            self._keys.add(id)
+        elif not keep_ttl:
+            self._expiry.pop(id, None)
+        self._storage[id] = content
+
+    def _iter_pages(
+        self, id_prefix_range: Union[str, bytes], batch_size: int
+    ) -> Iterator[tuple[Optional[str], dict]]:
+        cursor = None
+        while True:
+            cursor, items = self.scan_items(id_prefix_range, cursor, batch_size)
+            yield cursor, items
+            if cursor is None:
+                break
+
+
+class LocalBackend(MemoryBackend):
+    # MemoryBackend persisted to a directory, for a single host without Redis.
+    # Writes are appended to "log.<generation>" before they are applied, and
+    # once the log passes snapshot_bytes the state is pickled to "snapshot"
+    # and a new generation started, so a restart loads the snapshot and replays
+    # a bounded log. Processes sharing the directory each keep a copy and,
+    # under an flock of "lock", replay what the others appended before reading
+    # or writing, so increments stay exact across workers. The flock belongs to
+    # the open file, the backend is to be created after forking.
+    TYPE = SUPPORTED.LOCAL
+    # length and crc32 of the pickled record that follows
+    FRAME = struct.Struct("<II")
+
+    def __init__(
+        self,
+        directory="data",
+        fsync=False,
+        snapshot_bytes=64 * 1024 * 1024,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # appends are fsynced when set, otherwise they survive a crash of the
+        # process but not of the host; snapshots are always fsynced
+        self.fsync = fsync
+        self.snapshot_bytes = snapshot_bytes
+        self.counters = {
+            "appends": 0,
+            "replayed": 0,
+            "loads": 0,
+            "snapshots": 0,
+            "truncated_bytes": 0,
+        }
+        self._generation = 0
+        self._log_fd = None
+        self._offset = 0
+        self._file_lock = threading.Lock()
+        self._lock_fd = os.open(self._path("lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        with self._synced(exclusive=True):
+            pass
+
+    def get_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        self._refresh()
+        return super().get_keys(id_prefix_range)
+
+    def get_values(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        self._refresh()
+        return super().get_values(id_prefix_range)
+
+    def get_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> dict[Union[str, bytes], Union[str, bytes]]:
+        self._refresh()
+        return super().get_items(id_prefix_range)
+
+    def scan_items(
+        self,
+        id_prefix_range: Optional[Union[str, bytes]] = "",
+        cursor: Optional[str] = None,
+        count: int = 1000,
+    ) -> tuple[Optional[str], dict[Union[str, bytes], Union[str, bytes]]]:
+        self._refresh()
+        return super().scan_items(id_prefix_range, cursor, count)
+
+    def get_hash(self, id: Union[str, bytes]) -> dict[Union[str, bytes], float]:
+        self._refresh()
+        return super().get_hash(id)
+
+    def iter_hashes(
+        self, id_prefix_range: Union[str, bytes], batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], dict[Union[str, bytes], float]]]:
+        self._refresh()
+        return super().iter_hashes(id_prefix_range, batch_size)
+
+    def replace_hashes(
+        self,
+        id_prefix_range: Union[str, bytes],
+        mapping: dict[Union[str, bytes], dict[str, float]],
+    ) -> bool:
+        with self._synced(exclusive=True):
+            return self._commit(("replace", id_prefix_range, mapping))
+
+    def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
+        with self._synced(exclusive=True):
+            return self._commit(("mset", [id], [content]))
+
+    def mset(
+        self, ids: list[Union[str, bytes]], contents: list[Union[str, bytes]]
+    ) -> bool:
+        if len(contents) != len(ids):
+            return False
+        with self._synced(exclusive=True):
+            return self._commit(("mset", list(ids), list(contents)))
+
+    def contains(self, id: Union[str, bytes]) -> bool:
+        self._refresh()
+        return super().contains(id)
+
+    def delete(self, ids: list[Union[str, bytes]]) -> dict[Union[str, bytes], int]:
+        with self._synced(exclusive=True):
+            return self._commit(("delete", list(ids)))
+
+    def swap_namespace(self, staging: str, prefixes: tuple[str, ...]) -> int:
+        with self._synced(exclusive=True):
+            return self._commit(("swap", staging, tuple(prefixes)))
+
+    def mupdate(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
+        if not mapping:
+            return []
+        with self._synced(exclusive=True):
+            return self._commit(("incr", mapping))
+
+    def write(self, batch: WriteBatch) -> bool:
+        if not batch:
+            return True
+        # ttls are logged as deadlines so that a replay expires keys on time
+        now = time.time()
+        deadlines = {id: now + ttl for id, ttl in batch.ttls.items()}
+        with self._synced(exclusive=True):
+            return self._commit(
+                ("write", batch.sets, batch.deltas, batch.hdeltas, deadlines)
+            )
+
+    def snapshot(self):
+        with self._synced(exclusive=True):
+            self._snapshot()
+
+    def close(self):
+        with self._file_lock:
+            if self._log_fd is not None:
+                os.close(self._log_fd)
+                self._log_fd = None
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    @contextmanager
+    def _synced(self, exclusive: bool = False):
+        # threads of a process share the flock, _file_lock serializes them
+        with self._file_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._catch_up(exclusive)
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        with self._synced():
+            pass
+
+    def _catch_up(self, exclusive: bool):
+        # the log of the generation read last is gone once another process
+        # took a snapshot
+        try:
+            if self._log_fd is None:
+                raise FileNotFoundError
+            size = os.stat(self._path(f"log.{self._generation}")).st_size
+        except FileNotFoundError:
+            self._load(exclusive)
+            size = os.fstat(self._log_fd).st_size
+        if size > self._offset:
+            self._replay(size, exclusive)
+
+    def _load(self, exclusive: bool):
+        try:
+            with open(self._path("snapshot"), "rb") as f:
+                generation, storage, hashes, expiry, keys = pickle.load(f)
+        except FileNotFoundError:
+            generation, storage, hashes, expiry, keys = 0, {}, {}, {}, SortedKeys()
+        with self._lock:
+            self._storage, self._hashes, self._expiry = storage, hashes, expiry
+            self._keys = keys
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+        self._log_fd = os.open(
+            self._path(f"log.{generation}"),
+            os.O_RDWR | os.O_APPEND | os.O_CREAT,
+            0o644,
+        )
+        self._generation, self._offset = generation, 0
+        self.counters["loads"] += 1
+        if exclusive:
+            # leftovers of a snapshot interrupted by a crash
+            for name in os.listdir(self.directory):
+                if name == "snapshot.tmp" or (
+                    name.startswith("log.") and name != f"log.{generation}"
+                ):
+                    os.remove(self._path(name))
+
+    def _replay(self, size: int, exclusive: bool):
+        data = memoryview(os.pread(self._log_fd, size - self._offset, self._offset))
+        pos, header = 0, self.FRAME.size
+        while pos + header <= len(data):
+            length, crc = self.FRAME.unpack_from(data, pos)
+            end = pos + header + length
+            if end > len(data) or zlib.crc32(data[pos + header : end]) != crc:
+                break
+            self._apply(pickle.loads(data[pos + header : end]))
+            self.counters["replayed"] += 1
+            pos = end
+        self._offset += pos
+        if pos < len(data) and exclusive:
+            # a record torn by a writer that crashed mid-append, writers
+            # truncate it before appending theirs
+            logger.warning(
+                f"Truncating {len(data) - pos} bytes of a torn record from "
+                f"log.{self._generation}"
+            )
+            os.ftruncate(self._log_fd, self._offset)
+            self.counters["truncated_bytes"] += len(data) - pos
+
+    def _commit(self, record: tuple):
+        # appends the record, then applies it; called holding the flock
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        frame = self.FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        try:
+            if os.write(self._log_fd, frame) != len(frame):
+                raise OSError(errno.ENOSPC, "Short write to the log")
+            if self.fsync:
+                os.fsync(self._log_fd)
+        except OSError:
+            os.ftruncate(self._log_fd, self._offset)
+            raise
+        self._offset += len(frame)
+        self.counters["appends"] += 1
+        ret = self._apply(record)
+        if self._offset >= self.snapshot_bytes:
+            self._snapshot()
+        return ret
+
+    def _apply(self, record: tuple):
+        op, *args = record
+        with self._lock:
+            if op == "mset":
+                for id, content in zip(*args):
+                    self._put(id, content)
+                return True
+            if op == "incr":
+                return self._incr(*args)
+            if op == "write":
+                sets, deltas, hdeltas, deadlines = args
+                super().write(WriteBatch(sets=sets, deltas=deltas, hdeltas=hdeltas))
+                self._expiry.update(deadlines)
+                return True
+            if op == "replace":
+                return super().replace_hashes(*args)
+            if op == "delete":
+                return super().delete(*args)
+            if op == "swap":
+                return super().swap_namespace(*args)
+        raise ValueError(f"Unknown log record: {op}")
+
+    def _snapshot(self):
+        # called holding the flock exclusively
+        generation = self._generation + 1
+        with self._lock, open(self._path("snapshot.tmp"), "wb") as f:
+            state = (generation, self._storage, self._hashes, self._expiry, self._keys)
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._path("snapshot.tmp"), self._path("snapshot"))
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        log_fd = os.open(
+            self._path(f"log.{generation}"),
+            os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_TRUNC,
+            0o644,
+        )
+        os.close(self._log_fd)
+        os.remove(self._path(f"log.{self._generation}"))
+        self._log_fd, self._generation, self._offset = log_fd, generation, 0
+        self.counters["snapshots"] += 1
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+
+class NoMembership:
+    # nothing tracked, a key is a member while it exists
+    internal_keys = frozenset()
+
+    def updates(self, ids: list[Union[str, bytes]]) -> dict[str, tuple[str, list]]:
+        return {}
+
+    def contains(self, redis_client: Redis, id: Union[str, bytes]) -> bool:
+        return bool(redis_client.exists(id))
+
+
+class SetMembership:
+    # every key ever written in one set, exact but unbounded and a single key
+    # all writers touch
+    internal_keys = frozenset()
+
+    def __init__(self, key: str = "__MEMS__"):
+        self.key = key
+
+    def updates(self, ids: list[Union[str, bytes]]) -> dict[str, tuple[str, list]]:
+        return {self.key: ("set", ids)} if ids else {}
+
+    def contains(self, redis_client: Redis, id: Union[str, bytes]) -> bool:
+        return bool(redis_client.sismember(self.key, id))
+
+
+class PrefixSetMembership(SetMembership):
+    # one set per key prefix (up to the first ":"), e.g. "__MEMS__:ORGE:", so
+    # writers of different prefixes don't share a set and a prefix's set can
+    # be dropped on its own
+    def updates(self, ids: list[Union[str, bytes]]) -> dict[str, tuple[str, list]]:
+        sets = {}
+        for id in ids:
+            sets.setdefault(self._set_key(id), ("set", []))[1].append(id)
+        return sets
+
+    def contains(self, redis_client: Redis, id: Union[str, bytes]) -> bool:
+        return bool(redis_client.sismember(self._set_key(id), id))
+
+    def _set_key(self, id: Union[str, bytes]) -> str:
+        if isinstance(id, bytes):
+            id = id.decode("utf-8")
+        prefix, sep, _ = id.partition(":")
+        return f"{self.key}:{prefix}{sep}"
+
+
+class BloomMembership:
+    # Bloom filter in a Redis bitmap sized for capacity keys at error_rate
+    # false positives, memory stays bounded however many keys are written;
+    # bit positions are computed client side by double hashing a SHA-1
+    MAX_BITS = 2**32
+
+    def __init__(
+        self,
+        key: str = "__MEMS_BLOOM__",
+        capacity: int = 10_000_000,
+        error_rate: float = 0.001,
+    ):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError(f"Bad bloom filter sizing: {capacity}, {error_rate}")
+        self.key = key
+        # the bitmap is a string key, hidden from listings of the stored values
+        self.internal_keys = frozenset((key, key.encode("utf-8")))
+        self.num_bits = min(
+            math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2),
+            self.MAX_BITS,
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+
+    def updates(self, ids: list[Union[str, bytes]]) -> dict[str, tuple[str, list]]:
+        if not ids:
+            return {}
+        return {self.key: ("bits", [p for id in ids for p in self.positions(id)])}
+
+    def contains(self, redis_client: Redis, id: Union[str, bytes]) -> bool:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for p in self.positions(id):
+                pipe.getbit(self.key, p)
+            return all(pipe.execute())
+
+    def positions(self, id: Union[str, bytes]) -> list[int]:
+        digest = sha1(id.encode("utf-8") if isinstance(id, str) else id).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+MEMBERSHIPS = {
+    "none": NoMembership,
+    "set": SetMembership,
+    "prefix": PrefixSetMembership,
+    "bloom": BloomMembership,
+}
+
 
 class RedisBackend(Storage):
     TYPE = SUPPORTED.REDIS
-    MEMBER_SET_KEY = "__MEMS__"
+    # KEYS: keys to set, keys to increment, hashes to increment, keys to
+    # expire, membership keys
+    # ARGV: number of keys to set, to increment, of hashes and to expire, their
+    # values and increments, per hash the number of fields followed by
+    # field/increment, the ttl of each key to expire, then per membership key
+    # "set" or "bits", the number of items and the members or bits to add
+    WRITE_SCRIPT = """
+local unpack = table.unpack or unpack
+local nsets, ndeltas = tonumber(ARGV[1]), tonumber(ARGV[2])
+local nhashed = nsets + ndeltas + tonumber(ARGV[3])
+local nexpired = nhashed + tonumber(ARGV[4])
+local ret = {}
+for i = 1, nsets do
+    redis.call("SET", KEYS[i], ARGV[i + 4])
+end
+for i = nsets + 1, nsets + ndeltas do
+    ret[#ret + 1] = redis.call("INCRBYFLOAT", KEYS[i], ARGV[i + 4])
+end
+local a = nsets + ndeltas + 5
+for i = nsets + ndeltas + 1, nhashed do
+    for _ = 1, tonumber(ARGV[a]) do
+        redis.call("HINCRBYFLOAT", KEYS[i], ARGV[a + 1], ARGV[a + 2])
+        a = a + 2
+    end
+    a = a + 1
+end
+for i = nhashed + 1, nexpired do
+    redis.call("EXPIRE", KEYS[i], ARGV[a])
+    a = a + 1
+end
+for i = nexpired + 1, #KEYS do
+    local kind, n = ARGV[a], tonumber(ARGV[a + 1])
+    a = a + 2
+    if kind == "set" then
+        for j = a, a + n - 1, 1000 do
+            redis.call("SADD", KEYS[i], unpack(ARGV, j, math.min(j + 999, a + n - 1)))
+        end
+    else
+        for j = a, a + n - 1 do
+            redis.call("SETBIT", KEYS[i], ARGV[j], 1)
+        end
+    end
+    a = a + n
+end
+return ret
+"""
 
-    def __init__(self, host="redis", port=6379, **kwargs):
-        self.redis_client = Redis(host=host, port=port, **kwargs)
+    # KEYS: hashes to group, ARGV: 0-based node positions of the groups, if any
+    # returns {group, sum per hash...} rows, sums as strings since Redis
+    # truncates Lua numbers to integers
+    GROUP_SCRIPT = """
+local groups, order = {}, {}
+for i = 1, #KEYS do
+    local fields = redis.call("HGETALL", KEYS[i])
+    for j = 1, #fields, 2 do
+        local group = fields[j]
+        if #ARGV > 0 then
+            local head, suffix = string.match(group, "^(.*)(|[^|]*)$")
+            if not head then
+                head, suffix = group, ""
+            end
+            local nodes, start = {}, 1
+            while true do
+                local sep = string.find(head, ":", start, true)
+                if not sep then
+                    nodes[#nodes + 1] = string.sub(head, start)
+                    break
+                end
+                nodes[#nodes + 1] = string.sub(head, start, sep - 1)
+                start = sep + 1
+            end
+            local picked = {}
+            for n = 1, #ARGV do
+                picked[n] = nodes[tonumber(ARGV[n]) + 1] or ""
+            end
+            group = table.concat(picked, ":") .. suffix
+        end
+        local sums = groups[group]
+        if not sums then
+            sums = {}
+            for k = 1, #KEYS do
+                sums[k] = 0
+            end
+            groups[group] = sums
+            order[#order + 1] = group
+        end
+        sums[i] = sums[i] + tonumber(fields[j + 1])
+    end
+end
+local ret = {}
+for r, group in ipairs(order) do
+    local row = {group}
+    for k = 1, #KEYS do
+        row[k + 1] = string.format("%.17g", groups[group][k])
+    end
+    ret[r] = row
+end
+return ret
+"""
+
+    # KEYS: keys to delete
+    # returns the size of each that existed, -1 for the others
+    DELETE_SCRIPT = """
+local unpack = table.unpack or unpack
+local ret = {}
+for i, key in ipairs(KEYS) do
+    local kind = redis.call("TYPE", key)
+    kind = kind.ok or kind
+    if kind == "string" then
+        ret[i] = redis.call("STRLEN", key)
+    elseif kind == "none" then
+        ret[i] = -1
+    else
+        ret[i] = 0
+    end
+end
+if #KEYS > 0 then
+    redis.call("DEL", unpack(KEYS))
+end
+return ret
+"""
+
+    # ARGV: cursor, match pattern, count, then internal keys to leave out
+    # returns {next cursor, string keys, their values}, a page of keys and
+    # their values in one round-trip; internal keys, e.g. the bitmap of a
+    # bloom filter, are skipped before they are read
+    SCAN_SCRIPT = """
+local page = redis.call("SCAN", ARGV[1], "MATCH", ARGV[2], "COUNT", ARGV[3], "TYPE", "string")
+local internal = {}
+for i = 4, #ARGV do
+    internal[ARGV[i]] = true
+end
+local keys, values = {}, {}
+for _, key in ipairs(page[2]) do
+    if not internal[key] then
+        keys[#keys + 1] = key
+        values[#keys] = redis.call("GET", key)
+    end
+end
+return {page[1], keys, values}
+"""
+
+    # KEYS: keys to delete, then staged keys to rename
+    # ARGV: number of keys to delete, length of the staging prefix
+    # returns the number of keys renamed
+    SWAP_SCRIPT = """
+local ndeleted, skip = tonumber(ARGV[1]), tonumber(ARGV[2])
+for i = 1, ndeleted do
+    redis.call("DEL", KEYS[i])
+end
+local moved = 0
+for i = ndeleted + 1, #KEYS do
+    if redis.call("EXISTS", KEYS[i]) == 1 then
+        redis.call("RENAME", KEYS[i], string.sub(KEYS[i], skip + 1))
+        moved = moved + 1
+    end
+end
+return moved
+"""
+
+    def __init__(
+        self,
+        host="redis",
+        port=6379,
+        transactions="lua",
+        max_watch_retries=100,
+        membership="none",
+        bloom_capacity=10_000_000,
+        bloom_error_rate=0.001,
+        unix_socket_path=None,
+        max_connections=None,
+        pool_timeout=None,
+        socket_timeout=None,
+        socket_connect_timeout=None,
+        socket_keepalive=False,
+        health_check_interval=0,
+        scan_count=1000,
+        **kwargs,
+    ):
+        # one pool per backend shared by all threads; when max_connections are
+        # in use callers wait up to pool_timeout seconds for one to be released
+        # rather than failing, unix_socket_path connects to a co-located Redis
+        if unix_socket_path:
+            kwargs.update(
+                connection_class=UnixDomainSocketConnection, path=unix_socket_path
+            )
+        else:
+            kwargs.update(
+                host=host,
+                port=port,
+                socket_connect_timeout=socket_connect_timeout,
+                socket_keepalive=socket_keepalive,
+            )
+        kwargs.update(
+            socket_timeout=socket_timeout, health_check_interval=health_check_interval
+        )
+        if max_connections:
+            pool = BlockingConnectionPool(
+                max_connections=max_connections, timeout=pool_timeout, **kwargs
+            )
+        else:
+            pool = ConnectionPool(**kwargs)
+        self.redis_client = Redis(connection_pool=pool)
+        # keys per SCAN page of the prefix reads, each page is a round-trip
+        self.scan_count = scan_count
+        # what contains() answers from: "none" checks the key itself, "set" is
+        # the former global member set, "prefix" one set per key prefix and
+        # "bloom" a bounded Bloom filter
+        if membership not in MEMBERSHIPS:
+            raise ValueError(f"Unsupported membership tracking: {membership}")
+        if membership == "bloom":
+            self.membership = BloomMembership(
+                capacity=bloom_capacity, error_rate=bloom_error_rate
+            )
+        else:
+            self.membership = MEMBERSHIPS[membership]()
+        # "lua" applies writes atomically server side, "watch" is the former
+        # WATCH/MULTI/EXEC path
+        self.transactions = transactions
+        self.max_watch_retries = max_watch_retries
+        self.counters = {"script_calls": 0, "watch_retries": 0, "watch_aborts": 0}
+        self._write_script = self.redis_client.register_script(self.WRITE_SCRIPT)
+        self._group_script = self.redis_client.register_script(self.GROUP_SCRIPT)
+        self._delete_script = self.redis_client.register_script(self.DELETE_SCRIPT)
+        self._scan_script = self.redis_client.register_script(self.SCAN_SCRIPT)
+        self._swap_script = self.redis_client.register_script(self.SWAP_SCRIPT)
 
     def get_keys(
         self, id_prefix_range: Optional[Union[str, bytes]] = ""
     ) -> list[Union[str, bytes]]:
-        if self.redis_client.get(id_prefix_range):
-            return [id_prefix_range]
-        if not id_prefix_range or id_prefix_range[-1] != "*":
-            id_prefix_range += "*"
-        return [
-            found
-            for found in self.redis_client.scan_iter(
-                match=id_prefix_range, _type="STRING"
-            )
-        ]
+        return list(self.iter_keys(id_prefix_range, self.scan_count))
 
     def get_values(
         self, id_prefix_range: Union[str, bytes] = ""
     ) -> list[Union[str, bytes]]:
-        keys = self.get_keys(id_prefix_range)
-        if len(keys) == 1:
-            return self.redis_client.get(id_prefix_range)
-        return self.redis_client.mget(keys=keys)
+        return [v for _, v in self.iter_items(id_prefix_range, self.scan_count)]
 
     def get_items(
         self, id_prefix_range: Optional[Union[str, bytes]] = ""
     ) -> dict[Union[str, bytes], Union[str, bytes]]:
-        keys = self.get_keys(id_prefix_range)
-        if len(keys) == 1:
-            return {id_prefix_range: self.redis_client.get(id_prefix_range)}
-        return {k: v for k, v in zip(keys, self.redis_client.mget(keys=keys))}
+        return dict(self.iter_items(id_prefix_range, self.scan_count))
 
-    def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
-        keys = [self.MEMBER_SET_KEY, id]
-        self._pipe(
-            funcs=["set", "sadd"],
-            func_args=[((), {"name": id, "value": content}), ((keys), {})],
-            watch_parameters=keys,
+    def iter_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[Union[str, bytes]]:
+        internal_keys = self.membership.internal_keys
+        return (
+            key
+            for key in self.redis_client.scan_iter(
+                match=id_prefix_range + "*", count=batch_size, _type="STRING"
+            )
+            if key not in internal_keys
         )
+
+    def iter_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], Union[str, bytes]]]:
+        cursor = 0
+        while True:
+            cursor, items = self._scan_page(id_prefix_range, cursor, batch_size)
+            yield from items.items()
+            if not cursor:
+                return
+
+    def scan_items(
+        self,
+        id_prefix_range: Optional[Union[str, bytes]] = "",
+        cursor: Optional[str] = None,
+        count: int = 1000,
+    ) -> tuple[Optional[str], dict[Union[str, bytes], Union[str, bytes]]]:
+        next_cursor, items = self._scan_page(id_prefix_range, int(cursor or 0), count)
+        return (str(next_cursor) if next_cursor else None), items
+
+    def get_hash(self, id: Union[str, bytes]) -> dict[Union[str, bytes], float]:
+        return {k: float(v) for k, v in self.redis_client.hgetall(id).items()}
+
+    def get_hashes(
+        self, ids: list[Union[str, bytes]]
+    ) -> list[dict[Union[str, bytes], float]]:
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for id in ids:
+                pipe.hgetall(id)
+            return [
+                {k: float(v) for k, v in fields.items()} for fields in pipe.execute()
+            ]
+
+    def iter_hashes(
+        self, id_prefix_range: Union[str, bytes], batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], dict[Union[str, bytes], float]]]:
+        ids = self.redis_client.scan_iter(
+            match=id_prefix_range + "*", count=batch_size, _type="HASH"
+        )
+        while chunk := list(islice(ids, batch_size)):
+            for id, fields in zip(chunk, self.get_hashes(chunk)):
+                if fields:
+                    yield id, fields
+
+    def group_hashes(
+        self, ids: list[Union[str, bytes]], nodes: Optional[list[int]] = None
+    ) -> dict[Union[str, bytes], list[float]]:
+        # grouped server side, only one row per group is transferred
+        rows = self._group_script(keys=ids, args=nodes or [])
+        return {group: [float(v) for v in sums] for group, *sums in rows}
+
+    def replace_hashes(
+        self,
+        id_prefix_range: Union[str, bytes],
+        mapping: dict[Union[str, bytes], dict[str, float]],
+    ) -> bool:
+        stale = list(
+            self.redis_client.scan_iter(match=id_prefix_range + "*", _type="HASH")
+        )
+        with self.redis_client.pipeline() as pipe:
+            if stale:
+                pipe.delete(*stale)
+            for id, fields in mapping.items():
+                if fields:
+                    pipe.hset(id, mapping=fields)
+            pipe.execute()
         return True
 
+    def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
+        return self.write(WriteBatch(sets={id: content}))
+
     def mset(
         self, ids: list[Union[str, bytes]], contents: list[Union[str, bytes]]
     ) -> bool:
         if len(contents) != len(ids):
             return False
-        to_set_map = {id: content for id, content in zip(ids, contents)}
-        keys = [self.MEMBER_SET_KEY, *ids]
-        self._pipe(
-            funcs=["mset", "sadd"],
-            func_args=[
-                ((to_set_map,), {}),
-                ((keys,), {}),
-            ],
-            watch_parameters=keys,
-        )
-        return True
+        return self.write(WriteBatch(sets=dict(zip(ids, contents))))
 
     def contains(self, id: Union[str, bytes]) -> bool:
-        return self.redis_client.sismember(name=self.MEMBER_SET_KEY, value=id)
+        return self.membership.contains(self.redis_client, id)
+
+    def delete(self, ids: list[Union[str, bytes]]) -> dict[Union[str, bytes], int]:
+        # membership trackers aren't updated, "set" and "prefix" keep the ids
+        # and "bloom" can't forget them
+        deleted = {}
+        for start in range(0, len(ids), 1000):
+            chunk = ids[start : start + 1000]
+            sizes = self._delete_script(keys=chunk)
+            deleted.update((id, n) for id, n in zip(chunk, sizes) if n >= 0)
+        return deleted
+
+    def swap_namespace(self, staging: str, prefixes: tuple[str, ...]) -> int:
+        # keys are listed first and swapped by one script call, keys created
+        # under prefixes in between are kept unless a staged key replaces them
+        stale = [
+            key
+            for prefix in prefixes
+            for key in self.redis_client.scan_iter(
+                match=prefix + "*", count=self.scan_count
+            )
+        ]
+        staged = list(
+            self.redis_client.scan_iter(match=staging + "*", count=self.scan_count)
+        )
+        return self._swap_script(
+            keys=[*stale, *staged], args=[len(stale), len(staging.encode("utf-8"))]
+        )
 
     def mupdate(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
-        args = []
-        for id, delta in mapping.items():
-            args.append(((id, delta), {}))
-        funcs = ["incrbyfloat"] * len(mapping)
-        funcs.append("sadd")
-        keys = [self.MEMBER_SET_KEY, *mapping.keys()]
-        args.append((keys, {}))
-        return self._pipe(
-            funcs=funcs,
-            func_args=args,
-            watch_parameters=keys,
-        )
-
-    def _pipe(
-        self, funcs: list, func_args: list, watch_parameters: Optional[list] = None
-    ):
-        ret = []
+        if not mapping:
+            return []
+        return self._write(WriteBatch(deltas=mapping))
+
+    def write(self, batch: WriteBatch) -> bool:
+        if batch:
+            self._write(batch)
+        return True
+
+    def close(self):
+        self.redis_client.connection_pool.disconnect()
+
+    def _scan_page(
+        self, id_prefix_range: Union[str, bytes], cursor: int, count: int
+    ) -> tuple[int, dict[Union[str, bytes], Union[str, bytes]]]:
+        internal_keys = [k for k in self.membership.internal_keys if isinstance(k, str)]
+        next_cursor, keys, values = self._scan_script(
+            args=[cursor, id_prefix_range + "*", count, *internal_keys]
+        )
+        return int(next_cursor), dict(zip(keys, values))
+
+    def _write(self, batch: WriteBatch) -> list[float]:
+        if self.transactions == "watch":
+            return self._watch_write(batch)
+        members = self.membership.updates([*batch.sets, *batch.deltas])
+        keys = [
+            *batch.sets.keys(),
+            *batch.deltas.keys(),
+            *batch.hdeltas.keys(),
+            *batch.ttls.keys(),
+            *members.keys(),
+        ]
+        args = [
+            len(batch.sets),
+            len(batch.deltas),
+            len(batch.hdeltas),
+            len(batch.ttls),
+            *batch.sets.values(),
+            *batch.deltas.values(),
+        ]
+        for fields in batch.hdeltas.values():
+            args.append(len(fields))
+            for f, delta in fields.items():
+                args.extend((f, delta))
+        args.extend(batch.ttls.values())
+        for kind, items in members.values():
+            args.extend((kind, len(items), *items))
+        self.counters["script_calls"] += 1
+        return [float(v) for v in self._write_script(keys=keys, args=args)]
+
+    def _watch_write(self, batch: WriteBatch) -> list[float]:
+        # legacy optimistic transaction, kept to compare contention against the
+        # scripted path: writers watch the membership keys and retry on abort
+        members = self.membership.updates([*batch.sets, *batch.deltas])
+        keys = [*members, *batch.sets.keys(), *batch.deltas.keys()]
         with self.redis_client.pipeline() as pipe:
-            while True:
+            for _ in range(self.max_watch_retries):
                 try:
-                    if watch_parameters:
-                        pipe.watch(*watch_parameters)
+                    if keys:
+                        pipe.watch(*keys)
                     pipe.multi()
-                    for f, (fargs, fkwargs) in zip(funcs, func_args):
-                        ret.append(getattr(pipe, f)(*fargs, **fkwargs))
-                    pipe.execute()
+                    if batch.sets:
+                        pipe.mset(batch.sets)
+                    for id, delta in batch.deltas.items():
+                        pipe.incrbyfloat(id, delta)
+                    for key, (kind, items) in members.items():
+                        if kind == "set":
+                            pipe.sadd(key, *items)
+                        else:
+                            for p in items:
+                                pipe.setbit(key, p, 1)
+                    for id, fields in batch.hdeltas.items():
+                        for f, delta in fields.items():
+                            pipe.hincrbyfloat(id, f, delta)
+                    for id, ttl in batch.ttls.items():
+                        pipe.expire(id, ttl)
+                    ret = pipe.execute()
                     break
                 except WatchError:
+                    self.counters["watch_retries"] += 1
                     continue
+            else:
+                self.counters["watch_aborts"] += 1
+                raise WatchError(
+                    f"Transaction aborted after {self.max_watch_retries} retries"
+                )
+        offset = int(bool(batch.sets))
+        return [float(v) for v in ret[offset : offset + len(batch.deltas)]]
+
+
+def hash_tag(key: Union[str, bytes]) -> Union[str, bytes]:
+    # the Redis Cluster hash tag: the part within the first "{...}" when it
+    # isn't empty, else the whole key
+    start_sep, end_sep = ("{", "}") if isinstance(key, str) else (b"{", b"}")
+    if (start := key.find(start_sep)) != -1:
+        if (end := key.find(end_sep, start + 1)) > start + 1:
+            return key[start + 1 : end]
+    return key
+
+
+class ShardedBackend(Storage):
+    # Routes every key to one of several storages by the Redis Cluster slot
+    # (CRC16 mod 16384) of its tag, slots being split in contiguous ranges over
+    # the shards. Each shard keeps its own member set. Writes are split per
+    # shard and applied in parallel, atomically per shard only.
+    # Hash fields are partial sums: the hash deltas of a batch go to the shard
+    # of its first plain key, and reads fan out in parallel and add them up.
+    # Shards are storages or specs, "host:port" for Redis and "memory" for an
+    # in-process stand-in.
+    TYPE = SUPPORTED.SHARDED
+    SLOTS = 16384
+
+    def __init__(
+        self,
+        shards: list[Union[Storage, str]],
+        tag: Callable[[Union[str, bytes]], Union[str, bytes]] = hash_tag,
+        **kwargs,
+    ):
+        if not shards:
+            raise ValueError("At least one shard is required")
+        self.shards = [
+            self._connect(shard, **kwargs) if isinstance(shard, str) else shard
+            for shard in shards
+        ]
+        self.tag = tag
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.shards), thread_name_prefix="shard"
+        )
+
+    def get_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        return [k for keys in self._fan_out("get_keys", id_prefix_range) for k in keys]
+
+    def get_values(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        return [
+            v for values in self._fan_out("get_values", id_prefix_range) for v in values
+        ]
+
+    def get_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> dict[Union[str, bytes], Union[str, bytes]]:
+        items = {}
+        for shard_items in self._fan_out("get_items", id_prefix_range):
+            items.update(shard_items)
+        return items
+
+    def iter_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[Union[str, bytes]]:
+        for shard in self.shards:
+            yield from shard.iter_keys(id_prefix_range, batch_size)
+
+    def iter_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], Union[str, bytes]]]:
+        for shard in self.shards:
+            yield from shard.iter_items(id_prefix_range, batch_size)
+
+    def scan_items(
+        self,
+        id_prefix_range: Optional[Union[str, bytes]] = "",
+        cursor: Optional[str] = None,
+        count: int = 1000,
+    ) -> tuple[Optional[str], dict[Union[str, bytes], Union[str, bytes]]]:
+        # the cursor is "<shard>:<cursor within the shard>"
+        index, _, shard_cursor = (cursor or "0:").partition(":")
+        index = int(index)
+        if not 0 <= index < len(self.shards):
+            raise ValueError(f"Bad cursor: {cursor}")
+        shard_cursor, items = self.shards[index].scan_items(
+            id_prefix_range, shard_cursor or None, count
+        )
+        if shard_cursor is not None:
+            return f"{index}:{shard_cursor}", items
+        return (f"{index + 1}:" if index + 1 < len(self.shards) else None), items
+
+    def get_hash(self, id: Union[str, bytes]) -> dict[Union[str, bytes], float]:
+        return _sum_fields(self._fan_out("get_hash", id))
+
+    def get_hashes(
+        self, ids: list[Union[str, bytes]]
+    ) -> list[dict[Union[str, bytes], float]]:
+        return [_sum_fields(parts) for parts in zip(*self._fan_out("get_hashes", ids))]
+
+    def iter_hashes(
+        self, id_prefix_range: Union[str, bytes], batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], dict[Union[str, bytes], float]]]:
+        # a hash written to several shards comes once per shard, its parts add up
+        for shard in self.shards:
+            yield from shard.iter_hashes(id_prefix_range, batch_size)
+
+    def group_hashes(
+        self, ids: list[Union[str, bytes]], nodes: Optional[list[int]] = None
+    ) -> dict[Union[str, bytes], list[float]]:
+        groups = {}
+        for shard_groups in self._fan_out("group_hashes", ids, nodes):
+            for group, sums in shard_groups.items():
+                if (total := groups.get(group)) is None:
+                    groups[group] = sums
+                else:
+                    groups[group] = [a + b for a, b in zip(total, sums)]
+        return groups
+
+    def replace_hashes(
+        self,
+        id_prefix_range: Union[str, bytes],
+        mapping: dict[Union[str, bytes], dict[str, float]],
+    ) -> bool:
+        parts = [{} for _ in self.shards]
+        for id, fields in mapping.items():
+            parts[self._shard_index(id)][id] = fields
+        return all(
+            self._executor.map(
+                lambda shard, part: shard.replace_hashes(id_prefix_range, part),
+                self.shards,
+                parts,
+            )
+        )
+
+    def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
+        return self.shards[self._shard_index(id)].set(id, content)
+
+    def mset(self, ids: list[Union[str, bytes]], contents: list[Any]) -> bool:
+        parts = {}
+        for id, content in zip(ids, contents):
+            part = parts.setdefault(self._shard_index(id), ([], []))
+            part[0].append(id)
+            part[1].append(content)
+        return all(
+            self._executor.map(
+                lambda index: self.shards[index].mset(*parts[index]), parts
+            )
+        )
+
+    def contains(self, id: Union[str, bytes]) -> bool:
+        return self.shards[self._shard_index(id)].contains(id)
+
+    def delete(self, ids: list[Union[str, bytes]]) -> dict[Union[str, bytes], int]:
+        # hashes may have parts on any shard, every shard is asked
+        deleted = {}
+        for shard_deleted in self._fan_out("delete", ids):
+            for id, n in shard_deleted.items():
+                deleted[id] = deleted.get(id, 0) + n
+        return deleted
+
+    def swap_namespace(self, staging: str, prefixes: tuple[str, ...]) -> int:
+        # swapped on each shard, atomically per shard only; a staged plain key
+        # must be routed like its final name, as with a tag that ignores the
+        # leading segments (see services.routing_tag)
+        return sum(self._fan_out("swap_namespace", staging, prefixes))
+
+    def mupdate(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
+        batch = self._split(WriteBatch(deltas=mapping))
+        results = dict(
+            zip(
+                batch,
+                self._executor.map(
+                    lambda index: self.shards[index].mupdate(batch[index].deltas), batch
+                ),
+            )
+        )
+        # back in the order of mapping
+        positions = {index: iter(values) for index, values in results.items()}
+        return [next(positions[self._shard_index(id)]) for id in mapping]
+
+    def write(self, batch: WriteBatch) -> bool:
+        parts = self._split(batch)
+        return all(
+            self._executor.map(
+                lambda index: self.shards[index].write(parts[index]), parts
+            )
+        )
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._executor.shutdown(wait=False)
+
+    def _connect(self, spec: str, **kwargs) -> Storage:
+        if spec == "memory":
+            return MemoryBackend()
+        host, _, port = spec.rpartition(":")
+        return RedisBackend(host=host or "redis", port=int(port or 6379), **kwargs)
+
+    def _shard_index(self, id: Union[str, bytes]) -> int:
+        tag = self.tag(id)
+        if isinstance(tag, str):
+            tag = tag.encode("utf-8")
+        return crc_hqx(tag, 0) % self.SLOTS * len(self.shards) // self.SLOTS
+
+    def _split(self, batch: WriteBatch) -> dict[int, WriteBatch]:
+        parts = {}
+        for id, content in batch.sets.items():
+            parts.setdefault(self._shard_index(id), WriteBatch()).sets[id] = content
+        for id, delta in batch.deltas.items():
+            parts.setdefault(self._shard_index(id), WriteBatch()).deltas[id] = delta
+        home = next(iter(parts), None)
+        for id, fields in batch.hdeltas.items():
+            index = self._shard_index(id) if home is None else home
+            parts.setdefault(index, WriteBatch()).hdeltas[id] = fields
+        for id, ttl in batch.ttls.items():
+            if id in batch.hdeltas:
+                index = self._shard_index(id) if home is None else home
+            else:
+                index = self._shard_index(id)
+            parts.setdefault(index, WriteBatch()).ttls[id] = ttl
+        return parts
+
+    def _fan_out(self, method: str, *args) -> list:
+        if len(self.shards) == 1:
+            return [getattr(self.shards[0], method)(*args)]
+        return list(
+            self._executor.map(lambda shard: getattr(shard, method)(*args), self.shards)
+        )
+
+
+def _sum_fields(
+    hashes: list[dict[Union[str, bytes], float]],
+) -> dict[Union[str, bytes], float]:
+    total = {}
+    for fields in hashes:
+        for f, v in fields.items():
+            total[f] = total.get(f, 0.0) + v
+    return total
+
+
+class WriteBehindBuffer(Storage):
+    # Coalesces counter and hash deltas in process, summed per key, and flushes
+    # them to the wrapped storage as a single write once max_keys distinct keys
+    # are pending, every flush_interval seconds and on close() (also at exit).
+    # Plain sets are written through immediately.
+    # Reads go to the wrapped storage and lag behind by up to flush_interval.
+    # Deltas still pending when the process dies without running close() are
+    # lost: at most flush_interval seconds or max_keys keys worth of updates.
+    # A failed flush keeps its deltas pending and retries on the next one.
+    def __init__(self, storage: Storage, flush_interval=1.0, max_keys=10000):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.counters = {"flushes": 0, "flushed_keys": 0, "flush_errors": 0}
+        self._pending = WriteBatch()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self._flusher.start()
+        atexit.register(self.close)
+
+    @property
+    def TYPE(self) -> SUPPORTED:
+        return self.storage.TYPE
+
+    def get_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        return self.storage.get_keys(id_prefix_range)
+
+    def get_values(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        return self.storage.get_values(id_prefix_range)
+
+    def get_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> dict[Union[str, bytes], Union[str, bytes]]:
+        return self.storage.get_items(id_prefix_range)
+
+    def iter_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[Union[str, bytes]]:
+        return self.storage.iter_keys(id_prefix_range, batch_size)
+
+    def iter_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], Union[str, bytes]]]:
+        return self.storage.iter_items(id_prefix_range, batch_size)
+
+    def scan_items(
+        self,
+        id_prefix_range: Optional[Union[str, bytes]] = "",
+        cursor: Optional[str] = None,
+        count: int = 1000,
+    ) -> tuple[Optional[str], dict[Union[str, bytes], Union[str, bytes]]]:
+        return self.storage.scan_items(id_prefix_range, cursor, count)
+
+    def get_hash(self, id: Union[str, bytes]) -> dict[Union[str, bytes], float]:
+        return self.storage.get_hash(id)
+
+    def get_hashes(
+        self, ids: list[Union[str, bytes]]
+    ) -> list[dict[Union[str, bytes], float]]:
+        return self.storage.get_hashes(ids)
+
+    def iter_hashes(
+        self, id_prefix_range: Union[str, bytes], batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], dict[Union[str, bytes], float]]]:
+        return self.storage.iter_hashes(id_prefix_range, batch_size)
+
+    def group_hashes(
+        self, ids: list[Union[str, bytes]], nodes: Optional[list[int]] = None
+    ) -> dict[Union[str, bytes], list[float]]:
+        return self.storage.group_hashes(ids, nodes)
+
+    def replace_hashes(
+        self,
+        id_prefix_range: Union[str, bytes],
+        mapping: dict[Union[str, bytes], dict[str, float]],
+    ) -> bool:
+        # pending deltas belong to sessions the replacement already accounts for
+        self.flush()
+        return self.storage.replace_hashes(id_prefix_range, mapping)
+
+    def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
+        return self.storage.set(id, content)
+
+    def mset(
+        self, ids: list[Union[str, bytes]], contents: list[Union[str, bytes]]
+    ) -> bool:
+        return self.storage.mset(ids, contents)
+
+    def contains(self, id: Union[str, bytes]) -> bool:
+        return self.storage.contains(id)
+
+    def delete(self, ids: list[Union[str, bytes]]) -> dict[Union[str, bytes], int]:
+        return self.storage.delete(ids)
+
+    def swap_namespace(self, staging: str, prefixes: tuple[str, ...]) -> int:
+        self.flush()
+        return self.storage.swap_namespace(staging, prefixes)
+
+    def mupdate(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
+        # updated values are only known after the flush
+        self.write(WriteBatch(deltas=mapping))
+        return []
+
+    def write(self, batch: WriteBatch) -> bool:
+        # ttls go with both parts, expiring a key that does not exist is a no-op
+        if batch.sets:
+            self.storage.write(WriteBatch(sets=batch.sets, ttls=batch.ttls))
+        with self._lock:
+            self._pending.merge(
+                WriteBatch(deltas=batch.deltas, hdeltas=batch.hdeltas, ttls=batch.ttls)
+            )
+            is_full = self._num_pending() >= self.max_keys
+        if is_full:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, WriteBatch()
+        if not pending:
+            return
+        try:
+            self.storage.write(pending)
+        except Exception:
+            self.counters["flush_errors"] += 1
+            with self._lock:
+                self._pending = pending.merge(self._pending)
+            raise
+        self.counters["flushes"] += 1
+        self.counters["flushed_keys"] += len(pending.deltas) + sum(
+            len(fields) for fields in pending.hdeltas.values()
+        )
+
+    def close(self):
+        # once, e.g. on SIGTERM and again at exit
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
+        self.storage.close()
+
+    def _num_pending(self) -> int:
+        return len(self._pending.deltas) + sum(
+            len(fields) for fields in self._pending.hdeltas.values()
+        )
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error(f"Unable to flush buffered writes: {ex}")
+
+
+def _num_bytes(obj) -> int:
+    # rough size of the values, keys aren't counted and numbers count as 8
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, WriteBatch):
+        num_fields = len(obj.deltas) + sum(map(len, obj.hdeltas.values()))
+        return sum(map(len, obj.sets.values())) + 8 * num_fields
+    if isinstance(obj, dict):
+        return sum(map(_num_bytes, obj.values()))
+    if isinstance(obj, (list, tuple)):
+        return sum(map(_num_bytes, obj))
+    return 0 if obj is None else 8
+
+
+class InstrumentedStorage(Storage):
+    # Times every call to the wrapped storage, one round-trip for the Redis
+    # backend, and counts the bytes of the values sent and received by method.
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    @property
+    def TYPE(self) -> SUPPORTED:
+        return self.storage.TYPE
+
+    def get_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        return self._call("get_keys", id_prefix_range)
+
+    def get_values(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> list[Union[str, bytes]]:
+        return self._call("get_values", id_prefix_range)
+
+    def get_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = ""
+    ) -> dict[Union[str, bytes], Union[str, bytes]]:
+        return self._call("get_items", id_prefix_range)
+
+    def iter_keys(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[Union[str, bytes]]:
+        return self._iter("iter_keys", id_prefix_range, batch_size)
+
+    def iter_items(
+        self, id_prefix_range: Optional[Union[str, bytes]] = "", batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], Union[str, bytes]]]:
+        return self._iter("iter_items", id_prefix_range, batch_size)
+
+    def scan_items(
+        self,
+        id_prefix_range: Optional[Union[str, bytes]] = "",
+        cursor: Optional[str] = None,
+        count: int = 1000,
+    ) -> tuple[Optional[str], dict[Union[str, bytes], Union[str, bytes]]]:
+        return self._call("scan_items", id_prefix_range, cursor, count)
+
+    def get_hash(self, id: Union[str, bytes]) -> dict[Union[str, bytes], float]:
+        return self._call("get_hash", id)
+
+    def get_hashes(
+        self, ids: list[Union[str, bytes]]
+    ) -> list[dict[Union[str, bytes], float]]:
+        return self._call("get_hashes", ids)
+
+    def iter_hashes(
+        self, id_prefix_range: Union[str, bytes], batch_size: int = 1000
+    ) -> Iterator[tuple[Union[str, bytes], dict[Union[str, bytes], float]]]:
+        return self._iter("iter_hashes", id_prefix_range, batch_size)
+
+    def group_hashes(
+        self, ids: list[Union[str, bytes]], nodes: Optional[list[int]] = None
+    ) -> dict[Union[str, bytes], list[float]]:
+        return self._call("group_hashes", ids, nodes)
+
+    def replace_hashes(
+        self,
+        id_prefix_range: Union[str, bytes],
+        mapping: dict[Union[str, bytes], dict[str, float]],
+    ) -> bool:
+        return self._call("replace_hashes", id_prefix_range, mapping, sent=mapping)
+
+    def set(self, id: Union[str, bytes], content: Union[str, bytes]) -> bool:
+        return self._call("set", id, content, sent=content)
+
+    def mset(
+        self, ids: list[Union[str, bytes]], contents: list[Union[str, bytes]]
+    ) -> bool:
+        return self._call("mset", ids, contents, sent=contents)
+
+    def contains(self, id: Union[str, bytes]) -> bool:
+        return self._call("contains", id)
+
+    def delete(self, ids: list[Union[str, bytes]]) -> dict[Union[str, bytes], int]:
+        return self._call("delete", ids)
+
+    def swap_namespace(self, staging: str, prefixes: tuple[str, ...]) -> int:
+        return self._call("swap_namespace", staging, prefixes)
+
+    def mupdate(self, mapping: dict[Union[str, bytes], float]) -> list[float]:
+        return self._call("mupdate", mapping, sent=mapping)
+
+    def write(self, batch: WriteBatch) -> bool:
+        return self._call("write", batch, sent=batch)
+
+    def close(self):
+        self.storage.close()
+
+    def _call(self, method: str, *args, sent=None):
+        started = time.perf_counter()
+        try:
+            ret = getattr(self.storage, method)(*args)
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, method=method)
+        if sent is not None:
+            STORAGE_BYTES.inc(_num_bytes(sent), method=method, direction="out")
+        elif not isinstance(ret, bool):
+            STORAGE_BYTES.inc(_num_bytes(ret), method=method, direction="in")
         return ret
 
+    def _iter(self, method: str, *args) -> Iterator:
+        # one observation per call, of the time spent in the wrapped iterator
+        # only, when exhausted or abandoned
+        items = getattr(self.storage, method)(*args)
+        elapsed, num_bytes = 0.0, 0
+        try:
+            while True:
+                started = time.perf_counter()
+                item = next(items, None)
+                elapsed += time.perf_counter() - started
+                if item is None:
+                    return
+                num_bytes += _num_bytes(item)
+                yield item
+        finally:
+            STORAGE_SECONDS.observe(elapsed, method=method)
+            STORAGE_BYTES.inc(num_bytes, method=method, direction="in")
+
 
 class Client:
     __instance = None
 
     @classmethod
-    def init(cls, type: SUPPORTED, *args, **kwargs):
+    def init(
+        cls,
+        type: SUPPORTED,
+        *args,
+        write_behind: Optional[dict] = None,
+        instrument: bool = False,
+        **kwargs,
+    ):
         if not cls.__instance or cls.__instance.TYPE != type:
             cls.__instance = {
                 SUPPORTED.MEMORY: MemoryBackend,
+                SUPPORTED.LOCAL: LocalBackend,
                 SUPPORTED.REDIS: RedisBackend,
+                SUPPORTED.SHARDED: ShardedBackend,
             }[type](*args, **kwargs)
+            if instrument:
+                cls.__instance = InstrumentedStorage(cls.__instance)
+            if write_behind:
+                cls.__instance = WriteBehindBuffer(cls.__instance, **write_behind)
+
+    @classmethod
+    def close(cls):
+        if cls.__instance:
+            cls.__instance.close()
 
     @classmethod
     def get(cls):
@@ -0,0 +1,142 @@
+import argparse
+import glob
+import os
+import time
+
+from omnimatsoo.app import init_clients
+from omnimatsoo.export import WRITERS, open_writer
+from omnimatsoo.services import SESSION_COLUMNS, ServiceClients
+
+
+def rebuild_rollups():
+    parser = argparse.ArgumentParser(
+        description="Recompute the rollup index and sketches from the raw "
+        "records, configured as the server by the APP_ environment"
+    )
+    parser.add_argument(
+        "--drop-expired",
+        action="store_true",
+        help="required with APP_RAW_RECORD_TTL: sessions whose raw records have "
+        "expired are removed from the rollups, for good",
+    )
+    args = parser.parse_args()
+
+    init_clients()
+    started = time.perf_counter()
+    try:
+        num_sessions = ServiceClients.playback_benchmark.rebuild_rollups(
+            drop_expired=args.drop_expired
+        )
+    except ValueError as ex:
+        raise SystemExit(str(ex))
+    print(
+        f"Rebuilt rollups from {num_sessions} sessions "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+
+def compact_raw():
+    init_clients()
+    if not (compactor := ServiceClients.compactor):
+        raise SystemExit("APP_RAW_RETENTION isn't set, nothing to compact")
+    started = time.perf_counter()
+    counts = compactor.run_once()
+    print(
+        f"Compacted {counts['records']} raw records, reclaimed {counts['bytes']} "
+        f"bytes in {time.perf_counter() - started:.2f}s"
+    )
+
+
+def reaggregate():
+    parser = argparse.ArgumentParser(
+        description="Recompute the aggregations from the raw records and swap "
+        "them in, configured as the server by the APP_ environment"
+    )
+    add_raw_arguments(parser)
+    parser.add_argument(
+        "--drop-compacted",
+        action="store_true",
+        help="leave sessions compacted without an archive out of the aggregations",
+    )
+    parser.add_argument(
+        "--drop-expired",
+        action="store_true",
+        help="required with APP_RAW_RECORD_TTL: sessions whose raw records have "
+        "expired are removed from every aggregation, for good",
+    )
+    args = parser.parse_args()
+
+    init_clients()
+    started = time.perf_counter()
+    try:
+        counts = ServiceClients.playback_benchmark.reaggregate(
+            processes=args.processes,
+            chunk_size=args.chunk_size,
+            archives=find_archives(args.archive_dir),
+            drop_compacted=args.drop_compacted,
+            drop_expired=args.drop_expired,
+        )
+    except ValueError as ex:
+        raise SystemExit(str(ex))
+    elapsed = time.perf_counter() - started
+    print(
+        f"Re-aggregated {counts['sessions']} sessions into {counts['keys']} keys "
+        f"in {elapsed:.2f}s, {counts['sessions'] / elapsed:,.0f} sessions/s"
+    )
+
+
+def export_raw():
+    parser = argparse.ArgumentParser(
+        description="Export the raw sessions as one row each, configured as the "
+        "server by the APP_ environment"
+    )
+    parser.add_argument("output", help="file to write")
+    parser.add_argument(
+        "--format",
+        choices=sorted(WRITERS),
+        help="defaults to the extension of output",
+    )
+    add_raw_arguments(parser)
+    args = parser.parse_args()
+    format = args.format or os.path.splitext(args.output)[1].lstrip(".")
+
+    init_clients()
+    started = time.perf_counter()
+    try:
+        writer = open_writer(args.output, format, SESSION_COLUMNS)
+    except ValueError as ex:
+        raise SystemExit(str(ex))
+    try:
+        num_sessions = ServiceClients.playback_benchmark.export_raw(
+            writer,
+            processes=args.processes,
+            chunk_size=args.chunk_size,
+            archives=find_archives(args.archive_dir),
+        )
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - started
+    print(
+        f"Exported {num_sessions} sessions to {args.output} in {elapsed:.2f}s, "
+        f"{num_sessions / elapsed:,.0f} sessions/s"
+    )
+
+
+def add_raw_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes decoding the records, 1 to decode in process",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--archive-dir",
+        help="also read the records dumped there by compaction (APP_ARCHIVE_DIR)",
+    )
+
+
+def find_archives(archive_dir: str) -> tuple[str, ...]:
+    if not archive_dir:
+        return ()
+    return tuple(sorted(glob.glob(os.path.join(archive_dir, "ORGE-*.jsonl.gz"))))
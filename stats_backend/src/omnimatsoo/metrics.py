@@ -0,0 +1,234 @@
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+# seconds, from a fast in-process stage to a slow storage round-trip
+LATENCY_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    10.0,
+)
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(labels)} {value!r}"
+
+
+class Histogram:
+    # cumulative buckets are only summed up when rendered, an observation is a
+    # bisect and two additions
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            if (series := self._series.get(key)) is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, **labels) -> "Timer":
+        return Timer(self, labels)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [
+                (k, list(counts), total) for k, (counts, total) in self._series.items()
+            ]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = _labels((*labels, ("le", bound)))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_labels(labels)} {total!r}"
+            yield f"{self.name}_count{_labels(labels)} {cumulative}"
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    # metrics, plus named collectors called at render time that return
+    # [(name, help, type, [(labels, value)])] for values kept elsewhere, e.g.
+    # the counters dicts of the storages and caches
+    def __init__(self, enabled: bool = True):
+        # when disabled stages aren't timed, the rest is cheap enough to keep
+        self.enabled = enabled
+        self.metrics = []
+        self.collectors = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        self.metrics.append(metric := Counter(name, help))
+        return metric
+
+    def histogram(self, name: str, help: str, **kwargs) -> Histogram:
+        self.metrics.append(metric := Histogram(name, help, **kwargs))
+        return metric
+
+    def add_collector(self, name: str, collector: Callable[[], list]):
+        self.collectors[name] = collector
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors.values():
+            for name, help, type, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(tuple(labels.items()))} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "omnimatsoo_stage_seconds",
+    "Time spent per stage of the ingest and aggregation paths",
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "omnimatsoo_request_seconds", "Time spent per request by handler and status"
+)
+STORAGE_SECONDS = REGISTRY.histogram(
+    "omnimatsoo_storage_seconds", "Time spent per storage call by method"
+)
+STORAGE_BYTES = REGISTRY.counter(
+    "omnimatsoo_storage_bytes_total",
+    "Bytes of values written (out) and read (in) per storage method",
+)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def stage(name: str, **labels):
+    # with stage("parse"): ... times its block into STAGE_SECONDS
+    if not REGISTRY.enabled:
+        return NULL_TIMER
+    return Timer(STAGE_SECONDS, {"stage": name, **labels})
+
+
+def component_counters(components: Callable[[], dict]) -> Callable[[], list]:
+    # collector of the counters dicts of the components returned by name
+    def collect() -> list:
+        samples = [
+            ({"component": name, "event": event}, value)
+            for name, component in components().items()
+            for event, value in getattr(component, "counters", {}).items()
+        ]
+        return [
+            (
+                "omnimatsoo_component_events_total",
+                "Counters of the storage, cache and background components",
+                "counter",
+                samples,
+            )
+        ]
+
+    return collect
+
+
+class Profiler:
+    # cProfile of a sample of the requests whose path matches the route regex,
+    # each dumped to "<directory>/<path>-<time>-<pid>.prof" for pstats
+    def __init__(self, route: str, sample: float = 0.01, directory: str = "."):
+        self.route = re.compile(route)
+        self.sample = sample
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, path: str) -> Optional[cProfile.Profile]:
+        if not self.route.match(path) or random.random() >= self.sample:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active in this thread's interpreter
+            return None
+        return profile
+
+    def stop(self, profile: Optional[cProfile.Profile], path: str):
+        if profile is None:
+            return
+        profile.disable()
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", path.strip("/")) or "root"
+        profile.dump_stats(
+            os.path.join(self.directory, f"{name}-{time.time():.6f}-{os.getpid()}.prof")
+        )
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from tornado import web, wsgi
+from tornado.ioloop import IOLoop
+
+from omnimatsoo.app import create_app
+from omnimatsoo.cache import CachedResult
+from omnimatsoo.entities import PlaybackStatistics
+from omnimatsoo.handlers.aggr import (
+    ndjson_page,
+    parse_limit,
+    parse_nodes,
+    parse_time_range,
+)
+from omnimatsoo.handlers.collect import MAX_BATCH_ITEMS, add_batch, parse_batch
+from omnimatsoo.metrics import REGISTRY, REQUEST_SECONDS, stage
+from omnimatsoo.services import ServiceClients as SVC
+
+logger = logging.getLogger(__name__)
+
+
+class BaseHandler(web.RequestHandler):
+    # storage calls are blocking, they run on the executor so a slow round-trip
+    # only holds one pooled connection instead of the whole IOLoop
+    def initialize(self, executor: ThreadPoolExecutor):
+        self.executor = executor
+
+    def prepare(self):
+        self.started = time.perf_counter()
+
+    def on_finish(self):
+        # APP_PROFILE_ROUTE only profiles the routes falling back to Flask, the
+        # work of these handlers is spread over the executor threads
+        if REGISTRY.enabled:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - self.started,
+                handler=type(self).__name__,
+                method=self.request.method,
+                status=self.get_status(),
+            )
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Content-Type", "application/json")
+
+    def options(self, *args):
+        self.set_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.set_header("Access-Control-Allow-Headers", "Content-Type")
+        self.set_status(204)
+
+    async def offload(self, func, *args, **kwargs):
+        return await IOLoop.current().run_in_executor(
+            self.executor, partial(func, *args, **kwargs)
+        )
+
+    def reply(self, obj, status: int = 200):
+        self.set_status(status)
+        self.finish(json.dumps(obj, separators=(",", ":")))
+
+    def reply_error(self, message: str, status: int):
+        self.set_status(status)
+        self.finish(message)
+
+
+class CollectHandler(BaseHandler):
+    async def post(self):
+        try:
+            with stage("parse"):
+                result = json.loads(self.request.body)
+            with stage("build"):
+                playback_statistics = PlaybackStatistics(**result)
+        except Exception as ex:
+            logger.error(f"Unable to process received payload: {ex}")
+            return self.reply_error("bad payload", 400)
+        try:
+            await self.offload(SVC.playback_benchmark.add, playback_statistics)
+        except Exception as ex:
+            logger.error(f"Unable to store received payload: {ex}")
+            return self.reply_error("bad payload", 400)
+        self.reply("")
+
+
+class CollectBatchHandler(BaseHandler):
+    async def post(self):
+        try:
+            with stage("parse"):
+                payloads = parse_batch(self.request.body)
+        except ValueError as ex:
+            logger.error(f"Unable to parse received batch: {ex}")
+            return self.reply_error("bad payload", 400)
+        if len(payloads) > MAX_BATCH_ITEMS:
+            return self.reply_error(
+                f'too many items: "{len(payloads)}" > "{MAX_BATCH_ITEMS}"', 413
+            )
+        try:
+            self.reply(await self.offload(add_batch, payloads))
+        except Exception as ex:
+            logger.error(f"Unable to store received batch: {ex}")
+            self.reply_error("storage failure", 500)
+
+
+class NodeAggrHandler(BaseHandler):
+    def initialize(
+        self, executor: ThreadPoolExecutor, handler_name: str, series_handler_name: str
+    ):
+        super().initialize(executor)
+        self.handler_name = handler_name
+        self.series_handler_name = series_handler_name
+
+    async def get(self, *args):
+        *event, nodes = args
+        try:
+            if not (pnodes := parse_nodes(nodes)):
+                raise ValueError(nodes)
+        except ValueError:
+            return self.reply_error(f'wrong parameter format: "{nodes}"', 400)
+        kwargs = {"event_name": event[0]} if event else {}
+        handler = partial(SVC.playback_benchmark.cached_aggregation, self.handler_name)
+        try:
+            query = {k: self.get_argument(k, None) for k in ("from", "to", "step")}
+            if time_range := parse_time_range(query):
+                handler = getattr(SVC.playback_benchmark, self.series_handler_name)
+                kwargs.update(zip(("start", "end", "step"), time_range))
+        except ValueError:
+            return self.reply_error(
+                f'wrong time range format: "{self.request.query}"', 400
+            )
+        try:
+            result = await self.offload(handler, nodes=pnodes, **kwargs)
+            if not isinstance(result, CachedResult):
+                return self.reply(result)
+            self.set_header("Etag", f'"{result.etag}"')
+            if self.check_etag_header():
+                self.set_status(304)
+                return self.finish()
+            self.reply(result.value)
+        except IndexError:
+            self.reply_error(f'bad node numbers specified: "{nodes}"', 400)
+        except ValueError as ex:
+            self.reply_error(f'bad request: "{ex}"', 400)
+
+
+class AllHandler(BaseHandler):
+    # WSGIContainer buffers whole responses, streaming needs a native handler
+    async def get(self):
+        try:
+            limit = parse_limit(self.get_argument("limit", None))
+            cursor = self.get_argument("cursor", None)
+            if self.get_argument("format", None) == "ndjson" and cursor:
+                # the next page of a listing started on the wsgi server
+                self.set_header("Content-Type", "application/x-ndjson")
+                return self.finish(await self.offload(ndjson_page, cursor, limit))
+            if self.get_argument("format", None) == "ndjson":
+                return await self.stream(limit)
+            if cursor is None and self.get_argument("limit", None) is None:
+                return self.reply(await self.offload(SVC.playback_benchmark.list_all))
+            cursor, items = await self.offload(
+                SVC.playback_benchmark.list_page, cursor or None, limit
+            )
+        except ValueError as ex:
+            return self.reply_error(f'bad request: "{ex}"', 400)
+        self.reply({"items": items, "cursor": cursor})
+
+    async def stream(self, batch_size: int):
+        self.set_header("Content-Type", "application/x-ndjson")
+        pages = SVC.playback_benchmark.iter_all(batch_size)
+        while items := await self.offload(next, pages, None):
+            for k, v in items.items():
+                self.write(json.dumps({"key": k, "value": v}, separators=(",", ":")))
+                self.write("\n")
+            await self.flush()
+        self.finish()
+
+
+def create_native_app(executor_threads: int = None) -> web.Application:
+    # hot ingest and query routes are served natively, everything else falls
+    # back to the Flask application, keeping the same URL contract
+    flask_app = create_app()
+    executor = ThreadPoolExecutor(
+        max_workers=executor_threads
+        or int(os.environ.get("APP_EXECUTOR_THREADS") or 16),
+        thread_name_prefix="storage",
+    )
+    ex = {"executor": executor}
+    return web.Application(
+        [
+            (r"/collect/", CollectHandler, ex),
+            (r"/collect/batch/", CollectBatchHandler, ex),
+            (r"/aggr/all/", AllHandler, ex),
+            (
+                r"/aggr/playable-latency/([^/]+)/",
+                NodeAggrHandler,
+                {
+                    **ex,
+                    "handler_name": "group_by_nodes_playable",
+                    "series_handler_name": "series_by_nodes_playable",
+                },
+            ),
+            (
+                r"/aggr/playback-duration/([^/]+)/",
+                NodeAggrHandler,
+                {
+                    **ex,
+                    "handler_name": "group_by_nodes_playback_duration",
+                    "series_handler_name": "series_by_nodes_playback_duration",
+                },
+            ),
+            (
+                r"/aggr/event/([^/]+)/([^/]+)/",
+                NodeAggrHandler,
+                {
+                    **ex,
+                    "handler_name": "group_by_nodes_num_events",
+                    "series_handler_name": "series_by_nodes_num_events",
+                },
+            ),
+            (
+                r".*",
+                web.FallbackHandler,
+                {"fallback": wsgi.WSGIContainer(flask_app)},
+            ),
+        ]
+    )
@@ -1,11 +1,32 @@
-from collections import Counter
+import atexit
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from hashlib import blake2b
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
+from itertools import combinations, islice
+from typing import Any, Iterator, Optional, Union
 from urllib.parse import urlsplit
 
+from omnimatsoo.cache import CachedResult, ResultCache
+from omnimatsoo.codec import RecordCodec
 from omnimatsoo.entities import PlaybackStatistics
-from omnimatsoo.kvstorage import Client
-from omnimatsoo.utils import serialize_dataclass
+from omnimatsoo.kvstorage import SUPPORTED, Client, WriteBatch
+from omnimatsoo.metrics import stage
+from omnimatsoo.sketch import LogHistogram
+
+logger = logging.getLogger(__name__)
 
 
 class PREFIXES(str, Enum):
@@ -19,6 +40,28 @@ class PREFIXES(str, Enum):
     # "AGGR_ACTUAL_PLAYBACK_DURATION"
     AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM = "AGGRADURATION_VS:"
     AGGREGATION_ACTUAL_PLAYBACK_DURATION_ACTUAL_SUM = "AGGRADURATION_AS:"
+    # hash per aggregation prefix above and per subset of the key nodes
+    # (origin, device, video), fields are the nodes of that subset
+    # "AGGRIDX:AGGRTPLAYABLE_S:0,2" -> {"S3:short.mp4": 1234.0}
+    ROLLUP_INDEX = "AGGRIDX:"
+    # log-bucketed histogram (see LogHistogram) per origin:device:video,
+    # "AGGRQ_TPLAYABLE:" -> {"S3:pixel:short.mp4|342": 12.0}
+    AGGREGATION_TIME_BECOME_PLAYABLE_SKETCH = "AGGRQ_TPLAYABLE:"
+    # of the actual playback duration over the video duration of each session
+    AGGREGATION_ACTUAL_PLAYBACK_DURATION_SKETCH = "AGGRQ_ADURATION:"
+    # aggregation counters per time bucket (see TIME_BUCKETS),
+    # "AGGRTS:3600:1718002800:AGGRTPLAYABLE_S:" -> {"S3:pixel:short.mp4": 1234.0}
+    TIME_SERIES = "AGGRTS:"
+    # write counts per aggregation prefix, read to validate cached results,
+    # "AGGRVER:" -> {"AGGRHIST:playing:": 12.0, "*": 1.0}, "*" invalidates all
+    RESULT_VERSIONS = "AGGRVER:"
+    # contributions of compacted raw records to the DERIVED_HASH_PREFIXES
+    # hashes, which rebuild_rollups can't recompute from them anymore,
+    # "AGGRARCH:AGGRQ_TPLAYABLE:" -> {"S3:pixel:short.mp4|342": 3.0}
+    ARCHIVED_ROLLUPS = "AGGRARCH:"
+    # aggregations recomputed by reaggregate, until swapped in under their name
+    # without this prefix
+    STAGED_AGGREGATIONS = "AGGRNEW:"
 
     S3 = "S3"
     CloudFront = "CloudFront"
@@ -34,141 +77,785 @@ class RecordKey:
     id: str
 
     def __post_init__(self):
-        self._seglen = [
+        self._seglen = (
             len(self.origin),
-            len(self.device) + 1,
-            len(self.video) + 1,
-            len(self.id) + 1,
-        ]
-        for i, sl in enumerate(self._seglen[1:], 1):
-            self._seglen[i] = self._seglen[i - 1] + sl
+            len(self.origin) + len(self.device) + 1,
+            len(self.origin) + len(self.device) + len(self.video) + 2,
+        )
         self._k = f"{self.origin}:{self.device}:{self.video}:{self.id}"
 
     def __str__(self) -> str:
         return self._k
 
     def leveled_key(self, level=4):
+        if level > len(self._seglen):
+            return self._k
         return self._k[: self._seglen[level - 1]]
 
+    def with_id(self, id: str) -> "RecordKey":
+        # same origin, device and video, without recomputing the segments
+        key = object.__new__(RecordKey)
+        key.origin = self.origin
+        key.device = self.device
+        key.video = self.video
+        key.id = id
+        key._seglen = self._seglen
+        key._k = self._k[: self._seglen[2] + 1] + id
+        return key
+
+
+class OriginRules:
+    # ordered (netloc suffix, origin tag) rules, the first match wins and
+    # netlocs matching none get the default tag; configured as
+    # "s3.amazonaws.com=S3,cloudfront.net=CloudFront,*=Edge"
+    def __init__(self, rules: list[tuple[str, str]], default: str):
+        for suffix, tag in (*rules, ("*", default)):
+            if not suffix or not tag or ":" in tag:
+                raise ValueError(f"Bad origin rule: {suffix}={tag}")
+        self.rules = tuple(rules)
+        self.default = default
+
+    @classmethod
+    def parse(cls, spec: str) -> "OriginRules":
+        rules, default = [], PREFIXES.Edge.value
+        for rule in filter(None, map(str.strip, spec.split(","))):
+            suffix, sep, tag = map(str.strip, rule.partition("="))
+            if not sep:
+                raise ValueError(f"Bad origin rule: {rule}")
+            if suffix == "*":
+                default = tag
+            else:
+                rules.append((suffix, tag))
+        return cls(rules, default)
+
+    def match(self, netloc: str) -> str:
+        for suffix, tag in self.rules:
+            if netloc.endswith(suffix):
+                return tag
+        return self.default
+
+
+DEFAULT_ORIGIN_RULES = OriginRules(
+    [
+        ("s3.amazonaws.com", PREFIXES.S3.value),
+        ("cloudfront.net", PREFIXES.CloudFront.value),
+    ],
+    PREFIXES.Edge.value,
+)
+
+
+def _decode(value):
+    return value.decode("utf-8") if hasattr(value, "decode") else value
+
+
+def routing_tag(key: Union[str, bytes]) -> Union[str, bytes]:
+    # the origin:device:video of raw records and counters, so that the keys of
+    # a group share a shard; other keys are routed by their last segments
+    sep, prefix = ":", PREFIXES.ORIGINAL_EVENT.value
+    if isinstance(key, bytes):
+        sep, prefix = b":", prefix.encode("utf-8")
+    if key.startswith(prefix):
+        return sep.join(key.rsplit(sep, 4)[1:4])
+    return sep.join(key.rsplit(sep, 3)[-3:])
+
+
+ROLLUP_NODES = 3
+ROLLUP_SUBSETS = [
+    subset
+    for size in range(1, ROLLUP_NODES + 1)
+    for subset in combinations(range(ROLLUP_NODES), size)
+]
+
+
+# (bucket seconds, ttl seconds or None), the finer buckets expire and leave the
+# coarser ones as the downsampled history
+TIME_BUCKETS = ((60, 2 * 86400), (3600, 90 * 86400), (86400, None))
+MAX_SERIES_BUCKETS = 5000
+
+# everything computed from the raw records, replaced as a whole by reaggregate
+AGGREGATION_PREFIXES = tuple(
+    prefix.value
+    for prefix in (
+        PREFIXES.AGGREGATION_EVENTS_HISTOGRAM,
+        PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS,
+        PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SUM,
+        PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM,
+        PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_ACTUAL_SUM,
+        PREFIXES.ROLLUP_INDEX,
+        PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SKETCH,
+        PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_SKETCH,
+        PREFIXES.TIME_SERIES,
+    )
+)
+
+# (name, arrow type) of the rows export_raw writes per session
+SESSION_COLUMNS = (
+    ("id", "string"),
+    ("timestamp", "int64"),
+    ("origin", "string"),
+    ("device", "string"),
+    ("video", "string"),
+    ("target", "string"),
+    ("duration", "double"),
+    ("num_events", "int64"),
+    ("playable_ms", "double"),
+    ("played_ms", "double"),
+    ("events", "string"),
+)
+
+DERIVED_HASH_PREFIXES = (
+    PREFIXES.ROLLUP_INDEX,
+    PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SKETCH,
+    PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_SKETCH,
+)
+
+# the prefixes read by the cacheable group_by_nodes_* handlers
+RESULT_PREFIXES = {
+    "group_by_nodes_playable": (
+        PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SUM.value,
+        PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS.value,
+    ),
+    "group_by_nodes_playback_duration": (
+        PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_ACTUAL_SUM.value,
+        PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM.value,
+    ),
+}
+
 
 class PlaybackBenchmark:
-    def __init__(self):
+    def __init__(
+        self,
+        record_codec: Optional[RecordCodec] = None,
+        origin_rules: Optional[OriginRules] = None,
+        key_cache_size: int = 4096,
+        result_cache: Optional[ResultCache] = None,
+        raw_ttl: Optional[int] = None,
+    ):
         self.__storage = Client.get()
+        self.__codec = record_codec or RecordCodec()
+        self.__origin_rules = origin_rules or DEFAULT_ORIGIN_RULES
+        # distinct (target, device_tag) pairs are few, their key prefix is
+        # resolved once and only the id is appended per session
+        self._resolve_key = lru_cache(maxsize=key_cache_size)(self._resolve_key)
+        self.__result_cache = result_cache
+        # seconds raw records are kept at most, whether compacted or not
+        self.__raw_ttl = raw_ttl
+        self.__sketch = LogHistogram()
+
+    @property
+    def result_cache(self) -> Optional[ResultCache]:
+        return self.__result_cache
 
     def add(self, playback_statistics: PlaybackStatistics):
+        with stage("compose"):
+            batch = self._compose_writes(playback_statistics)
+        self.__storage.write(batch)
+
+    def add_many(
+        self, playback_statistics: list[PlaybackStatistics]
+    ) -> list[Optional[str]]:
+        # all accepted sessions of a batch go out as one storage write, rejected
+        # ones are reported back by position
+        batch, errors = WriteBatch(), []
+        with stage("compose"):
+            for stats in playback_statistics:
+                try:
+                    batch.merge(self._compose_writes(stats))
+                except Exception as ex:
+                    errors.append(str(ex) or type(ex).__name__)
+                else:
+                    errors.append(None)
+        self.__storage.write(batch)
+        return errors
+
+    def rebuild_rollups(self, drop_expired: bool = False) -> int:
+        # recompute the rollup index and sketch hashes from the raw events, e.g.
+        # after a change of their layout; sessions ingested meanwhile may be missed.
+        # Raw records expired by raw_ttl are gone, drop_expired leaves their
+        # sessions out of the rollups
+        if self.__raw_ttl and not drop_expired:
+            raise ValueError(
+                "Raw records expire after the raw record ttl, the sessions they "
+                "held would be removed from the rollups unless dropped"
+            )
+        cube = WriteBatch()
+        num_sessions = 0
+        for id, fields in self.__storage.iter_hashes(PREFIXES.ARCHIVED_ROLLUPS):
+            name = _decode(id)[len(PREFIXES.ARCHIVED_ROLLUPS) :]
+            cube.merge(
+                WriteBatch(hdeltas={name: {_decode(k): v for k, v in fields.items()}})
+            )
+        for _, v in self.__storage.iter_items(PREFIXES.ORIGINAL_EVENT):
+            playback_statistics = PlaybackStatistics(**self.__codec.decode(v))
+            cube.merge(
+                self._compose_aggregations(
+                    self._compose_key(playback_statistics), playback_statistics
+                )
+            )
+            num_sessions += 1
+        for prefix in DERIVED_HASH_PREFIXES:
+            self.__storage.replace_hashes(
+                prefix,
+                {k: v for k, v in cube.hdeltas.items() if k.startswith(prefix)},
+            )
+        self.__storage.write(
+            WriteBatch(hdeltas={PREFIXES.RESULT_VERSIONS.value: {"*": 1.0}})
+        )
+        return num_sessions
+
+    def compact_raw(
+        self,
+        older_than: float,
+        archive_dir: Optional[str] = None,
+        batch_size: int = 1000,
+    ) -> dict[str, int]:
+        # deletes the raw records of sessions older than older_than seconds,
+        # then appends them as JSON lines to a gzip file in archive_dir if
+        # given and folds them into the archived rollups; a record is dumped and
+        # folded only by the run that deleted it, so concurrent runs don't count
+        # it twice, and a run dying in between leaves it out of both
+        cutoff = (time.time() - older_than) * 1000
+        counts = {"records": 0, "bytes": 0, "dumped": 0}
+        dump_path = None
+        if archive_dir:
+            dump_path = os.path.join(
+                archive_dir,
+                f"ORGE-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.jsonl.gz",
+            )
+        expired = {}
+        for k, v in self.__storage.iter_items(PREFIXES.ORIGINAL_EVENT, batch_size):
+            record = self.__codec.decode(v)
+            if record["timestamp"] < cutoff:
+                expired[k] = (v, record)
+            if len(expired) >= batch_size:
+                self._compact_records(expired, counts, dump_path)
+                expired = {}
+        if expired:
+            self._compact_records(expired, counts, dump_path)
+        return counts
+
+    def reaggregate(
+        self,
+        processes: int = 1,
+        chunk_size: int = 1000,
+        archives: tuple[str, ...] = (),
+        drop_compacted: bool = False,
+        drop_expired: bool = False,
+    ) -> dict[str, int]:
+        # recomputes every AGGREGATION_PREFIXES key from the raw records, and
+        # from the dumps of compacted ones in archives, over processes workers;
+        # the result is written under STAGED_AGGREGATIONS and swapped in at
+        # once, sessions ingested meanwhile may be missed. Without archives,
+        # compacted sessions only remain in the archived rollups, which can't
+        # restore counters or time series: drop_compacted leaves them out, and
+        # drops the archived rollups with the same swap so that rebuild_rollups
+        # doesn't bring them back.
+        # Raw records expired by raw_ttl are gone, drop_expired leaves their
+        # sessions out of every aggregation
+        if self.__raw_ttl and not drop_expired:
+            raise ValueError(
+                "Raw records expire after the raw record ttl, the sessions they "
+                "held would be removed from the aggregations unless dropped"
+            )
+        if not archives and not drop_compacted:
+            if next(self.__storage.iter_hashes(PREFIXES.ARCHIVED_ROLLUPS), None):
+                raise ValueError(
+                    "Raw records were compacted, their archives are required to "
+                    "recompute the aggregations unless they are dropped"
+                )
+        cube, counts = WriteBatch(), {"sessions": 0, "keys": 0}
+        for batch, num_sessions in self._map_raw(
+            "_aggregate_records", processes, chunk_size, archives
+        ):
+            cube.merge(batch)
+            counts["sessions"] += num_sessions
+        cube.hdeltas.pop(PREFIXES.RESULT_VERSIONS.value, None)
+        self._stage(cube, chunk_size)
+        prefixes = AGGREGATION_PREFIXES
+        if not archives:
+            prefixes += (PREFIXES.ARCHIVED_ROLLUPS.value,)
+        counts["keys"] = self.__storage.swap_namespace(
+            PREFIXES.STAGED_AGGREGATIONS.value, prefixes
+        )
+        self.__storage.write(
+            WriteBatch(hdeltas={PREFIXES.RESULT_VERSIONS.value: {"*": 1.0}})
+        )
+        return counts
+
+    def export_raw(
+        self,
+        writer,
+        processes: int = 1,
+        chunk_size: int = 1000,
+        archives: tuple[str, ...] = (),
+    ) -> int:
+        # writes one SESSION_COLUMNS row per raw record, and per record of the
+        # dumps in archives, to writer (see omnimatsoo.export) in chunks
+        num_sessions = 0
+        for rows, _ in self._map_raw("_session_rows", processes, chunk_size, archives):
+            writer.write(rows)
+            num_sessions += len(rows)
+        return num_sessions
+
+    def _compact_records(
+        self,
+        records: dict[Union[str, bytes], tuple[Union[str, bytes], dict]],
+        counts: dict[str, int],
+        dump_path: Optional[str],
+    ):
+        deleted = self.__storage.delete(list(records))
+        if dump_path and deleted:
+            # one gzip member per batch, readable as a whole by gzip tools; only
+            # the records this run deleted, a concurrent run dumps the others
+            with gzip.open(dump_path, "ab") as dump:
+                for k in deleted:
+                    dump.write(self.__codec.to_json(records[k][0]).encode("utf-8"))
+                    dump.write(b"\n")
+            counts["dumped"] += len(deleted)
+        archived = WriteBatch()
+        for k in deleted:
+            playback_statistics = PlaybackStatistics(**records[k][1])
+            cube = self._compose_aggregations(
+                self._compose_key(playback_statistics), playback_statistics
+            )
+            for name, fields in cube.hdeltas.items():
+                if name.startswith(DERIVED_HASH_PREFIXES):
+                    archived.merge(
+                        WriteBatch(hdeltas={PREFIXES.ARCHIVED_ROLLUPS + name: fields})
+                    )
+        if archived:
+            self.__storage.write(archived)
+        counts["records"] += len(deleted)
+        counts["bytes"] += sum(deleted.values())
+
+    def _map_raw(
+        self, method: str, processes: int, chunk_size: int, archives: tuple[str, ...]
+    ) -> Iterator[tuple[Any, int]]:
+        # results of method over chunks of the raw records, then of the dumps
+        # in archives, with the number of records of each chunk, in no
+        # particular order; at most two chunks per process are pending
+        chunks = self._raw_chunks(chunk_size, archives)
+        if processes <= 1:
+            for records, encoded in chunks:
+                yield getattr(self, method)(records, encoded), len(records)
+            return
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_worker,
+            initargs=(self.__codec, self.__origin_rules),
+        ) as pool:
+            pending = set()
+            for records, encoded in chunks:
+                if len(pending) >= 2 * processes:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from (future.result() for future in done)
+                pending.add(pool.submit(_run_chunk, method, records, encoded))
+            yield from (future.result() for future in as_completed(pending))
+
+    def _raw_chunks(
+        self, chunk_size: int, archives: tuple[str, ...]
+    ) -> Iterator[tuple[list, bool]]:
+        # stored records are encoded by the codec, dumped ones are JSON lines
+        items = self.__storage.iter_items(PREFIXES.ORIGINAL_EVENT, chunk_size)
+        values = (v for _, v in items)
+        while chunk := list(islice(values, chunk_size)):
+            yield chunk, True
+        for path in archives:
+            with gzip.open(path, "rb") as dump:
+                while chunk := list(islice(dump, chunk_size)):
+                    yield chunk, False
+
+    def _decode_record(self, record: Union[str, bytes], encoded: bool) -> dict:
+        return self.__codec.decode(record) if encoded else json.loads(record)
+
+    def _aggregate_records(self, records: list, encoded: bool) -> WriteBatch:
+        cube = WriteBatch()
+        for record in records:
+            playback_statistics = PlaybackStatistics(
+                **self._decode_record(record, encoded)
+            )
+            cube.merge(
+                self._compose_aggregations(
+                    self._compose_key(playback_statistics), playback_statistics
+                )
+            )
+        return cube
+
+    def _session_rows(self, records: list, encoded: bool) -> list[tuple]:
+        rows = []
+        for record in records:
+            stats = PlaybackStatistics(**self._decode_record(record, encoded))
+            key = self._compose_key(stats)
+            targets = stats.events.first_timestamps(
+                ("loadstart", "loadeddata", "playing", "ended")
+            )
+            playable = played = None
+            if targets["loadstart"] and targets["loadeddata"]:
+                playable = float(targets["loadeddata"] - targets["loadstart"])
+            if targets["ended"] and targets["playing"]:
+                played = float(targets["ended"] - targets["playing"])
+            events = list(zip(stats.events.timestamps, stats.events.names()))
+            rows.append(
+                (
+                    stats.id,
+                    int(stats.timestamp),
+                    key.origin,
+                    key.device,
+                    key.video,
+                    stats.target,
+                    float(stats.duration),
+                    len(stats.events),
+                    playable,
+                    played,
+                    json.dumps(events, separators=(",", ":")),
+                )
+            )
+        return rows
+
+    def _stage(self, cube: WriteBatch, chunk_size: int):
+        # writes cube under STAGED_AGGREGATIONS, the time buckets with what
+        # would have been left of their ttl; leftovers of an interrupted run
+        # are deleted first
+        staging = PREFIXES.STAGED_AGGREGATIONS.value
+        self.__storage.delete(
+            [
+                *self.__storage.iter_keys(staging),
+                *(id for id, _ in self.__storage.iter_hashes(staging)),
+            ]
+        )
+        now, ttls = time.time(), {}
+        bucket_ttls = dict(TIME_BUCKETS)
+        for name in list(cube.hdeltas):
+            if not name.startswith(PREFIXES.TIME_SERIES):
+                continue
+            resolution, bucket = map(int, name.split(":")[1:3])
+            if not (ttl := bucket_ttls[resolution]):
+                continue
+            if (left := int(bucket + resolution + ttl - now)) > 0:
+                ttls[name] = left
+            else:
+                del cube.hdeltas[name]
+        names = [*cube.deltas, *cube.hdeltas]
+        for start in range(0, len(names), chunk_size):
+            batch = WriteBatch()
+            for name in names[start : start + chunk_size]:
+                if name in cube.deltas:
+                    batch.deltas[staging + name] = cube.deltas[name]
+                else:
+                    batch.hdeltas[staging + name] = cube.hdeltas[name]
+                if name in ttls:
+                    batch.ttls[staging + name] = ttls[name]
+            self.__storage.write(batch)
+
+    def _compose_writes(self, playback_statistics: PlaybackStatistics) -> WriteBatch:
         key = self._compose_key(playback_statistics)
-        self.__storage.set(
-            f"{PREFIXES.ORIGINAL_EVENT}{key}", serialize_dataclass(playback_statistics)
+        raw_key = PREFIXES.ORIGINAL_EVENT + str(key)
+        with stage("encode"):
+            record = self.__codec.encode(playback_statistics)
+        batch = WriteBatch(sets={raw_key: record})
+        if self.__raw_ttl:
+            batch.ttls[raw_key] = self.__raw_ttl
+        return batch.merge(self._compose_aggregations(key, playback_statistics))
+
+    def _compose_aggregations(
+        self, key: RecordKey, playback_statistics: PlaybackStatistics
+    ) -> WriteBatch:
+        batch = WriteBatch()
+        batch.merge(
+            self._aggr_hist(
+                key=key.leveled_key(3), playback_events=playback_statistics.events
+            )
         )
-        self._aggr_hist(
-            key=key.leveled_key(3), playback_events=playback_statistics.events
+        batch.merge(
+            self._aggr_playback(
+                key=key.leveled_key(3),
+                playback_events=playback_statistics.events,
+                duration=playback_statistics.duration,
+            )
         )
-        self._aggr_playback(
-            key=key.leveled_key(3),
-            playback_events=playback_statistics.events,
-            duration=playback_statistics.duration,
+        return self._with_time_buckets(
+            batch, key.leveled_key(3), playback_statistics.timestamp
         )
 
+    def _with_time_buckets(
+        self, batch: WriteBatch, key: str, timestamp_ms: int
+    ) -> WriteBatch:
+        # every "<prefix><key>" counter delta also goes to the bucket of each
+        # resolution the session timestamp falls in
+        timestamp = int(timestamp_ms) // 1000
+        for resolution, ttl in TIME_BUCKETS:
+            bucket = timestamp - timestamp % resolution
+            for key_name, delta in batch.deltas.items():
+                name = self._series_name(resolution, bucket, key_name[: -len(key)])
+                batch.hdeltas[name] = {key: delta}
+                if ttl:
+                    batch.ttls[name] = ttl
+        return batch
+
     def list_all(self) -> list:
-        items = self.__storage.get_items()
-        if not items:
-            return items
-        k, v = items.popitem()
-        items[k] = v
-        is_bytes = hasattr(k, "decode")
+        return dict(map(self._render_item, self.__storage.get_items().items()))
+
+    def list_page(
+        self, cursor: Optional[str] = None, limit: int = 1000
+    ) -> tuple[Optional[str], dict]:
+        next_cursor, items = self.__storage.scan_items("", cursor, limit)
+        return next_cursor, dict(map(self._render_item, items.items()))
 
-        if not is_bytes:
-            return items
-        return {k.decode("utf-8"): v.decode("utf-8") for k, v in items.items()}
+    def iter_all(self, batch_size: int = 1000) -> Iterator[dict]:
+        # pages of at most batch_size records, memory stays bounded by one page
+        page = {}
+        for item in self.__storage.iter_items("", batch_size):
+            k, v = self._render_item(item)
+            page[k] = v
+            if len(page) >= batch_size:
+                yield page
+                page = {}
+        if page:
+            yield page
+
+    def _render_item(self, item: tuple) -> tuple[str, Any]:
+        # raw records are shown as their JSON text whatever they are stored as
+        k, v = _decode(item[0]), item[1]
+        if k.startswith(PREFIXES.ORIGINAL_EVENT):
+            return k, self.__codec.to_json(v)
+        return k, _decode(v)
+
+    def cached_aggregation(self, handler_name: str, **kwargs) -> CachedResult:
+        # result of one of the group_by_nodes_* handlers with an etag, reused
+        # until a write touches one of the prefixes it reads
+        if handler_name == "group_by_nodes_num_events":
+            prefixes = (
+                PREFIXES.AGGREGATION_EVENTS_HISTOGRAM + kwargs["event_name"] + ":",
+            )
+        else:
+            prefixes = RESULT_PREFIXES[handler_name]
+        versions = {
+            _decode(k): v
+            for k, v in self.__storage.get_hash(PREFIXES.RESULT_VERSIONS).items()
+        }
+        version = tuple(float(versions.get(p, 0)) for p in ("*", *prefixes))
+        key = (
+            handler_name,
+            *((k, tuple(v) if isinstance(v, list) else v) for k, v in kwargs.items()),
+        )
+        if self.__result_cache and (cached := self.__result_cache.get(key, version)):
+            return cached
+        with stage("aggregate", handler=handler_name):
+            value = getattr(self, handler_name)(**kwargs)
+        result = CachedResult(
+            etag=blake2b(repr((key, version)).encode(), digest_size=8).hexdigest(),
+            value=value,
+        )
+        if self.__result_cache:
+            self.__result_cache.put(key, version, result)
+        return result
 
     def group_by_nodes_playable(self, nodes: list[int]) -> dict[str, float]:
         return self._fraction_aggretation(
-            fetch_prefix=PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS[:-3],
-            dividend_prefix=PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SUM[:-1],
-            divisor_prefix=PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS[:-1],
+            dividend_prefix=PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SUM,
+            divisor_prefix=PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS,
             nodes=nodes,
         )
 
     def group_by_nodes_playback_duration(self, nodes: list[int]) -> dict[str, float]:
         return self._fraction_aggretation(
-            fetch_prefix=PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM[:-3],
-            dividend_prefix=PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_ACTUAL_SUM[
-                :-1
-            ],
-            divisor_prefix=PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM[:-1],
+            dividend_prefix=PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_ACTUAL_SUM,
+            divisor_prefix=PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM,
             nodes=nodes,
         )
 
+    def series_by_nodes_playable(
+        self, nodes: list[int], start: int, end: int, step: int
+    ) -> dict[str, list]:
+        return self._fraction_series(
+            dividend_prefix=PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SUM,
+            divisor_prefix=PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS,
+            nodes=nodes,
+            time_range=(start, end, step),
+        )
+
+    def series_by_nodes_playback_duration(
+        self, nodes: list[int], start: int, end: int, step: int
+    ) -> dict[str, list]:
+        return self._fraction_series(
+            dividend_prefix=PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_ACTUAL_SUM,
+            divisor_prefix=PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM,
+            nodes=nodes,
+            time_range=(start, end, step),
+        )
+
+    def series_by_nodes_num_events(
+        self, event_name: str, nodes: list[int], start: int, end: int, step: int
+    ) -> dict[str, list]:
+        (series,) = self._series(
+            [PREFIXES.AGGREGATION_EVENTS_HISTOGRAM + event_name + ":"],
+            nodes,
+            (start, end, step),
+        )
+        return {
+            k: [[t, int(v)] for t, v in sorted(windows.items())]
+            for k, windows in series.items()
+        }
+
+    def group_by_nodes_playable_quantiles(
+        self, nodes: list[int], quantiles: list[float]
+    ) -> dict[str, dict[float, float]]:
+        return self._quantile_aggregation(
+            PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SKETCH, nodes, quantiles
+        )
+
+    def group_by_nodes_playback_duration_quantiles(
+        self, nodes: list[int], quantiles: list[float]
+    ) -> dict[str, dict[float, float]]:
+        return self._quantile_aggregation(
+            PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_SKETCH, nodes, quantiles
+        )
+
     def group_by_nodes_num_events(
         self, event_name: str, nodes: list[int]
     ) -> dict[str, int]:
-        if not (
-            pairs := self.__storage.get_items(
-                f"{PREFIXES.AGGREGATION_EVENTS_HISTOGRAM}{event_name}"
-            )
-        ):
-            return {}
-        k, v = pairs.popitem()
-        pairs[k] = v
-        IS_SOURCE_BYTES = hasattr(k, "decode")
-        bucket = {}
-        for k, v in pairs.items():
-            if IS_SOURCE_BYTES:
-                k = k.decode("utf-8")
-            total_nodes = k.split(":")
-            node_key = ":".join(total_nodes[node_idx + 2] for node_idx in nodes)
-            bucket[node_key] = bucket.get(node_key, 0) + int(v)
-        return bucket
+        groups = self._group_index(
+            [PREFIXES.AGGREGATION_EVENTS_HISTOGRAM + event_name + ":"], nodes
+        )
+        return {k: int(v) for k, (v,) in groups.items()}
 
     def _fraction_aggretation(
         self,
-        fetch_prefix: str,
         dividend_prefix: str,
         divisor_prefix: str,
         nodes: list[int],
     ):
-        if not (pairs := self.__storage.get_items(fetch_prefix)):
-            return {}
-        k, v = pairs.popitem()
-        pairs[k] = v
-        IS_SOURCE_BYTES = hasattr(k, "decode")
-        buckets = {
-            dividend_prefix: {},
-            divisor_prefix: {},
+        groups = self._group_index([dividend_prefix, divisor_prefix], nodes)
+        with stage("bucketing"):
+            return {
+                k: dividend / divisor
+                for k, (dividend, divisor) in groups.items()
+                if divisor
+            }
+
+    def _fraction_series(
+        self,
+        dividend_prefix: str,
+        divisor_prefix: str,
+        nodes: list[int],
+        time_range: tuple[int, int, int],
+    ) -> dict[str, list]:
+        dividends, divisors = self._series(
+            [dividend_prefix, divisor_prefix], nodes, time_range
+        )
+        # windows without a divisor are skipped, as groups are by
+        # _fraction_aggretation, e.g. when sessions of duration 0 are all a
+        # window has
+        series = {
+            k: [
+                [t, dividends.get(k, {}).get(t, 0.0) / v]
+                for t, v in sorted(w.items())
+                if v
+            ]
+            for k, w in divisors.items()
         }
+        return {k: windows for k, windows in series.items() if windows}
+
+    def _series(
+        self, prefixes: list[str], nodes: list[int], time_range: tuple[int, int, int]
+    ) -> list[dict[str, dict[int, float]]]:
+        # merges the time buckets within [start, end) into windows aligned to
+        # multiples of step, per node group and prefix
+        self._check_nodes(nodes)
+        start, end, step = time_range
+        resolution = self._series_resolution(start, step)
+        buckets = range(start - start % resolution, end, resolution)
+        if len(buckets) * len(prefixes) > MAX_SERIES_BUCKETS:
+            raise ValueError(f"Time range spans more than {MAX_SERIES_BUCKETS} buckets")
+        names = [
+            self._series_name(resolution, bucket, prefix)
+            for prefix in prefixes
+            for bucket in buckets
+        ]
+        hashes = iter(self.__storage.get_hashes(names))
+        ret = []
+        with stage("bucketing"):
+            for _ in prefixes:
+                series = {}
+                for bucket in buckets:
+                    window = bucket - bucket % step
+                    for k, v in next(hashes).items():
+                        total_nodes = _decode(k).split(":")
+                        node_key = ":".join(total_nodes[idx] for idx in nodes)
+                        windows = series.setdefault(node_key, {})
+                        windows[window] = windows.get(window, 0.0) + float(v)
+                ret.append(series)
+        return ret
+
+    def _series_resolution(self, start: int, step: int) -> int:
+        # the coarsest bucket size dividing step whose buckets are still kept
+        for resolution, ttl in reversed(TIME_BUCKETS):
+            if step % resolution:
+                continue
+            if ttl and start < time.time() - ttl:
+                raise ValueError(f"{resolution}s buckets are only kept for {ttl}s")
+            return resolution
+        raise ValueError(f"Step must be a multiple of {TIME_BUCKETS[0][0]}s")
+
+    def _series_name(self, resolution: int, bucket: int, prefix: str) -> str:
+        return PREFIXES.TIME_SERIES + f"{resolution}:{bucket}:" + prefix
 
-        for k, v in pairs.items():
-            if IS_SOURCE_BYTES:
-                k = k.decode("utf-8")
-            total_nodes = k.split(":")
-            node_key = ":".join(total_nodes[node_idx + 1] for node_idx in nodes)
-            bucket = buckets.get(total_nodes[0])
-            if bucket is None:
-                raise ValueError(f'Malformed key found: "{k}"')
-            bucket[node_key] = bucket.get(node_key, 0.0) + float(v)
+    def _quantile_aggregation(
+        self, sketch_name: str, nodes: list[int], quantiles: list[float]
+    ) -> dict[str, dict[float, float]]:
+        self._check_nodes(nodes)
+        # merge the histograms of every origin:device:video into its node group
+        merged = {}
+        for k, (v,) in self.__storage.group_hashes([sketch_name], nodes).items():
+            node_key, _, bucket = _decode(k).rpartition("|")
+            merged.setdefault(node_key, {})[int(bucket)] = v
         return {
-            k: buckets[dividend_prefix][k] / v
-            for k, v in buckets[divisor_prefix].items()
+            k: self.__sketch.quantiles(counts, quantiles)
+            for k, counts in merged.items()
         }
 
-    def _aggr_hist(self, key, playback_events):
+    def _check_nodes(self, nodes: list[int]):
+        if not nodes or any(not 0 <= node_idx < ROLLUP_NODES for node_idx in nodes):
+            raise IndexError(f"Node index out of range: {nodes}")
+
+    def _group_index(
+        self, prefixes: list[str], nodes: list[int]
+    ) -> dict[str, list[float]]:
+        # per group of nodes, one sum per prefix read from the rollup index of
+        # the node subset; the storage only re-orders the group nodes when they
+        # aren't asked in ascending order
+        self._check_nodes(nodes)
+        subset = tuple(sorted(set(nodes)))
+        positions = [subset.index(node_idx) for node_idx in nodes]
+        groups = self.__storage.group_hashes(
+            [self._index_name(prefix, subset) for prefix in prefixes],
+            positions if positions != list(range(len(subset))) else None,
+        )
+        return {_decode(k): v for k, v in groups.items()}
+
+    def _index_name(self, prefix: str, subset: tuple) -> str:
+        return PREFIXES.ROLLUP_INDEX + prefix + ",".join(map(str, subset))
+
+    def _aggr_hist(self, key, playback_events) -> WriteBatch:
         to_update = {}
-        for evt_name, times in Counter(evt.type for evt in playback_events).items():
+        for evt_name, times in playback_events.counts().items():
             key_name = PREFIXES.AGGREGATION_EVENTS_HISTOGRAM + evt_name + ":" + key
             to_update[key_name] = float(times)
-        self.__storage.mupdate(to_update)
+        return self._with_index(key, to_update)
 
-    def _aggr_playback(self, key, playback_events, duration):
-        targets = {"loadstart": 0, "loadeddata": 0, "playing": 0, "ended": 0}
-        for evt in playback_events:
-            if evt.type in targets and not targets[evt.type]:
-                targets[evt.type] = evt.timestamp
-        to_update = {}
+    def _aggr_playback(self, key, playback_events, duration) -> WriteBatch:
+        targets = playback_events.first_timestamps(
+            ("loadstart", "loadeddata", "playing", "ended")
+        )
+        to_update, sketches = {}, {}
         if targets["loadstart"] and targets["loadeddata"]:
             to_update[PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS + key] = 1.0
             to_update[PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SUM + key] = float(
                 targets["loadeddata"] - targets["loadstart"]
             )
+            sketches[PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_SKETCH] = float(
+                targets["loadeddata"] - targets["loadstart"]
+            )
 
         if targets["ended"] and targets["playing"]:
             to_update[PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_VIDEO_SUM + key] = (
@@ -177,36 +864,150 @@ class PlaybackBenchmark:
             to_update[
                 PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_ACTUAL_SUM + key
             ] = (targets["ended"] - targets["playing"])
+            if duration > 0:
+                sketches[PREFIXES.AGGREGATION_ACTUAL_PLAYBACK_DURATION_SKETCH] = (
+                    targets["ended"] - targets["playing"]
+                ) / (duration * 1000)
 
-        self.__storage.mupdate(to_update)
+        batch = self._with_index(key, to_update)
+        for sketch_name, value in sketches.items():
+            batch.hdeltas[sketch_name] = {f"{key}|{self.__sketch.bucket(value)}": 1.0}
+        return batch
+
+    def _with_index(self, key: str, to_update: dict[str, float]) -> WriteBatch:
+        # mirror every "<prefix><key>" counter into the rollup index hashes of
+        # its prefix, one per node subset, so a query reads a single hash
+        # holding exactly the groups it returns
+        key_nodes = key.split(":")
+        subset_keys = [
+            (subset, ":".join(key_nodes[node_idx] for node_idx in subset))
+            for subset in ROLLUP_SUBSETS
+        ]
+        hdeltas, versions = {}, {}
+        for key_name, delta in to_update.items():
+            prefix = key_name[: -len(key)]
+            for subset, subset_key in subset_keys:
+                hdeltas[self._index_name(prefix, subset)] = {subset_key: delta}
+            versions[prefix] = 1.0
+        if versions:
+            hdeltas[PREFIXES.RESULT_VERSIONS.value] = versions
+        return WriteBatch(deltas=to_update, hdeltas=hdeltas)
 
     def _compose_key(self, playback_statistics: PlaybackStatistics) -> RecordKey:
-        url_segments = urlsplit(playback_statistics.target)
+        return self._resolve_key(
+            playback_statistics.target, playback_statistics.device_tag
+        ).with_id(playback_statistics.id)
+
+    def _resolve_key(self, target: str, device_tag: str) -> RecordKey:
+        url_segments = urlsplit(target)
         tag = self._get_origin_tag(url_segments.netloc)
         test_video_name = url_segments.path.rstrip("/").rsplit("/", 1)[1]
-        return RecordKey(
-            origin=tag,
-            video=test_video_name,
-            device=playback_statistics.device_tag,
-            id=playback_statistics.id,
-        )
+        return RecordKey(origin=tag, video=test_video_name, device=device_tag, id="")
 
     def _get_origin_tag(self, netloc: str) -> str:
-        if netloc.endswith("s3.amazonaws.com"):
-            return PREFIXES.S3.value
-        elif netloc.endswith("cloudfront.net"):
-            return PREFIXES.CloudFront.value
-        else:
-            return PREFIXES.Edge.value
+        return self.__origin_rules.match(netloc)
+
+
+class Compactor:
+    # Runs PlaybackBenchmark.compact_raw every interval seconds in a background
+    # thread, raw records of sessions older than older_than seconds are folded
+    # into the archived rollups and deleted, and dumped to archive_dir if set.
+    # Without background only run_once compacts, e.g. in all but one worker.
+    # counters add up every run: records deleted and bytes reclaimed.
+    def __init__(
+        self,
+        service: PlaybackBenchmark,
+        older_than: float,
+        interval: float = 3600.0,
+        archive_dir: Optional[str] = None,
+        batch_size: int = 1000,
+        background: bool = True,
+    ):
+        self.service = service
+        self.older_than = older_than
+        self.interval = interval
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.counters = {
+            "runs": 0,
+            "run_errors": 0,
+            "compacted_records": 0,
+            "dumped_records": 0,
+            "reclaimed_bytes": 0,
+        }
+        self._closed = threading.Event()
+        self._runner = None
+        if background:
+            self._runner = threading.Thread(
+                target=self._run, name="compact", daemon=True
+            )
+            self._runner.start()
+            atexit.register(self.close)
+
+    def run_once(self) -> dict[str, int]:
+        try:
+            counts = self.service.compact_raw(
+                self.older_than, self.archive_dir, self.batch_size
+            )
+        except Exception:
+            self.counters["run_errors"] += 1
+            raise
+        self.counters["runs"] += 1
+        self.counters["compacted_records"] += counts["records"]
+        self.counters["dumped_records"] += counts["dumped"]
+        self.counters["reclaimed_bytes"] += counts["bytes"]
+        return counts
+
+    def close(self):
+        self._closed.set()
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            try:
+                counts = self.run_once()
+            except Exception as ex:
+                logger.error(f"Unable to compact raw records: {ex}")
+                continue
+            if counts["records"]:
+                logger.info(
+                    f"Compacted {counts['records']} raw records,"
+                    f" reclaimed {counts['bytes']} bytes"
+                )
+
+
+# the service of a process pool worker of reaggregate and export_raw, composing
+# aggregations and rows off any storage
+_worker_service = None
+
+
+def _init_worker(record_codec: RecordCodec, origin_rules: OriginRules):
+    global _worker_service
+    Client.init(SUPPORTED.MEMORY)
+    _worker_service = PlaybackBenchmark(record_codec, origin_rules)
+
+
+def _run_chunk(method: str, records: list, encoded: bool) -> tuple[Any, int]:
+    return getattr(_worker_service, method)(records, encoded), len(records)
 
 
 class ServiceClients:
     __playback_benchmark = None
+    __compactor = None
 
     @classmethod
     def init_services(cls, *args, **kwargs):
         if not cls.__playback_benchmark:
-            cls.__playback_benchmark = PlaybackBenchmark()
+            cls.__playback_benchmark = PlaybackBenchmark(*args, **kwargs)
+
+    @classmethod
+    def init_compactor(cls, *args, **kwargs):
+        if not cls.__compactor:
+            cls.__compactor = Compactor(cls.__playback_benchmark, *args, **kwargs)
+
+    @classmethod
+    @property
+    def compactor(cls):
+        return cls.__compactor
 
     @classmethod
     @property
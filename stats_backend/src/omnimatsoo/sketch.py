@@ -0,0 +1,44 @@
+import math
+from typing import Iterable
+
+
+class LogHistogram:
+    # DDSketch-style log-bucketed histogram: bucket i counts the values within
+    # (gamma^(i-1), gamma^i], so any reported quantile is within
+    # relative_accuracy of the true one. Values are clamped to
+    # [min_value, max_value], which bounds the number of buckets per histogram.
+    # Histograms are plain {bucket: count} mappings and merge by summing counts.
+    def __init__(self, relative_accuracy: float = 0.01, min_value=1e-3, max_value=1e7):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.max_value = max_value
+
+    @property
+    def max_buckets(self) -> int:
+        return self.bucket(self.max_value) - self.bucket(self.min_value) + 1
+
+    def bucket(self, value: float) -> int:
+        value = min(max(value, self.min_value), self.max_value)
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def value(self, bucket: int) -> float:
+        return 2 * self.gamma**bucket / (self.gamma + 1)
+
+    def quantiles(
+        self, counts: dict[int, float], quantiles: Iterable[float]
+    ) -> dict[float, float]:
+        buckets = sorted(counts.items())
+        total = sum(count for _, count in buckets)
+        ret = {}
+        for q in quantiles:
+            if not total:
+                ret[q] = None
+                continue
+            rank, seen = q * (total - 1), 0.0
+            for bucket, count in buckets:
+                seen += count
+                if seen > rank:
+                    break
+            ret[q] = self.value(bucket)
+        return ret
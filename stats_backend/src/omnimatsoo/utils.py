@@ -2,11 +2,15 @@ from typing import Any
 import dataclasses
 import json
 
+from omnimatsoo.entities import EventColumns
+
 
 class DataclassJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if dataclasses.is_dataclass(obj):
             return dataclasses.asdict(obj)
+        if isinstance(obj, EventColumns):
+            return obj.to_dicts()
         return super().default(obj)
 
 
@@ -1,27 +1,130 @@
+import argparse
+import asyncio
 import logging
 import os
+import signal
 import sys
+from typing import Optional
 
 import tornado.log
 from tornado import httpserver, wsgi, ioloop
-from tornado.netutil import bind_unix_socket
+from tornado.netutil import bind_sockets, bind_unix_socket
 
 from omnimatsoo.app import create_app
+from omnimatsoo.kvstorage import Client
+
+SERVERS = ("wsgi", "native")
+
+logger = logging.getLogger("tornado.general")
 
 
 def start():
+    parser = argparse.ArgumentParser(prog="matsoogo")
+    parser.add_argument(
+        "--server",
+        choices=SERVERS,
+        default=os.environ.get("APP_SERVER") or "wsgi",
+        help="wsgi: Flask app in a WSGIContainer, which buffers whole responses "
+        "so /aggr/all/?format=ndjson is served a page at a time, "
+        "native: Tornado handlers with storage calls on a thread pool, "
+        "streaming /aggr/all/?format=ndjson",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("APP_WORKERS") or 1),
+        help="number of pre-forked worker processes, 0 for one per CPU",
+    )
+    parser.add_argument(
+        "--shutdown-grace",
+        type=float,
+        default=float(os.environ.get("APP_SHUTDOWN_GRACE") or 1.0),
+        help="seconds given to in-flight requests after SIGTERM",
+    )
+    args = parser.parse_args()
+
     for logger_name in ("tornado.general",):
         logger = logging.getLogger(logger_name)
         logger.propagate = False
         logger.setLevel(logging.INFO)
         logger.addHandler(logging.StreamHandler(sys.stdout))
 
-    app = create_app()
-    http_server = httpserver.HTTPServer(wsgi.WSGIContainer(app))
+    # sockets are bound once in the parent and shared by all workers, anything
+    # holding connections (storage clients, pools) is created after the fork
     if socket_path := os.environ.get("APP_SOCKET_PATH"):
-        socket = bind_unix_socket(socket_path)
-        http_server.add_socket(socket)
+        sockets = [bind_unix_socket(socket_path)]
     else:
-        port = os.environ.get("APP_PORT") or 5000
-        http_server.listen(port=port, address="0.0.0.0")
+        port = int(os.environ.get("APP_PORT") or 5000)
+        sockets = bind_sockets(port=port, address="0.0.0.0")
+    num_workers = args.workers or os.cpu_count() or 1
+    if num_workers > 1:
+        fork_workers(num_workers)
+
+    if args.server == "native":
+        from omnimatsoo.nativeapp import create_native_app
+
+        http_server = httpserver.HTTPServer(create_native_app())
+    else:
+        http_server = httpserver.HTTPServer(wsgi.WSGIContainer(create_app()))
+    http_server.add_sockets(sockets)
+    install_shutdown_handler(http_server, args.shutdown_grace)
     ioloop.IOLoop.current().start()
+
+
+def fork_workers(num_workers: int) -> Optional[int]:
+    # returns the worker id in the children; the parent supervises them,
+    # restarts crashed ones, forwards SIGTERM/SIGINT and exits once all are gone
+    children = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    def spawn(worker_id: int) -> bool:
+        if pid := os.fork():
+            children[pid] = worker_id
+            return False
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # read by init_clients, per-host background jobs only run in worker 0
+        os.environ["APP_WORKER_ID"] = str(worker_id)
+        return True
+
+    for worker_id in range(num_workers):
+        if spawn(worker_id):
+            return worker_id
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Started {num_workers} workers")
+
+    while children:
+        pid, status = os.wait()
+        if (worker_id := children.pop(pid, None)) is None:
+            continue
+        if stopping or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            logger.info(f"Worker {worker_id} (pid {pid}) exited")
+            continue
+        logger.warning(f"Worker {worker_id} (pid {pid}) died, restarting")
+        if spawn(worker_id):
+            return worker_id
+    sys.exit(0)
+
+
+def install_shutdown_handler(http_server: httpserver.HTTPServer, grace: float):
+    io_loop = ioloop.IOLoop.current()
+
+    async def shutdown():
+        http_server.stop()
+        await asyncio.sleep(grace)
+        await http_server.close_all_connections()
+        Client.close()
+        io_loop.stop()
+
+    def on_signal(signum, frame):
+        logger.info(f"Received signal {signum}, shutting down")
+        io_loop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, on_signal)
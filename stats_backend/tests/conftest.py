@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from omnimatsoo import kvstorage, services
+from omnimatsoo.app import create_app
+from omnimatsoo.kvstorage import SUPPORTED, Client
+
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    # a fresh storage for the services created by the test
+    monkeypatch.setattr(Client, "_Client__instance", None)
+    Client.init(SUPPORTED.MEMORY)
+    return Client.get()
+
+
+@pytest.fixture
+def make_redis_backend(monkeypatch):
+    # RedisBackends against fakeredis servers, by name, which run the Lua
+    # scripts with lupa
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    servers, backends = {}, []
+
+    def make(server: str = "default", **kwargs) -> kvstorage.RedisBackend:
+        fake = servers.setdefault(server, fakeredis.FakeServer())
+        monkeypatch.setattr(
+            kvstorage, "Redis", lambda connection_pool: fakeredis.FakeRedis(server=fake)
+        )
+        backends.append(backend := kvstorage.RedisBackend(**kwargs))
+        return backend
+
+    yield make
+    for backend in backends:
+        backend.close()
+
+
+@pytest.fixture
+def redis_backend(make_redis_backend):
+    return make_redis_backend()
+
+
+@pytest.fixture(params=["memory", "redis", "redis-watch"])
+def storage(request):
+    # the same calls are expected to give the same results on each backend
+    if request.param == "memory":
+        return kvstorage.MemoryBackend()
+    make = request.getfixturevalue("make_redis_backend")
+    if request.param == "redis-watch":
+        return make(transactions="watch")
+    return make()
+
+
+@pytest.fixture
+def clients(monkeypatch, tmp_path):
+    # what init_clients configures, from the APP_ environment set by the test
+    monkeypatch.setattr(kvstorage.Client, "_Client__instance", None)
+    monkeypatch.setattr(
+        services.ServiceClients, "_ServiceClients__playback_benchmark", None
+    )
+    monkeypatch.setattr(services.ServiceClients, "_ServiceClients__compactor", None)
+    monkeypatch.setenv("APP_STORAGE", "memory")
+    monkeypatch.delenv("APP_WORKER_ID", raising=False)
+    yield services.ServiceClients
+    if compactor := services.ServiceClients.compactor:
+        compactor.close()
+
+
+@pytest.fixture
+def client(clients):
+    app = create_app()
+    app.testing = True
+    return app.test_client()
+
+
+@pytest.fixture
+def native_fetch(clients):
+    # requests to the native Tornado application, served on a local port for
+    # the duration of each call
+    from omnimatsoo.nativeapp import create_native_app
+
+    app = create_native_app(executor_threads=2)
+
+    def fetch(path: str, **kwargs):
+        async def run():
+            sock, port = bind_unused_port()
+            server = HTTPServer(app)
+            server.add_sockets([sock])
+            try:
+                return await AsyncHTTPClient().fetch(
+                    f"http://127.0.0.1:{port}{path}", raise_error=False, **kwargs
+                )
+            finally:
+                server.stop()
+
+        return asyncio.run(run())
+
+    return fetch
+
+
+@pytest.fixture
+def make_session():
+    def make(i: int = 0, **overrides) -> dict:
+        fields = {
+            "id": f"{i:08x}",
+            "timestamp": 1700000000000 + i,
+            "target": "https://d111111abcdef8.cloudfront.net/v/a.mp4",
+            "duration": 60.0,
+            "events": [
+                [1.0, "loadstart"],
+                [10.0 + i, "loadeddata"],
+                [20.0, "playing"],
+                [50020.0, "ended"],
+            ],
+            "device_tag": "pixel",
+            "playbackquality": {
+                "samples": 0,
+                "creationTimes": [],
+                "droppedVideoFrames": [],
+                "totalVideoFrames": [],
+            },
+        }
+        fields.update(overrides)
+        return fields
+
+    return make
@@ -0,0 +1,125 @@
+import json
+import zlib
+
+import pytest
+
+from omnimatsoo import codec
+from omnimatsoo.codec import COMPRESSIONS, FORMATS, RecordCodec
+from omnimatsoo.entities import PlaybackStatistics
+
+
+def session(**overrides) -> dict:
+    fields = {
+        "id": "0001abcd",
+        "timestamp": 1700000000123,
+        "target": "https://d111111abcdef8.cloudfront.net/v/a.mp4",
+        "duration": 61.5,
+        "events": [
+            {"timestamp": 1.0, "type": "loadstart"},
+            {"timestamp": 12.5, "type": "loadeddata"},
+            {"timestamp": 20.25, "type": "playing"},
+            {"timestamp": 30.0, "type": "webkitcustom"},
+            {"timestamp": 900.0, "type": "ended"},
+        ],
+        "device_tag": "pixel-7",
+        "playbackquality": {
+            "samples": 2,
+            "creationTimes": [1000.0, 2000.0],
+            "droppedVideoFrames": [0, 3],
+            "totalVideoFrames": [30, 60],
+        },
+    }
+    fields.update(overrides)
+    return fields
+
+
+def available(format: str, compression: str) -> bool:
+    if format == "msgpack" and codec.msgpack is None:
+        return False
+    return compression != "zstd" or codec.zstandard is not None
+
+
+@pytest.mark.parametrize("compression", sorted(COMPRESSIONS))
+@pytest.mark.parametrize("format", sorted(FORMATS))
+def test_round_trip(format, compression):
+    if not available(format, compression):
+        pytest.skip(f"{format} with {compression} needs an optional dependency")
+    record = RecordCodec(format, compression).encode(PlaybackStatistics(**session()))
+    assert isinstance(record, bytes)
+    # any configuration decodes records written with any other
+    assert RecordCodec().decode(record) == session()
+
+
+def test_uncompressed_json_is_the_legacy_layout():
+    record = RecordCodec("json").encode(PlaybackStatistics(**session()))
+    assert json.loads(record) == session()
+
+
+def test_decodes_legacy_records():
+    legacy = json.dumps(session())
+    assert RecordCodec().decode(legacy) == session()
+    assert RecordCodec().decode(legacy.encode("utf-8")) == session()
+
+
+def test_packed_is_smaller_than_json():
+    stats = PlaybackStatistics(**session())
+    assert len(RecordCodec("packed").encode(stats)) < len(
+        RecordCodec("json").encode(stats)
+    )
+
+
+def test_zlib_record_layout():
+    record = RecordCodec("packed", "zlib").encode(PlaybackStatistics(**session()))
+    assert record[0] == FORMATS["packed"].ID | COMPRESSIONS["zlib"]
+    zlib.decompress(record[1:])
+
+
+def test_falls_back_to_json_for_values_packed_cant_hold():
+    fields = session(
+        playbackquality={
+            "samples": 1,
+            "creationTimes": [1.0],
+            "droppedVideoFrames": [0.5],
+            "totalVideoFrames": [30],
+        }
+    )
+    record = RecordCodec("packed", "zlib").encode(PlaybackStatistics(**fields))
+    assert record[0] == FORMATS["json"].ID | COMPRESSIONS["zlib"]
+    assert RecordCodec().decode(record) == fields
+
+
+def test_msgpack_falls_back_to_json():
+    pytest.importorskip("msgpack")
+    fields = session(timestamp=2**70)
+    record = RecordCodec("msgpack").encode(PlaybackStatistics(**fields))
+    assert record[0] == FORMATS["json"].ID
+    assert RecordCodec().decode(record) == fields
+
+
+def test_missing_optional_dependencies(monkeypatch):
+    monkeypatch.setattr(codec, "msgpack", None)
+    monkeypatch.setattr(codec, "zstandard", None)
+    with pytest.raises(ValueError, match="requires msgpack"):
+        RecordCodec("msgpack")
+    with pytest.raises(ValueError, match="requires zstandard"):
+        RecordCodec("packed", "zstd")
+    with pytest.raises(ValueError, match="requires zstandard"):
+        RecordCodec().decode(bytes((FORMATS["packed"].ID | COMPRESSIONS["zstd"],)))
+
+
+@pytest.mark.parametrize("format, compression", [("avro", "none"), ("json", "lz4")])
+def test_unsupported_configuration(format, compression):
+    with pytest.raises(ValueError, match="Unsupported"):
+        RecordCodec(format, compression)
+
+
+def test_unknown_version():
+    with pytest.raises(ValueError, match="Unknown record version"):
+        RecordCodec().decode(b"\x0f")
+
+
+def test_to_json():
+    packed = RecordCodec("packed", "zlib").encode(PlaybackStatistics(**session()))
+    assert json.loads(RecordCodec().to_json(packed)) == session()
+    legacy = json.dumps(session())
+    assert RecordCodec().to_json(legacy.encode("utf-8")) == legacy
@@ -0,0 +1,68 @@
+import json
+
+from omnimatsoo import nativeapp
+from omnimatsoo.handlers import collect
+
+
+def ndjson(*lines) -> bytes:
+    return "\n".join(
+        line if isinstance(line, str) else json.dumps(line) for line in lines
+    ).encode()
+
+
+def test_batch_statuses_by_position(client, make_session):
+    missing_field = make_session(3)
+    del missing_field["target"]
+    bad_event = make_session(4, events=[[1.0, 5]])
+    body = ndjson(
+        make_session(0), "{not json", missing_field, "", bad_event, make_session(2)
+    )
+    response = client.post("/collect/batch/", data=body)
+    assert response.status_code == 200
+    result = response.get_json()
+    assert (result["accepted"], result["rejected"]) == (2, 3)
+    assert [r["status"] for r in result["results"]] == [
+        "accepted",
+        "rejected",
+        "rejected",
+        "rejected",
+        "accepted",
+    ]
+    assert all(r["error"] for r in result["results"] if r["status"] == "rejected")
+    # only the accepted sessions are aggregated
+    response = client.get("/aggr/playable-latency/0/")
+    assert response.get_json() == {"CloudFront": 10.0}
+
+
+def test_batch_json_array(client, make_session):
+    body = json.dumps([make_session(0), 5, make_session(1)])
+    result = client.post("/collect/batch/", data=body).get_json()
+    assert [r["status"] for r in result["results"]] == [
+        "accepted",
+        "rejected",
+        "accepted",
+    ]
+
+
+def test_bad_batch(client, monkeypatch, make_session):
+    response = client.post("/collect/batch/", data=b"[{not json")
+    assert response.status_code == 400
+    monkeypatch.setattr(collect, "MAX_BATCH_ITEMS", 2)
+    body = ndjson(make_session(0), make_session(1), make_session(2))
+    assert client.post("/collect/batch/", data=body).status_code == 413
+    assert client.get("/aggr/all/").get_json() == {}
+
+
+def test_native_batch(native_fetch, monkeypatch, make_session):
+    body = ndjson(make_session(0), "{not json", make_session(2))
+    response = native_fetch("/collect/batch/", method="POST", body=body)
+    assert response.code == 200
+    result = json.loads(response.body)
+    assert [r["status"] for r in result["results"]] == [
+        "accepted",
+        "rejected",
+        "accepted",
+    ]
+    monkeypatch.setattr(nativeapp, "MAX_BATCH_ITEMS", 2)
+    response = native_fetch("/collect/batch/", method="POST", body=body + b"\n{}")
+    assert response.code == 413
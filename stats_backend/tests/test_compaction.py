@@ -0,0 +1,72 @@
+import gzip
+import time
+
+import pytest
+
+from omnimatsoo.app import init_clients
+from omnimatsoo.entities import PlaybackStatistics
+from omnimatsoo.kvstorage import WriteBatch
+from omnimatsoo.services import PREFIXES, PlaybackBenchmark
+from util import hashes, items, text
+
+
+def add_old_sessions(service, make_session, num: int):
+    old = int((time.time() - 10 * 86400) * 1000)
+    for i in range(num):
+        service.add(PlaybackStatistics(**make_session(i, timestamp=old + i)))
+
+
+def test_compaction_dumps_only_what_it_deleted(memory_storage, make_session, tmp_path):
+    service = PlaybackBenchmark()
+    add_old_sessions(service, make_session, 10)
+    delete = memory_storage.delete
+
+    def concurrent_delete(ids):
+        # another run deleted half of the batch first
+        delete(ids[::2])
+        return delete(ids)
+
+    memory_storage.delete = concurrent_delete
+    counts = service.compact_raw(86400, str(tmp_path), batch_size=4)
+    (dump,) = tmp_path.iterdir()
+    with gzip.open(dump) as f:
+        lines = f.read().splitlines()
+    assert counts["records"] == counts["dumped"] == len(lines) == 5
+    assert not memory_storage.get_keys(PREFIXES.ORIGINAL_EVENT)
+
+
+def test_rebuild_rollups_refuses_with_a_raw_ttl(memory_storage, make_session):
+    service = PlaybackBenchmark(raw_ttl=86400 * 30)
+    add_old_sessions(service, make_session, 3)
+    before = service.group_by_nodes_num_events("playing", [0])
+    assert before == {"CloudFront": 3}
+    with pytest.raises(ValueError, match="raw record ttl"):
+        service.rebuild_rollups()
+    assert service.group_by_nodes_num_events("playing", [0]) == before
+    assert service.rebuild_rollups(drop_expired=True) == 3
+
+
+def test_raw_ttl_must_outlive_the_retention(clients, monkeypatch):
+    monkeypatch.setenv("APP_RAW_RECORD_TTL", "3600")
+    monkeypatch.setenv("APP_RAW_RETENTION", "3600")
+    with pytest.raises(ValueError, match="APP_RAW_RETENTION"):
+        init_clients()
+
+
+@pytest.mark.parametrize(
+    "worker_id, background", [(None, True), ("0", True), ("3", False)]
+)
+def test_compactor_runs_in_one_worker(clients, monkeypatch, worker_id, background):
+    monkeypatch.setenv("APP_RAW_RETENTION", "3600")
+    if worker_id is not None:
+        monkeypatch.setenv("APP_WORKER_ID", worker_id)
+    init_clients()
+    assert (clients.compactor._runner is not None) == background
+
+
+def test_delete(storage):
+    storage.write(WriteBatch(sets={"ORGE:1": b"12345"}, hdeltas={"IDX:0": {"a": 1.0}}))
+    deleted = storage.delete(["ORGE:1", "IDX:0", "missing"])
+    assert {text(k): v for k, v in deleted.items()} == {"ORGE:1": 5, "IDX:0": 0}
+    assert not items(storage, "ORGE:") and not hashes(storage, "IDX:")
+    assert storage.delete(["ORGE:1"]) == {}
@@ -0,0 +1,46 @@
+import pytest
+
+from omnimatsoo.kvstorage import WriteBatch
+from util import text
+
+
+@pytest.mark.parametrize(
+    "nodes, expected",
+    [
+        (None, {"S3:pixel:v1": [3.0, 1.0], "S3:ios:v1|x": [1.0, 2.0]}),
+        ([0], {"S3": [3.0, 1.0], "S3|x": [1.0, 2.0]}),
+        ([1, 0], {"pixel:S3": [3.0, 1.0], "ios:S3|x": [1.0, 2.0]}),
+        ([2], {"v1": [3.0, 1.0], "v1|x": [1.0, 2.0]}),
+    ],
+)
+def test_group_hashes(storage, nodes, expected):
+    storage.write(
+        WriteBatch(
+            hdeltas={
+                "IDX:S": {"S3:pixel:v1": 3.0, "S3:ios:v1|x": 1.0},
+                "IDX:C": {"S3:pixel:v1": 1.0, "S3:ios:v1|x": 2.0},
+            }
+        )
+    )
+    grouped = storage.group_hashes(["IDX:S", "IDX:C", "IDX:missing"], nodes)
+    assert {text(k): v[:2] for k, v in grouped.items()} == expected
+    assert all(v[2] == 0.0 for v in grouped.values())
+
+
+def test_group_hashes_sums_groups(storage):
+    storage.write(
+        WriteBatch(hdeltas={"IDX:S": {"S3:pixel": 1.0, "S3:ios": 2.0, "CF:ios": 4.0}})
+    )
+    grouped = storage.group_hashes(["IDX:S"], [0])
+    assert {text(k): v for k, v in grouped.items()} == {"S3": [3.0], "CF": [4.0]}
+
+
+def test_group_hashes_of_missing_hashes(storage):
+    assert storage.group_hashes(["IDX:missing"]) == {}
+    assert storage.group_hashes(["IDX:missing"], [0]) == {}
+
+
+def test_group_hashes_with_nodes_past_the_field(storage):
+    storage.write(WriteBatch(hdeltas={"IDX:S": {"S3:pixel": 1.0}}))
+    grouped = storage.group_hashes(["IDX:S"], [0, 3])
+    assert {text(k): v for k, v in grouped.items()} == {"S3:": [1.0]}
@@ -0,0 +1,37 @@
+from omnimatsoo.kvstorage import WriteBatch
+from util import hashes, text
+
+KEYS = [f"ORGE:{i:03d}" for i in range(25)]
+
+
+def test_iter_items_pages(storage):
+    storage.mset(KEYS, [b"v"] * 25)
+    storage.set("OTHER:0", b"v")
+    assert sorted(text(k) for k, _ in storage.iter_items("ORGE:", 7)) == KEYS
+    assert sorted(map(text, storage.iter_keys("ORGE:", 7))) == KEYS
+
+
+def test_scan_items_cursor(storage):
+    storage.mset(KEYS, [b"v"] * 25)
+    cursor, seen = None, {}
+    while True:
+        cursor, page = storage.scan_items("ORGE:", cursor, 10)
+        seen.update(page)
+        if cursor is None:
+            break
+    assert sorted(map(text, seen)) == KEYS
+
+
+def test_iter_hashes(storage):
+    storage.write(
+        WriteBatch(hdeltas={f"IDX:{i:02d}": {"a": float(i)} for i in range(12)})
+    )
+    storage.set("IDX:plain", b"v")
+    assert hashes(storage, "IDX:") == {
+        f"IDX:{i:02d}": {"a": float(i)} for i in range(12)
+    }
+
+
+def test_empty_prefix(storage):
+    assert list(storage.iter_items("ORGE:")) == []
+    assert list(storage.iter_keys("ORGE:")) == []
@@ -0,0 +1,172 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from omnimatsoo.kvstorage import LocalBackend, WriteBatch
+
+
+def logs(directory) -> list[str]:
+    return sorted(name for name in os.listdir(directory) if name.startswith("log."))
+
+
+def counter(storage: LocalBackend, id: str) -> float:
+    return float(storage.get_items(id).get(id, 0.0))
+
+
+def test_reopen_replays_the_log(tmp_path):
+    storage = LocalBackend(tmp_path)
+    storage.set("ORGE:1", b"raw")
+    storage.write(WriteBatch(deltas={"AGGR:a": 1.5}, hdeltas={"IDX:0": {"a": 1.0}}))
+    storage.mupdate({"AGGR:a": 1.0})
+    storage.delete(["ORGE:1"])
+    storage.close()
+
+    reopened = LocalBackend(tmp_path)
+    assert reopened.get_items("") == {"AGGR:a": 2.5}
+    assert reopened.get_hash("IDX:0") == {"a": 1.0}
+    assert reopened.counters["replayed"] == 4
+    reopened.close()
+
+
+def test_reopen_loads_the_snapshot(tmp_path):
+    storage = LocalBackend(tmp_path, snapshot_bytes=1024)
+    for i in range(100):
+        storage.mupdate({"AGGR:a": 1.0, f"AGGR:{i}": float(i)})
+    assert storage.counters["snapshots"] > 0
+    assert len(logs(tmp_path)) == 1
+    storage.close()
+
+    reopened = LocalBackend(tmp_path, snapshot_bytes=1024)
+    assert counter(reopened, "AGGR:a") == 100.0
+    assert counter(reopened, "AGGR:99") == 99.0
+    assert reopened.counters["replayed"] < 100
+    reopened.close()
+
+
+@pytest.mark.parametrize(
+    "tail",
+    [
+        # a header cut short, a record cut short, a record with a bad crc
+        b"\x10\x00\x00",
+        LocalBackend.FRAME.pack(64, 0) + b"partial",
+        LocalBackend.FRAME.pack(4, 0) + b"junk",
+    ],
+)
+def test_truncates_a_torn_record(tmp_path, tail):
+    storage = LocalBackend(tmp_path)
+    storage.mupdate({"AGGR:a": 1.0})
+    storage.set("ORGE:1", b"raw")
+    storage.close()
+    (log,) = logs(tmp_path)
+    size = os.path.getsize(tmp_path / log)
+    with open(tmp_path / log, "ab") as f:
+        f.write(tail)
+
+    reopened = LocalBackend(tmp_path)
+    assert reopened.get_items("") == {"AGGR:a": 1.0, "ORGE:1": b"raw"}
+    assert reopened.counters["truncated_bytes"] == len(tail)
+    assert os.path.getsize(tmp_path / log) == size
+    # appends after the truncated tail are replayed
+    reopened.mupdate({"AGGR:a": 1.0})
+    reopened.close()
+    again = LocalBackend(tmp_path)
+    assert counter(again, "AGGR:a") == 2.0
+    again.close()
+
+
+def test_removes_leftovers_of_an_interrupted_snapshot(tmp_path):
+    storage = LocalBackend(tmp_path)
+    storage.mupdate({"AGGR:a": 1.0})
+    storage.close()
+    (tmp_path / "snapshot.tmp").write_bytes(b"half a snapshot")
+    (tmp_path / "log.7").write_bytes(b"")
+
+    reopened = LocalBackend(tmp_path)
+    assert counter(reopened, "AGGR:a") == 1.0
+    assert not (tmp_path / "snapshot.tmp").exists()
+    assert logs(tmp_path) == ["log.0"]
+    reopened.close()
+
+
+def test_ttls_survive_a_restart(tmp_path, monkeypatch):
+    storage = LocalBackend(tmp_path)
+    storage.write(WriteBatch(hdeltas={"B:0": {"a": 1.0}}, ttls={"B:0": 60}))
+    storage.close()
+    reopened = LocalBackend(tmp_path)
+    assert reopened.get_hash("B:0") == {"a": 1.0}
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    assert reopened.get_hash("B:0") == {}
+    reopened.close()
+
+
+def test_close_is_idempotent(tmp_path):
+    storage = LocalBackend(tmp_path)
+    storage.close()
+    storage.close()
+
+
+def test_backends_share_a_directory(tmp_path):
+    first, second = LocalBackend(tmp_path), LocalBackend(tmp_path)
+    first.mupdate({"AGGR:a": 1.0})
+    assert second.mupdate({"AGGR:a": 1.0}) == [2.0]
+    first.snapshot()
+    second.write(WriteBatch(hdeltas={"IDX:0": {"a": 1.0}}))
+    assert first.get_hash("IDX:0") == {"a": 1.0}
+    assert counter(first, "AGGR:a") == 2.0
+    first.close()
+    second.close()
+
+
+def test_concurrent_threads(tmp_path):
+    storage = LocalBackend(tmp_path, snapshot_bytes=4096)
+
+    def increment():
+        for _ in range(200):
+            storage.write(
+                WriteBatch(deltas={"AGGR:a": 1.0}, hdeltas={"IDX:0": {"a": 1.0}})
+            )
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter(storage, "AGGR:a") == 800.0
+    assert storage.get_hash("IDX:0") == {"a": 800.0}
+    storage.close()
+
+
+def increment(directory: str, num: int):
+    # each process opens its own backend, as pre-forked workers do
+    storage = LocalBackend(directory, snapshot_bytes=4096)
+    for i in range(num):
+        storage.write(
+            WriteBatch(
+                sets={f"ORGE:{os.getpid()}:{i}": b"raw"},
+                deltas={"AGGR:a": 1.0},
+                hdeltas={"IDX:0": {"a": 1.0}},
+            )
+        )
+    storage.close()
+
+
+def test_concurrent_processes(tmp_path):
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=increment, args=(str(tmp_path), 200)) for _ in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+
+    storage = LocalBackend(tmp_path)
+    assert counter(storage, "AGGR:a") == 800.0
+    assert storage.get_hash("IDX:0") == {"a": 800.0}
+    assert len(storage.get_keys("ORGE:")) == 800
+    storage.close()
@@ -0,0 +1,33 @@
+import pytest
+
+from omnimatsoo.kvstorage import WriteBatch
+
+
+@pytest.mark.parametrize("membership", ["none", "set", "prefix", "bloom"])
+def test_contains(make_redis_backend, membership):
+    storage = make_redis_backend(membership=membership, bloom_capacity=1000)
+    storage.write(WriteBatch(sets={"ORGE:a:1": b"raw"}, deltas={"AGGR:a": 1.0}))
+    storage.set("ORGE:b:1", b"raw")
+    assert storage.contains("ORGE:a:1")
+    assert storage.contains("ORGE:b:1")
+    assert storage.contains("AGGR:a")
+    assert not storage.contains("ORGE:c:1")
+
+
+@pytest.mark.parametrize("membership", ["set", "prefix", "bloom"])
+def test_listings_leave_out_internal_keys(make_redis_backend, membership):
+    storage = make_redis_backend(membership=membership, bloom_capacity=1000)
+    storage.mset([f"ORGE:{i}" for i in range(20)], [b"raw"] * 20)
+    expected = {f"ORGE:{i}".encode("utf-8") for i in range(20)}
+    assert set(storage.get_items("")) == expected
+    assert {k for k, _ in storage.iter_items("", 3)} == expected
+    assert set(storage.iter_keys("", 3)) == expected
+
+
+def test_scan_skips_the_bloom_filter_server_side(make_redis_backend):
+    storage = make_redis_backend(membership="bloom", bloom_capacity=1000)
+    storage.set("ORGE:1", b"raw")
+    (bloom_key,) = (k for k in storage.membership.internal_keys if isinstance(k, str))
+    assert storage.redis_client.exists(bloom_key)
+    _, keys, values = storage._scan_script(args=[0, "*", 1000, bloom_key])
+    assert keys == [b"ORGE:1"] and values == [b"raw"]
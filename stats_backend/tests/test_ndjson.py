@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+URL = "/aggr/all/?format=ndjson&limit=3"
+
+
+@pytest.fixture
+def num_records(client, make_session):
+    # a raw record and its counters per session
+    body = "\n".join(json.dumps(make_session(i)) for i in range(5))
+    client.post("/collect/batch/", data=body)
+    return len(client.get("/aggr/all/").get_json())
+
+
+def lines(body: bytes) -> list:
+    return [json.loads(line) for line in body.decode().splitlines()]
+
+
+def test_wsgi_pages(client, num_records):
+    keys, cursor, num_pages = [], "", 0
+    while cursor is not None:
+        response = client.get(f"{URL}&cursor={cursor}")
+        assert response.content_type == "application/x-ndjson"
+        page = lines(response.data)
+        cursor = page.pop()["cursor"] if "cursor" in page[-1] else None
+        assert len(page) <= 3
+        keys += [line["key"] for line in page]
+        num_pages += 1
+    assert len(keys) == len(set(keys)) == num_records
+    assert num_pages > 1
+
+
+def test_native_streams_all(native_fetch, client, num_records):
+    response = native_fetch(URL)
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    records = lines(response.body)
+    assert len(records) == num_records
+    assert dict(map(dict.values, records)) == client.get("/aggr/all/").get_json()
+    # a listing started on the wsgi server carries on page by page
+    cursor = lines(client.get(URL).data)[-1]["cursor"]
+    assert lines(native_fetch(f"{URL}&cursor={cursor}").body) == lines(
+        client.get(f"{URL}&cursor={cursor}").data
+    )
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+URL = "/aggr/playable-latency-quantiles/"
+
+
+@pytest.fixture
+def collected(client, make_session):
+    # 9 to 108 ms until loadeddata
+    body = "\n".join(json.dumps(make_session(i)) for i in range(100))
+    assert client.post("/collect/batch/", data=body).get_json()["accepted"] == 100
+    return client
+
+
+def test_quantiles(collected):
+    response = collected.get(f"{URL}0/?q=0.5,0.99")
+    assert response.status_code == 200
+    result = response.get_json()
+    assert list(result) == ["CloudFront"]
+    assert result["CloudFront"] == {
+        "0.5": pytest.approx(58.0, rel=0.02),
+        "0.99": pytest.approx(107.0, rel=0.02),
+    }
+    # the default quantiles, by origin and device
+    result = collected.get(f"{URL}0,1/").get_json()
+    assert list(result) == ["CloudFront:pixel"]
+    assert list(result["CloudFront:pixel"]) == ["0.5", "0.95", "0.99"]
+
+
+def test_playback_duration_quantiles(collected):
+    result = collected.get("/aggr/playback-duration-quantiles/0/?q=1").get_json()
+    # 50 of the 60 seconds played
+    assert result == {"CloudFront": {"1.0": pytest.approx(50 / 60, rel=0.02)}}
+
+
+@pytest.mark.parametrize("q", ["abc", "0.5,x", "1.5", "-0.1", ","])
+def test_bad_quantiles(collected, q):
+    response = collected.get(f"{URL}0/?q={q}")
+    assert response.status_code == 400
+    assert q in response.get_data(as_text=True)
+
+
+def test_bad_nodes(collected):
+    assert collected.get(f"{URL}9/").status_code == 400
+    assert collected.get(f"{URL}x/").status_code == 400
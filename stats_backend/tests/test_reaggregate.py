@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+from omnimatsoo.entities import PlaybackStatistics
+from omnimatsoo.kvstorage import RedisBackend, WriteBatch
+from omnimatsoo.services import PREFIXES, PlaybackBenchmark
+from util import counters, hashes, items
+
+QUERIES = (
+    ("group_by_nodes_playable", {"nodes": [0, 1]}),
+    ("group_by_nodes_playback_duration", {"nodes": [2]}),
+    ("group_by_nodes_num_events", {"event_name": "playing", "nodes": [0]}),
+    ("group_by_nodes_playable_quantiles", {"nodes": [0], "quantiles": [0.5]}),
+)
+
+
+def results(service) -> list:
+    return [getattr(service, name)(**kwargs) for name, kwargs in QUERIES]
+
+
+@pytest.fixture
+def service(memory_storage, make_session):
+    # 3 sessions older than a day, 2 recent ones
+    service = PlaybackBenchmark()
+    now = int(time.time() * 1000)
+    for i in range(5):
+        timestamp = now - (10 * 86400 * 1000 if i < 3 else 0) + i
+        service.add(
+            PlaybackStatistics(
+                **make_session(i, timestamp=timestamp, device_tag=f"d{i % 2}")
+            )
+        )
+    return service
+
+
+def test_reaggregate_restores_the_aggregations(service, memory_storage):
+    before = results(service)
+    memory_storage.delete(memory_storage.get_keys("AGGRHIST:"))
+    memory_storage.replace_hashes(PREFIXES.ROLLUP_INDEX, {})
+    assert results(service) != before
+    assert service.reaggregate()["sessions"] == 5
+    assert results(service) == before
+    assert not memory_storage.get_keys(PREFIXES.STAGED_AGGREGATIONS)
+
+
+def test_reaggregate_from_archives(service, memory_storage, tmp_path):
+    before = results(service)
+    assert service.compact_raw(86400, str(tmp_path))["records"] == 3
+    with pytest.raises(ValueError, match="archives are required"):
+        service.reaggregate()
+    archives = tuple(str(path) for path in tmp_path.iterdir())
+    assert service.reaggregate(archives=archives)["sessions"] == 5
+    assert results(service) == before
+    # the archived rollups still account for the compacted sessions
+    service.rebuild_rollups()
+    assert results(service) == before
+
+
+def test_reaggregate_dropping_compacted_sessions(service, memory_storage):
+    assert service.compact_raw(86400)["records"] == 3
+    assert service.reaggregate(drop_compacted=True)["sessions"] == 2
+    assert not list(memory_storage.iter_hashes(PREFIXES.ARCHIVED_ROLLUPS))
+    assert service.group_by_nodes_num_events("playing", [0]) == {"CloudFront": 2}
+    dropped = results(service)
+    # the dropped sessions don't come back with the rollups
+    service.rebuild_rollups()
+    assert results(service) == dropped
+
+
+def test_reaggregate_refuses_with_a_raw_ttl(memory_storage, make_session):
+    service = PlaybackBenchmark(raw_ttl=86400)
+    service.add(PlaybackStatistics(**make_session()))
+    with pytest.raises(ValueError, match="raw record ttl"):
+        service.reaggregate()
+    assert service.reaggregate(drop_expired=True)["sessions"] == 1
+
+
+def test_export_raw(service):
+    class Rows:
+        def __init__(self):
+            self.rows = []
+
+        def write(self, rows):
+            self.rows.extend(rows)
+
+    writer = Rows()
+    assert service.export_raw(writer, chunk_size=2) == 5
+    assert sorted(row[0] for row in writer.rows) == [f"{i:08x}" for i in range(5)]
+
+
+def test_swap_namespace(storage):
+    storage.write(
+        WriteBatch(
+            sets={"ORGE:1": b"raw"},
+            deltas={"AGGR:a": 1.0, "AGGR:stale": 5.0},
+            hdeltas={"AGGRIDX:0": {"a": 1.0}, "AGGRIDX:stale": {"b": 1.0}},
+        )
+    )
+    storage.write(
+        WriteBatch(
+            deltas={"NEW:AGGR:a": 7.0, "NEW:AGGR:b": 2.0},
+            hdeltas={"NEW:AGGRIDX:0": {"a": 9.0}},
+            ttls={"NEW:AGGR:b": 60},
+        )
+    )
+    assert storage.swap_namespace("NEW:", ("AGGR:", "AGGRIDX:")) == 3
+    assert items(storage, "ORGE:") == {"ORGE:1": "raw"}
+    assert counters(storage, "AGGR:") == {"AGGR:a": 7.0, "AGGR:b": 2.0}
+    assert hashes(storage, "AGGRIDX:") == {"AGGRIDX:0": {"a": 9.0}}
+    assert not items(storage, "NEW:") and not hashes(storage, "NEW:")
+    # ttls move with the keys
+    if isinstance(storage, RedisBackend):
+        assert 0 < storage.redis_client.ttl("AGGR:b") <= 60
+        assert storage.redis_client.ttl("AGGR:a") == -1
+    else:
+        assert set(storage._expiry) == {"AGGR:b"}
+
+
+def test_swap_namespace_without_staged_keys(storage):
+    storage.mupdate({"AGGR:a": 1.0})
+    assert storage.swap_namespace("NEW:", ("AGGR:",)) == 0
+    assert not items(storage, "AGGR:")
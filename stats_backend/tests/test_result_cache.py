@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from omnimatsoo.kvstorage import Client
+from omnimatsoo.services import PREFIXES, ServiceClients
+
+URL = "/aggr/playable-latency/0/"
+
+
+@pytest.fixture(autouse=True)
+def long_ttl(monkeypatch):
+    # entries only go stale through version bumps
+    monkeypatch.setenv("APP_RESULT_CACHE_TTL", "3600")
+
+
+def versions() -> dict:
+    return Client.get().get_hash(PREFIXES.RESULT_VERSIONS)
+
+
+def test_etag_and_not_modified(client, make_session):
+    client.post("/collect/", data=json.dumps(make_session(0)))
+    response = client.get(URL)
+    assert response.status_code == 200
+    assert response.get_json() == {"CloudFront": 9.0}
+    etag = response.headers["ETag"]
+
+    cache = ServiceClients.playback_benchmark.result_cache
+    assert client.get(URL).headers["ETag"] == etag
+    assert cache.counters["hits"] == 1
+
+    response = client.get(URL, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.data == b""
+    # another handler or nodes have their own etag
+    assert client.get("/aggr/playable-latency/0,1/").headers["ETag"] != etag
+    assert client.get("/aggr/playback-duration/0/").headers["ETag"] != etag
+
+
+def test_collect_invalidates_cached_results(client, make_session):
+    client.post("/collect/", data=json.dumps(make_session(0)))
+    response = client.get(URL)
+    etag, before = response.headers["ETag"], versions()
+
+    client.post("/collect/", data=json.dumps(make_session(2)))
+    assert versions() != before
+    response = client.get(URL, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.get_json() == {"CloudFront": 10.0}
+
+
+def test_native_etag_and_not_modified(native_fetch, make_session):
+    native_fetch("/collect/", method="POST", body=json.dumps(make_session(0)))
+    response = native_fetch(URL)
+    assert response.code == 200
+    assert json.loads(response.body) == {"CloudFront": 9.0}
+    etag = response.headers["Etag"]
+
+    response = native_fetch(URL, headers={"If-None-Match": etag})
+    assert response.code == 304
+
+    native_fetch("/collect/", method="POST", body=json.dumps(make_session(2)))
+    response = native_fetch(URL, headers={"If-None-Match": etag})
+    assert response.code == 200
+    assert response.headers["Etag"] != etag
+    assert json.loads(response.body) == {"CloudFront": 10.0}
@@ -0,0 +1,104 @@
+from itertools import permutations
+
+import pytest
+
+from omnimatsoo.entities import PlaybackStatistics
+from omnimatsoo.kvstorage import MemoryBackend, WriteBatch
+from omnimatsoo.services import PREFIXES, PlaybackBenchmark
+from util import hashes
+
+SESSIONS = (
+    ("https://d1.cloudfront.net/v/a.mp4", "pixel"),
+    ("https://b.s3.amazonaws.com/v/a.mp4", "ios"),
+    ("https://b.s3.amazonaws.com/x/b.mp4", "pixel"),
+)
+
+
+@pytest.fixture
+def service(memory_storage, make_session):
+    # 9, 10 and 11 ms until loadeddata, 50 s played of 60 s
+    service = PlaybackBenchmark()
+    for i, (target, device_tag) in enumerate(SESSIONS):
+        service.add(
+            PlaybackStatistics(**make_session(i, target=target, device_tag=device_tag))
+        )
+    return service
+
+
+def test_write_hashes(storage):
+    storage.write(
+        WriteBatch(
+            sets={"ORGE:a:1": b"raw1"},
+            hdeltas={"IDX:0": {"a": 1.0, "b": 2.0}, "IDX:1": {"a:x": 0.5}},
+        )
+    )
+    storage.write(WriteBatch(hdeltas={"IDX:0": {"a": 1.0, "c": 4.0}}))
+    assert hashes(storage, "IDX:") == {
+        "IDX:0": {"a": 2.0, "b": 2.0, "c": 4.0},
+        "IDX:1": {"a:x": 0.5},
+    }
+
+
+def test_group_by_nodes(service):
+    assert service.group_by_nodes_playable([0]) == {"CloudFront": 9.0, "S3": 10.5}
+    assert service.group_by_nodes_playable([0, 1, 2]) == {
+        "CloudFront:pixel:a.mp4": 9.0,
+        "S3:ios:a.mp4": 10.0,
+        "S3:pixel:b.mp4": 11.0,
+    }
+    assert service.group_by_nodes_playback_duration([1]) == {
+        "pixel": pytest.approx(50 / 60),
+        "ios": pytest.approx(50 / 60),
+    }
+    assert service.group_by_nodes_num_events("playing", [0]) == {
+        "CloudFront": 1,
+        "S3": 2,
+    }
+
+
+def test_index_is_kept_at_ingest(service, memory_storage):
+    index = hashes(memory_storage, PREFIXES.ROLLUP_INDEX)
+    counts = PREFIXES.ROLLUP_INDEX + PREFIXES.AGGREGATION_TIME_BECOME_PLAYABLE_COUNTS
+    assert index[counts + "0"] == {"CloudFront": 1.0, "S3": 2.0}
+    assert index[counts + "1"] == {"pixel": 2.0, "ios": 1.0}
+
+
+def test_bad_node_numbers(service):
+    with pytest.raises(IndexError):
+        service.group_by_nodes_playable([3])
+
+
+def test_replace_hashes(storage):
+    storage.write(
+        WriteBatch(
+            hdeltas={"IDX:0": {"a": 1.0}, "IDX:1": {"b": 1.0}, "KEEP:0": {"c": 1.0}},
+            ttls={"IDX:1": 60},
+        )
+    )
+    storage.replace_hashes("IDX:", {"IDX:1": {"d": 2.0}, "IDX:2": {"e": 3.0}})
+    assert hashes(storage, "IDX:") == {"IDX:1": {"d": 2.0}, "IDX:2": {"e": 3.0}}
+    assert hashes(storage, "KEEP:") == {"KEEP:0": {"c": 1.0}}
+    if isinstance(storage, MemoryBackend):
+        assert not storage._expiry
+
+
+def test_every_node_subset(service):
+    # any subset in any order, e.g. video then origin, is read from its cube
+    nodes = service.group_by_nodes_playable([0, 1, 2])
+    for size in (1, 2, 3):
+        for subset in permutations(range(3), size):
+            expected = {}
+            for key, latency in nodes.items():
+                group = ":".join(key.split(":")[i] for i in subset)
+                expected.setdefault(group, []).append(latency)
+            assert service.group_by_nodes_playable(list(subset)) == {
+                group: sum(values) / len(values) for group, values in expected.items()
+            }
+
+
+def test_rebuild_rollups(service, memory_storage):
+    before = service.group_by_nodes_playable([2, 0])
+    memory_storage.replace_hashes(PREFIXES.ROLLUP_INDEX, {})
+    assert service.group_by_nodes_playable([2, 0]) == {}
+    assert service.rebuild_rollups() == 3
+    assert service.group_by_nodes_playable([2, 0]) == before
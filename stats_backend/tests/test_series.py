@@ -0,0 +1,104 @@
+import json
+import time
+
+import pytest
+
+from omnimatsoo.kvstorage import Client, MemoryBackend, RedisBackend, WriteBatch
+from omnimatsoo.services import PREFIXES, TIME_BUCKETS
+
+URL = "/aggr/playable-latency/0/"
+
+
+@pytest.fixture
+def now():
+    # the start of a two minutes window
+    return int(time.time()) // 120 * 120
+
+
+def collect(client, sessions):
+    for session in sessions:
+        assert client.post("/collect/", data=json.dumps(session)).status_code == 200
+
+
+def test_series_buckets(client, make_session, now):
+    # 9 ms until loadeddata, then 11, 10 and 10 ms a minute later
+    collect(
+        client,
+        [
+            make_session(0, timestamp=now * 1000),
+            make_session(2, timestamp=(now + 60) * 1000),
+            make_session(1, timestamp=(now + 60) * 1000 + 10),
+            make_session(1, timestamp=(now + 60) * 1000 + 20),
+        ],
+    )
+    response = client.get(f"{URL}?from={now}&to={now + 120}&step=60")
+    assert response.status_code == 200
+    assert response.get_json() == {"CloudFront": [[now, 9.0], [now + 60, 31 / 3]]}
+    # windows of a coarser step merge the buckets they cover
+    response = client.get(f"{URL}?from={now}&to={now + 120}&step=120")
+    assert response.get_json() == {"CloudFront": [[now, 10.0]]}
+    # and buckets outside the range are left out
+    response = client.get(f"{URL}?from={now + 60}&to={now + 120}&step=60")
+    assert response.get_json() == {"CloudFront": [[now + 60, 31 / 3]]}
+
+
+def test_series_bucket_ttls(client, make_session, now):
+    collect(client, [make_session(0, timestamp=now * 1000)])
+    storage = Client.get()
+    while hasattr(storage, "storage"):
+        storage = storage.storage
+    ttls = {
+        int(name.split(":")[1]): deadline - time.time()
+        for name, deadline in storage._expiry.items()
+        if name.startswith(PREFIXES.TIME_SERIES)
+    }
+    for resolution, ttl in TIME_BUCKETS:
+        if ttl:
+            assert ttls[resolution] == pytest.approx(ttl, abs=5)
+        else:
+            assert resolution not in ttls
+    # buckets past their ttl can't be queried
+    response = client.get(f"{URL}?from={now - 3 * 86400}&to={now}&step=60")
+    assert response.status_code == 400
+
+
+def test_duration_series_skips_empty_windows(client, make_session, now):
+    collect(client, [make_session(0, timestamp=now * 1000, duration=0)])
+    response = client.get(f"/aggr/playback-duration/0/?from={now - 60}&step=60")
+    assert response.status_code == 200
+    assert response.get_json() == {}
+
+
+@pytest.mark.parametrize(
+    "query",
+    ["to=inf", "from=-inf", "from=nan", "to=1e400", "step=0", "from=10&to=5", "step=x"],
+)
+def test_bad_time_ranges(client, native_fetch, query):
+    assert client.get(f"{URL}?{query}").status_code == 400
+    assert native_fetch(f"{URL}?{query}").code == 400
+
+
+def test_write_ttls(storage):
+    storage.write(
+        WriteBatch(
+            deltas={"T:counter": 1.0},
+            hdeltas={"T:bucket": {"a": 1.0}},
+            ttls={"T:counter": 60, "T:bucket": 60},
+        )
+    )
+    storage.set("T:plain", b"v")
+    if isinstance(storage, RedisBackend):
+        ttls = {k: storage.redis_client.ttl(k) for k in ("T:counter", "T:bucket")}
+        assert all(0 < ttl <= 60 for ttl in ttls.values())
+        assert storage.redis_client.ttl("T:plain") == -1
+    else:
+        assert set(storage._expiry) == {"T:counter", "T:bucket"}
+
+
+def test_expired_hash_starts_afresh(monkeypatch):
+    storage, now = MemoryBackend(), time.time()
+    storage.write(WriteBatch(hdeltas={"B:0": {"a": 2.0}}, ttls={"B:0": 60}))
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    storage.write(WriteBatch(hdeltas={"B:0": {"a": 1.0}}, ttls={"B:0": 60}))
+    assert storage.get_hash("B:0") == {"a": 1.0}
+    assert storage._expiry["B:0"] == pytest.approx(now + 180)
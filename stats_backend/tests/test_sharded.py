@@ -0,0 +1,100 @@
+import pytest
+
+from omnimatsoo.kvstorage import MemoryBackend, ShardedBackend, WriteBatch
+from omnimatsoo.services import routing_tag
+from util import counters, hashes, items, text
+
+NUM_SHARDS = 3
+
+
+@pytest.fixture(params=["memory", "redis"])
+def sharded(request):
+    if request.param == "memory":
+        shards = [MemoryBackend() for _ in range(NUM_SHARDS)]
+    else:
+        make = request.getfixturevalue("make_redis_backend")
+        shards = [make(server=f"shard{i}") for i in range(NUM_SHARDS)]
+    backend = ShardedBackend(shards, tag=routing_tag)
+    yield backend
+    backend.close()
+
+
+def keys_by_shard(backend: ShardedBackend, prefix: str) -> dict[int, list[str]]:
+    # a few keys under prefix for every shard
+    ret = {}
+    for i in range(1000):
+        key = f"{prefix}:group{i}:{i}"
+        ret.setdefault(backend._shard_index(key), []).append(key)
+        if len(ret) == NUM_SHARDS and min(map(len, ret.values())) >= 3:
+            return ret
+    raise AssertionError("keys don't spread over the shards")
+
+
+def apply(storage, keys: dict[int, list[str]]):
+    # the same calls on the sharded and the single backend
+    all_keys = [k for shard_keys in keys.values() for k in shard_keys]
+    storage.mset(all_keys, [k.encode("utf-8") for k in all_keys])
+    for i, key in enumerate(all_keys):
+        storage.write(
+            WriteBatch(
+                sets={key: b"raw"},
+                deltas={key.replace("ORGE", "AGGR"): 1.0 + i},
+                hdeltas={
+                    "AGGRIDX:S:0": {key.split(":")[1]: 1.0 + i, "all": 1.0},
+                    "AGGRIDX:C:0": {key.split(":")[1]: 1.0, "all": 1.0},
+                },
+                ttls={"AGGRIDX:S:0": 3600},
+            )
+        )
+    storage.mupdate({key.replace("ORGE", "AGGR"): 0.5 for key in all_keys[::2]})
+    storage.delete(all_keys[1::3])
+
+
+def test_parity(sharded):
+    keys = keys_by_shard(sharded, "ORGE")
+    single = MemoryBackend()
+    apply(sharded, keys)
+    apply(single, keys)
+
+    assert items(sharded, "ORGE:") == items(single, "ORGE:")
+    assert counters(sharded, "AGGR:") == counters(single, "AGGR:")
+    assert hashes(sharded, "AGGRIDX:") == hashes(single, "AGGRIDX:")
+    for nodes in (None, [0]):
+        ids = ["AGGRIDX:S:0", "AGGRIDX:C:0"]
+        grouped = sharded.group_hashes(ids, nodes)
+        assert {text(k): v for k, v in grouped.items()} == single.group_hashes(
+            ids, nodes
+        )
+    assert [
+        {text(f): v for f, v in fields.items()}
+        for fields in sharded.get_hashes(["AGGRIDX:S:0", "AGGRIDX:missing"])
+    ] == single.get_hashes(["AGGRIDX:S:0", "AGGRIDX:missing"])
+    scanned = {text(k) for k, _ in sharded.iter_items("ORGE:", 2)}
+    assert scanned == set(single.get_keys("ORGE:"))
+    assert all(sharded.contains(k) for k in single.get_keys("ORGE:"))
+
+
+def test_hash_deltas_go_to_the_home_shard_of_the_first_key(sharded):
+    keys = keys_by_shard(sharded, "ORGE")
+    first, second = keys[0][0], keys[1][0]
+    hash_id = "AGGRIDX:S:0"
+    sharded.write(WriteBatch(sets={first: b"raw"}, hdeltas={hash_id: {"a": 1.0}}))
+    sharded.write(WriteBatch(sets={second: b"raw"}, hdeltas={hash_id: {"a": 2.0}}))
+    # partial sums on the shards of each batch's first key, whole when read
+    parts = [
+        {text(f): v for f, v in shard.get_hash(hash_id).items()}
+        for shard in sharded.shards
+    ]
+    assert parts[0] == {"a": 1.0} and parts[1] == {"a": 2.0}
+    assert {text(f): v for f, v in sharded.get_hash(hash_id).items()} == {"a": 3.0}
+    assert {text(k): v for k, v in sharded.group_hashes([hash_id]).items()} == {
+        "a": [3.0]
+    }
+    # without a plain key, a hash goes to its own shard
+    sharded.write(WriteBatch(hdeltas={hash_id: {"a": 4.0}}))
+    assert {text(f): v for f, v in sharded.get_hash(hash_id).items()} == {"a": 7.0}
+
+
+def test_a_staged_key_is_routed_like_its_final_name(sharded):
+    for key in keys_by_shard(sharded, "AGGRHIST:playing")[0]:
+        assert sharded._shard_index("AGGRNEW:" + key) == sharded._shard_index(key)
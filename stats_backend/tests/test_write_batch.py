@@ -0,0 +1,60 @@
+import pytest
+
+from omnimatsoo.kvstorage import WriteBatch
+from util import counters, items
+
+
+def test_write(storage):
+    assert storage.write(
+        WriteBatch(
+            sets={"ORGE:a:1": b"raw1", "ORGE:a:2": b"raw2"},
+            deltas={"AGGR:a": 1.5, "AGGR:b": 2.0},
+        )
+    )
+    storage.write(WriteBatch(sets={"ORGE:a:2": b"raw3"}, deltas={"AGGR:a": 1.0}))
+    assert items(storage, "ORGE:") == {"ORGE:a:1": "raw1", "ORGE:a:2": "raw3"}
+    assert counters(storage, "AGGR:") == {"AGGR:a": 2.5, "AGGR:b": 2.0}
+
+
+def test_mupdate_returns_the_updated_values(storage):
+    storage.mupdate({"AGGR:a": 1.0})
+    assert storage.mupdate({"AGGR:a": 0.5, "AGGR:c": 1.0}) == [1.5, 1.0]
+    assert storage.mupdate({}) == []
+
+
+def test_empty_write(storage):
+    assert storage.write(WriteBatch())
+    assert not items(storage, "")
+
+
+def test_merge():
+    batch = WriteBatch(
+        sets={"a": b"1"}, deltas={"c": 1.0}, hdeltas={"h": {"f": 1.0}}, ttls={"h": 60}
+    )
+    batch.merge(
+        WriteBatch(
+            sets={"a": b"2"},
+            deltas={"c": 2.0, "d": 1.0},
+            hdeltas={"h": {"f": 1.0, "g": 1.0}},
+            ttls={"h": 30, "c": 10},
+        )
+    )
+    assert batch == WriteBatch(
+        sets={"a": b"2"},
+        deltas={"c": 3.0, "d": 1.0},
+        hdeltas={"h": {"f": 2.0, "g": 1.0}},
+        ttls={"h": 60, "c": 10},
+    )
+
+
+def test_script_calls(make_redis_backend):
+    storage = make_redis_backend()
+    storage.write(WriteBatch(sets={"ORGE:1": b"raw"}, deltas={"AGGR:a": 1.0}))
+    assert storage.counters["script_calls"] == 1
+
+
+@pytest.mark.parametrize("transactions", ["lua", "watch"])
+def test_membership_is_tracked_with_the_write(make_redis_backend, transactions):
+    storage = make_redis_backend(transactions=transactions, membership="set")
+    storage.write(WriteBatch(sets={"ORGE:1": b"raw"}, deltas={"AGGR:a": 1.0}))
+    assert storage.contains("ORGE:1") and storage.contains("AGGR:a")
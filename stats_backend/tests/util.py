@@ -0,0 +1,24 @@
+# reads normalized across backends: Redis returns bytes where MemoryBackend
+# keeps the str it was given
+
+
+def text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def items(storage, prefix: str) -> dict:
+    return {text(k): text(v) for k, v in storage.get_items(prefix).items()}
+
+
+def counters(storage, prefix: str) -> dict:
+    return {k: float(v) for k, v in items(storage, prefix).items()}
+
+
+def hashes(storage, prefix: str) -> dict:
+    # hashes split over shards are summed up
+    ret = {}
+    for k, fields in storage.iter_hashes(prefix):
+        target = ret.setdefault(text(k), {})
+        for f, v in fields.items():
+            target[text(f)] = target.get(text(f), 0.0) + v
+    return ret